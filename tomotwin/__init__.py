@@ -32,7 +32,7 @@ from pyworkflow import Config
 from .constants import *
 
 
-__version__ = '3.5.1'
+__version__ = '3.6'
 _references = ['Rice2022']
 _logo = "tomotwin_logo.png"
 
@@ -46,6 +46,11 @@ class Plugin(pwem.Plugin):
     def _defineVariables(cls):
         cls._defineVar(TOMOTWIN_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
         cls._defineEmVar(TOMOTWIN_MODEL, cls._getTomotwinModel(DEFAULT_MODEL))
+        cls._defineVar(TOMOTWIN_CACHE_QUOTA, 200)
+        cls._defineVar(TOMOTWIN_CACHE_HASH, False)
+        cls._defineVar(TOMOTWIN_EMBED_CACHE_QUOTA, 500)
+        cls._defineVar(TOMOTWIN_PROFILE,
+                       os.path.join(Config.SCIPION_USER_DATA, "tomotwin_profile.json"))
 
     @classmethod
     def _getTomotwinModel(cls, version):
@@ -129,11 +134,13 @@ class Plugin(pwem.Plugin):
         return f'{cls.getCondaActivationCmd()} {cls.getTomoTwinEnvActivation()}'
 
     @classmethod
-    def getProgram(cls, program, gpus=True, useQueue=False):
-        """ Create TomoTwin command line. """
+    def getProgram(cls, program, gpus=True, useQueue=False, gpuId=None):
+        """ Create TomoTwin command line. If gpuId is given, the job
+        is pinned to that device instead of the step GPU list. """
         fullProgram = f"{cls.getActivationCmd()} && "
         if gpus and not useQueue:
-            fullProgram += "CUDA_VISIBLE_DEVICES=%(GPU)s "
+            gpu = "%(GPU)s" if gpuId is None else gpuId
+            fullProgram += f"CUDA_VISIBLE_DEVICES={gpu} "
 
         return fullProgram + program
 
@@ -0,0 +1,75 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+
+from .estimator import ROW_BYTES, UMAP_ROW_BYTES
+
+MEMORY_FRACTION = 0.8  # of the host RAM, when no memory budget is given
+MIN_FIT_SAMPLE = 10000
+GB = 1024 ** 3
+
+
+def getHostMemory():
+    """ Physical memory of the host in bytes. """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def getHostCores():
+    """ Cores this process may run on. """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class ResourceBudget:
+    """ Memory (bytes) and cores that one protocol run may use, and the
+    sizes and process counts derived from them. Missing values are
+    taken from the host. """
+    def __init__(self, memory=None, cores=None):
+        self.memory = int(memory or getHostMemory() * MEMORY_FRACTION)
+        self.cores = int(cores or getHostCores())
+
+    def getConcurrency(self, footprint, maxSteps):
+        """ Number of steps with a memory footprint (bytes) that fit
+        in the budget at the same time, between 1 and maxSteps. """
+        fit = self.memory // max(1, int(footprint))
+        return int(max(1, min(maxSteps, self.cores, fit)))
+
+    def getProcesses(self, concurrency):
+        """ Cores for each of concurrency steps. """
+        return max(1, self.cores // max(1, concurrency))
+
+    def getFitSampleSize(self, rows, jobs=1):
+        """ Largest UMAP sample of a tomogram with rows embeddings,
+        with jobs UMAPs running at the same time. """
+        memory = self.memory // max(1, jobs) - rows * ROW_BYTES
+        return int(max(0, min(rows, memory // UMAP_ROW_BYTES)))
+
+    def __str__(self):
+        return f"{self.memory / GB:.1f} GB, {self.cores} cores"
@@ -0,0 +1,242 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+import pyworkflow.utils as pwutils
+
+from . import Plugin
+from .constants import (TOMOTWIN_CACHE_QUOTA, TOMOTWIN_CACHE_HASH,
+                        TOMOTWIN_EMBED_CACHE_QUOTA, STAGING_CACHE_DIR,
+                        EMBED_CACHE_DIR)
+
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _updateHash(h, fn):
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            h.update(block)
+    return h
+
+
+def contentHash(fn):
+    """ Return a hex digest of the file content only. """
+    return _updateHash(hashlib.sha1(), fn).hexdigest()
+
+
+def fileFingerprint(fn, hashContent=False):
+    """ Return a hex digest identifying a file by its real path, size and
+    modification time and, optionally, by its content. """
+    fn = os.path.realpath(fn)
+    st = os.stat(fn)
+    h = hashlib.sha1(f"{fn}:{st.st_size}:{st.st_mtime_ns}".encode())
+    if hashContent:
+        _updateHash(h, fn)
+    return h.hexdigest()
+
+
+def linkOrCopy(src, dst):
+    """ Hard link src to dst, so that the file survives the cache eviction.
+    Fall back to a copy across file systems. """
+    pwutils.cleanPath(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class FileCache:
+    """ Directory of files addressed by a key, shared between protocols.
+    Producing an entry is guarded by a per-key file lock, so concurrent
+    steps (or protocols) asking for the same key wait for a single
+    producer. Entries are evicted in least recently used order once
+    the total size goes over the quota (bytes, 0 means no limit).
+    """
+    def __init__(self, path, quota=0, hashContent=False):
+        self.path = path
+        self.quota = quota
+        self.hashContent = hashContent
+        self.hits = 0
+        self.misses = 0
+        pwutils.makePath(path)
+
+    def getFingerprint(self, fn):
+        return fileFingerprint(fn, self.hashContent)
+
+    def getEntry(self, key, ext):
+        return os.path.join(self.path, key[:2], key + ext)
+
+    @contextmanager
+    def _lock(self, name):
+        with open(os.path.join(self.path, name + ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def lookup(self, key, ext):
+        """ Return the entry path or None. A hit refreshes the entry
+        access time for the LRU order. Hits are counted by get, so
+        that checking an entry before getting it counts once. """
+        entry = self.getEntry(key, ext)
+        if os.path.exists(entry):
+            os.utime(entry)
+            return entry
+        return None
+
+    def get(self, key, ext, producer):
+        """ Return the entry for key, calling producer(outputFn) to
+        create it on a miss. """
+        with self._lock(key):
+            entry = self.lookup(key, ext)
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = self.getEntry(key, ext)
+                pwutils.makePath(os.path.dirname(entry))
+                tmpFn = entry + ".part" + ext
+                try:
+                    producer(tmpFn)
+                    os.replace(tmpFn, entry)
+                finally:
+                    pwutils.cleanPath(tmpFn)
+                self.evict(keep=[entry])
+        return entry
+
+    def _iterEntries(self):
+        for root, _, files in os.walk(self.path):
+            for fn in files:
+                if fn.endswith(".lock") or ".part" in fn:
+                    continue
+                entry = os.path.join(root, fn)
+                st = os.stat(entry)
+                yield entry, st.st_size, st.st_mtime
+
+    def getSize(self):
+        return sum(size for _, size, _ in self._iterEntries())
+
+    def evict(self, keep=()):
+        """ Remove least recently used entries until the cache
+        fits into the quota. """
+        if not self.quota:
+            return []
+
+        removed = []
+        with self._lock("evict"):
+            entries = sorted(self._iterEntries(), key=lambda e: e[2])
+            total = sum(e[1] for e in entries)
+            for entry, size, _ in entries:
+                if total <= self.quota:
+                    break
+                if entry in keep:
+                    continue
+                pwutils.cleanPath(entry)
+                removed.append(entry)
+                total -= size
+        return removed
+
+    def getStats(self):
+        return f"cache hits: {self.hits}, misses: {self.misses}"
+
+
+class StagingCache(FileCache):
+    """ Project-level cache of tomograms and masks converted to MRC,
+    so that each input is converted once for all TomoTwin protocols. """
+    def getKey(self, inputFn, variant=None):
+        """ Key of an input file. Different conversions of the same
+        file (e.g. rescaled to another size) use their own variant. """
+        key = self.getFingerprint(inputFn)
+        if variant:
+            key = hashlib.sha1(f"{key} {variant}".encode()).hexdigest()
+        return key
+
+    def stage(self, inputFn, outputFn, convertFunc, variant=None):
+        """ Link outputFn to the converted inputFn, running
+        convertFunc(inputFn, fn) only if it is not cached yet. """
+        entry = self.get(self.getKey(inputFn, variant), ".mrc",
+                         lambda fn: convertFunc(inputFn, fn))
+        linkOrCopy(entry, outputFn)
+        return entry
+
+
+class EmbeddingCache(FileCache):
+    """ Project-level cache of TomoTwin embeddings (.temb), so that
+    protocols asking for an equivalent embedding skip the GPU job. """
+    def getKey(self, **kwargs):
+        """ Key from the parameters that define an embedding, e.g. the
+        tomogram fingerprint, model, stride, z-range and mask. """
+        return hashlib.sha1(json.dumps(kwargs, sort_keys=True).encode()).hexdigest()
+
+    def link(self, key, outputFn, producer, ext=".temb"):
+        """ Link outputFn to the cached entry. On a miss, producer()
+        must create outputFn, which is then added to the cache.
+        Return True on a hit. """
+        produced = []
+
+        def _produce(fn):
+            producer()
+            linkOrCopy(outputFn, fn)
+            produced.append(fn)
+
+        entry = self.get(key, ext, _produce)
+        if not produced:
+            pwutils.makePath(os.path.dirname(outputFn))
+            linkOrCopy(entry, outputFn)
+            return True
+        return False
+
+
+def _getQuota(var):
+    """ Read a size limit in GB from the plugin config, 0 = no limit. """
+    value = Plugin.getVar(var)
+    return int(float(value) * 1024 ** 3) if value else 0
+
+
+def _getBool(var):
+    return str(Plugin.getVar(var)).lower() in ["true", "1", "yes"]
+
+
+def getStagingCache(protocol):
+    """ Staging cache for the project of a given protocol. """
+    return StagingCache(protocol.getProject().getTmpPath(STAGING_CACHE_DIR),
+                        quota=_getQuota(TOMOTWIN_CACHE_QUOTA),
+                        hashContent=_getBool(TOMOTWIN_CACHE_HASH))
+
+
+def getEmbeddingCache(protocol):
+    """ Embedding cache for the project of a given protocol. """
+    return EmbeddingCache(protocol.getProject().getTmpPath(EMBED_CACHE_DIR),
+                          quota=_getQuota(TOMOTWIN_EMBED_CACHE_QUOTA),
+                          hashContent=_getBool(TOMOTWIN_CACHE_HASH))
@@ -44,6 +44,16 @@ TOMOTWIN_MODEL = 'TOMOTWIN_MODEL'
 MODEL_VERSIONS = ['052022', '092023']
 DEFAULT_MODEL = MODEL_VERSIONS[-1]
 
+# Cache vars
+TOMOTWIN_CACHE_QUOTA = 'TOMOTWIN_CACHE_QUOTA'  # GB, 0 = no limit
+TOMOTWIN_CACHE_HASH = 'TOMOTWIN_CACHE_HASH'
+TOMOTWIN_EMBED_CACHE_QUOTA = 'TOMOTWIN_EMBED_CACHE_QUOTA'  # GB, 0 = no limit
+STAGING_CACHE_DIR = 'tomotwin_staging'
+EMBED_CACHE_DIR = 'tomotwin_embeddings'
+
+# Batch sizes known to fit in memory, per host and model
+TOMOTWIN_PROFILE = 'TOMOTWIN_PROFILE'
+
 # Napari variables
 NAPARI_ENV_ACTIVATION = 'NAPARI_ENV_ACTIVATION'
 NAPARI_BOXMANAGER = 'napari_boxmanager'
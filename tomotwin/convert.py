@@ -24,6 +24,9 @@
 # *
 # **************************************************************************
 import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from emtable import Table
 
 from pyworkflow.object import Float
@@ -32,17 +35,167 @@ import pwem.emlib as emlib
 from tomo.objects import Coordinate3D
 from tomo.constants import BOTTOM_LEFT_CORNER
 
+MRC_EXTENSIONS = ['.mrc', '.mrcs', '.rec', '.map', '.st', '.ali']
+MRC_HEADER_BYTES = 1024
+MRC_MODES = [0, 1, 2, 6, 12]
+SPIDER_EXTENSIONS = ['.spi', '.vol', '.xmp']
+EM_HEADER_BYTES = 512
+EM_DTYPES = {1: "i1", 2: "i2", 4: "i4", 5: "f4", 9: "f8"}
+CONVERT_SLAB_BYTES = 256 * 1024 ** 2
+
+_readLock = threading.Lock()
+
 
 def readSetOfCoordinates3D(coordsFn, coord3DSet, inputTomo,
                            origin=BOTTOM_LEFT_CORNER, scale=1, groupId=None):
+    """ Read a Relion STAR file with 3D coordinates into a set.
+    The columns are converted in bulk and then appended in a single
+    transaction, see appendCoordinates3D. """
+    table = Table(fileName=coordsFn)
+    if not table.size():
+        return 0
+
+    coords = np.column_stack([
+        np.asarray(table.getColumnValues(label), dtype=np.float64)
+        for label in ['rlnCoordinateX', 'rlnCoordinateY', 'rlnCoordinateZ']
+    ])
+
+    return appendCoordinates3D(coords, coord3DSet, inputTomo, origin=origin,
+                               scale=scale, groupId=groupId)
+
+
+def appendCoordinates3D(coords, coord3DSet, inputTomo,
+                        origin=BOTTOM_LEFT_CORNER, scale=1, groupId=None,
+                        scores=None):
+    """ Append an (N, 3) array of xyz positions given in the origin
+    convention to coord3DSet. The origin shift is the same for all the
+    coordinates of a tomogram, so it is computed once and applied to the
+    whole array together with the scale factor. Returns the number
+    of appended items. """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    if not len(coords):
+        return 0
+
     coord3DSet.enableAppend()
     coord = Coordinate3D()
     coord._confidence = Float()
-    for row in Table.iterRows(fileName=coordsFn):
-        readCoordinate3D(coord, row, inputTomo, origin=origin,
-                         scale=scale, groupId=groupId)
+    coord.setVolume(inputTomo)
+    if groupId is not None:
+        coord.setGroupId(groupId)
+
+    # Scipion origin offset for this tomogram
+    coord.setPosition(0, 0, 0, origin)
+    offset = np.array([coord._x.get(), coord._y.get(), coord._z.get()],
+                      dtype=np.float64)
+    coords = (coords + offset) * scale
+
+    xAttr, yAttr, zAttr = coord._x, coord._y, coord._z
+    confAttr = coord._confidence
+    scores = [None] * len(coords) if scores is None else scores
+    for (x, y, z), score in zip(coords.tolist(), scores):
+        coord.setObjId(None)
+        xAttr.set(x)
+        yAttr.set(y)
+        zAttr.set(z)
+        if score is not None:
+            confAttr.set(float(score))
         coord3DSet.append(coord)
 
+    return len(coords)
+
+
+def readTable(fn):
+    """ Read a TomoTwin table (.temb, .tmap or .tloc),
+    i.e. a pickled pandas DataFrame. """
+    import pandas as pd
+    return pd.read_pickle(fn)
+
+
+def writeTable(table, fn):
+    pwutils.makePath(os.path.dirname(fn))
+    table.to_pickle(fn)
+
+
+def concatEmbeddings(tables, filepaths=None):
+    """ Concatenate reference embedding tables (one or more rows each),
+    optionally replacing the filepath column. """
+    import pandas as pd
+    result = pd.concat(tables, ignore_index=True)
+    result.attrs.update(tables[0].attrs)
+    if filepaths is not None:
+        result["filepath"] = list(filepaths)
+    return result
+
+
+def mergeEmbeddings(tables):
+    """ Merge tomogram embeddings of the same tomogram computed at
+    different strides (e.g. a coarse pass and finer windows). Positions
+    embedded more than once keep the row of the last table and the
+    attributes (stride...) of the last table are used. """
+    import pandas as pd
+    result = pd.concat(tables, ignore_index=True)
+    result = result.drop_duplicates(subset=["X", "Y", "Z"], keep="last")
+    result = result.sort_values(["Z", "Y", "X"], kind="stable", ignore_index=True)
+    result.attrs.update(tables[-1].attrs)
+    return result
+
+
+def mergeMaps(columns, outputFn, references=None):
+    """ Write a distance map (.tmap) built from (mapTable, refIndex)
+    pairs, one for each output reference, in the output order.
+    All the maps must come from the same tomogram embedding. """
+    first = columns[0][0]
+    merged = first[["X", "Y", "Z"]].copy()
+    for i, (table, refIndex) in enumerate(columns):
+        merged[f"d{i}"] = table[f"d{refIndex}"].to_numpy()
+    merged.attrs.update(first.attrs)
+    if references is not None:
+        merged.attrs["references"] = list(references)
+    writeTable(merged, outputFn)
+
+
+def readLocatedTable(tlocFn):
+    """ Read a TomoTwin locate table (.tloc) in-process, instead of
+    converting it to star files with tomotwin_pick.py.
+    Returns a list of (classId, className, coords, metric, size) tuples,
+    one for each predicted class (i.e. reference), where coords is
+    an (N, 3) array of xyz positions. """
+    located = readTable(tlocFn)
+    refs = located.attrs.get("references", [])
+    results = []
+
+    if located.empty:
+        return results
+
+    for classId, group in located.groupby("predicted_class", sort=True):
+        classId = int(classId)
+        if classId < len(refs):
+            className = pwutils.removeBaseExt(str(refs[classId]))
+        else:
+            className = f"class_{classId}"
+        coords = group[["X", "Y", "Z"]].to_numpy(dtype=np.float64)
+        metric = group["metric"].to_numpy() if "metric" in group else None
+        size = group["size"].to_numpy() if "size" in group else None
+        results.append((classId, className, coords, metric, size))
+
+    return results
+
+
+def readSetOfCoordinates3DFromTloc(tlocFn, coord3DSet, inputTomo,
+                                   origin=BOTTOM_LEFT_CORNER, scale=1):
+    """ Fill coord3DSet from a TomoTwin locate table. Each predicted
+    class goes into its own group and the metric is stored as the
+    coordinate score. The scale (a number or xyz factors) takes the
+    table positions to the pixels of inputTomo, e.g. when the
+    tomogram was rescaled for TomoTwin, before the origin shift.
+    Returns the number of appended items. """
+    count = 0
+    for classId, _, coords, metric, _ in readLocatedTable(tlocFn):
+        count += appendCoordinates3D(coords * scale, coord3DSet, inputTomo,
+                                     origin=origin, groupId=classId,
+                                     scores=metric)
+    return count
+
 
 def readCoordinate3D(coord, row, inputTomo, origin=BOTTOM_LEFT_CORNER,
                      scale=1, groupId=None):
@@ -55,9 +208,134 @@ def readCoordinate3D(coord, row, inputTomo, origin=BOTTOM_LEFT_CORNER,
         coord.setGroupId(groupId)
 
 
-def convertToMrc(inputFn, outputFn):
-    ih = emlib.image.ImageHandler()
-    if pwutils.getExt(inputFn) == '.mrc':
+def convertToMrc(inputFn, outputFn, cache=None, voxelSize=None):
+    """ Link MRC files (also with .rec, .map, .st... extensions) or
+    convert other formats to float32 mrc with the given voxel size.
+    If a StagingCache is provided, the converted file is taken from
+    (or added to) the cache and linked to outputFn. """
+    def _convert(inFn, outFn):
+        _convertImage(inFn, outFn, voxelSize)
+
+    if pwutils.getExt(inputFn) == '.mrc' or isMrcFile(inputFn):
         pwutils.createAbsLink(os.path.abspath(inputFn), outputFn)
+    elif cache is not None:
+        variant = f"voxel {voxelSize}" if voxelSize else None
+        cache.stage(inputFn, outputFn, _convert, variant=variant)
+    else:
+        _convert(inputFn, outputFn)
+
+
+def convertAllToMrc(files, cache=None, numWorkers=1, voxelSize=None):
+    """ Convert a list of (inputFn, outputFn) pairs with a pool
+    of threads. Conversions are streamed, so the memory used
+    is bounded by numWorkers slabs. """
+    def _convert(f):
+        convertToMrc(*f, cache=cache, voxelSize=voxelSize)
+
+    if numWorkers > 1 and len(files) > 1:
+        with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+            list(executor.map(_convert, files))
+    else:
+        for f in files:
+            _convert(f)
+
+
+def isMrcFile(fn):
+    """ True for MRC files, whatever the extension, that
+    TomoTwin can read directly. """
+    if pwutils.getExt(fn).lower() not in MRC_EXTENSIONS:
+        return False
+    with open(fn, "rb") as f:
+        header = f.read(MRC_HEADER_BYTES)
+    if len(header) < MRC_HEADER_BYTES or header[208:211] != b"MAP":
+        return False
+    for byteOrder in "<>":
+        dims = np.frombuffer(header, dtype=f"{byteOrder}i4", count=4)
+        if all(0 < d < 2 ** 16 for d in dims[:3]) and dims[3] in MRC_MODES:
+            return True
+    return False
+
+
+def _convertImage(inputFn, outputFn, voxelSize=None):
+    data = _mapVolume(inputFn)
+    if data is None:
+        # formats without a known layout are read whole,
+        # one at a time to bound the memory
+        with _readLock:
+            ih = emlib.image.ImageHandler()
+            ih.convert(inputFn, outputFn, emlib.DT_FLOAT)
+        if voxelSize:
+            import mrcfile
+            with mrcfile.open(outputFn, mode="r+", header_only=True) as mrc:
+                mrc.voxel_size = voxelSize
     else:
-        ih.convert(inputFn, outputFn, emlib.DT_FLOAT)
+        writeMrcSlabs(data, outputFn, voxelSize=voxelSize)
+
+
+def writeMrcSlabs(data, outputFn, slabBytes=CONVERT_SLAB_BYTES,
+                  voxelSize=None):
+    """ Write a (z, y, x) array (e.g. a memory map of the input)
+    to a float32 mrc, slab by slab. """
+    import mrcfile
+    nz, ny, nx = data.shape
+    slab = max(1, slabBytes // (ny * nx * 4))
+    dmin, dmax, total = np.inf, -np.inf, 0.
+    tmpFn = outputFn + ".part.mrc"
+
+    with mrcfile.new_mmap(tmpFn, shape=data.shape, mrc_mode=2,
+                          overwrite=True) as mrc:
+        for z in range(0, nz, slab):
+            values = np.asarray(data[z:z + slab], dtype=np.float32)
+            mrc.data[z:z + slab] = values
+            dmin = min(dmin, values.min())
+            dmax = max(dmax, values.max())
+            total += values.sum(dtype=np.float64)
+        mrc.header.dmin = dmin
+        mrc.header.dmax = dmax
+        mrc.header.dmean = total / data.size
+        if voxelSize:
+            mrc.voxel_size = voxelSize
+    os.replace(tmpFn, outputFn)
+
+
+def _mapVolume(fn):
+    """ Memory map of the voxels of a SPIDER or EM volume,
+    or None for other formats. """
+    ext = pwutils.getExt(fn).lower()
+    if ext in SPIDER_EXTENSIONS:
+        return _mapSpider(fn)
+    elif ext == ".em":
+        return _mapEm(fn)
+    return None
+
+
+def _mapSpider(fn):
+    """ SPIDER (and Xmipp .vol) header: float words with nz, ny, iform,
+    nx and the header size (labbyt). Stacks are not mapped. """
+    with open(fn, "rb") as f:
+        header = f.read(256 * 4)
+    for byteOrder in "<>":
+        words = np.frombuffer(header, dtype=f"{byteOrder}f4")
+        nz, ny, iform, nx = words[0], words[1], words[4], words[11]
+        labbyt, istack = words[21], words[23]
+        if iform in (1, 3) and nx > 0 and ny > 0 and 0 < labbyt < 2 ** 24:
+            if istack > 0:
+                return None
+            return np.memmap(fn, dtype=f"{byteOrder}f4", mode="r",
+                             offset=int(labbyt),
+                             shape=(max(1, int(nz)), int(ny), int(nx)))
+    return None
+
+
+def _mapEm(fn):
+    """ EM header: machine code (6 = little endian), data type
+    and the x, y, z dimensions, followed by the voxels at 512 bytes. """
+    with open(fn, "rb") as f:
+        header = f.read(EM_HEADER_BYTES)
+    byteOrder = "<" if header[0] == 6 else ">"
+    dtype = EM_DTYPES.get(header[3])
+    if dtype is None:
+        return None
+    nx, ny, nz = np.frombuffer(header, dtype=f"{byteOrder}i4", count=3, offset=4)
+    return np.memmap(fn, dtype=np.dtype(dtype).newbyteorder(byteOrder), mode="r",
+                     offset=EM_HEADER_BYTES, shape=(int(nz), int(ny), int(nx)))
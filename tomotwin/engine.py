@@ -0,0 +1,692 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+from .convert import readTable, writeTable
+from .heatmaps import HeatmapWriter, HEATMAPS_FILE
+
+MAP_CHUNK_SIZE = 200000
+
+
+def getEmbeddingColumns(table):
+    """ Embedding vector columns of a .temb table, named 0..N-1. """
+    return [c for c in table.columns if str(c).isdigit()]
+
+
+def normalizeRows(vectors):
+    """ L2-normalize the rows of a 2D array. """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def computeDistanceMap(refs, embeddings, chunkSize=MAP_CHUNK_SIZE,
+                       numThreads=1):
+    """ Cosine similarity of each reference against each embedding.
+    Embeddings are normalized and multiplied chunk by chunk, so the
+    extra memory is bounded by chunkSize rows per thread.
+    Return a float32 array of shape (numRefs, numEmbeddings). """
+    refs = normalizeRows(refs)
+    embeddings = np.asarray(embeddings)
+    numRows = len(embeddings)
+    result = np.empty((len(refs), numRows), dtype=np.float32)
+
+    def _mapChunk(start):
+        end = min(start + chunkSize, numRows)
+        result[:, start:end] = refs @ normalizeRows(embeddings[start:end]).T
+
+    chunks = range(0, numRows, chunkSize)
+    if numThreads > 1:
+        with ThreadPoolExecutor(max_workers=numThreads) as executor:
+            list(executor.map(_mapChunk, chunks))
+    else:
+        for start in chunks:
+            _mapChunk(start)
+
+    return result
+
+
+def mapEmbeddings(refsFn, embeddingsFn, outputFn, chunkSize=MAP_CHUNK_SIZE,
+                  numThreads=1):
+    """ Replacement of "tomotwin_map.py distance": write a map (.tmap)
+    with the similarity of each reference (d0..dN columns) for each
+    position of the tomogram embedding. """
+    refs = readTable(refsFn)
+    volume = readTable(embeddingsFn)
+    distances = computeDistanceMap(refs[getEmbeddingColumns(refs)].to_numpy(),
+                                   volume[getEmbeddingColumns(volume)].to_numpy(),
+                                   chunkSize=chunkSize, numThreads=numThreads)
+
+    result = volume[["X", "Y", "Z"]].copy()
+    for i, dist in enumerate(distances):
+        result[f"d{i}"] = dist
+    result.attrs.update(volume.attrs)
+    result.attrs["references"] = refs["filepath"].tolist()
+    writeTable(result, outputFn)
+    return result
+
+
+# 26-connected neighbourhood
+NEIGHBOURS = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+              for dz in (-1, 0, 1) if (dx, dy, dz) != (0, 0, 0)]
+NMS_IOU_THRESHOLD = 0.6
+
+
+def mapToVolumes(table):
+    """ Arrange the map positions on their stride grid. Return the grid
+    indexes (N, 3) in xyz order, the grid origin, stride and shape. """
+    coords = table[["X", "Y", "Z"]].to_numpy()
+    stride = np.broadcast_to(table.attrs.get("stride", 2), (3,)).astype(int)
+    origin = coords.min(axis=0)
+    indexes = np.rint((coords - origin) / stride).astype(int)
+    shape = tuple(indexes.max(axis=0) + 1)
+    return indexes, origin, stride, shape
+
+
+def getVolume(values, indexes, shape):
+    """ Fill a xyz volume with map values, missing
+    (e.g. masked) positions are set to -inf. """
+    volume = np.full(shape, -np.inf, dtype=np.float32)
+    volume[tuple(indexes.T)] = values
+    return volume
+
+
+def localMaxima(volume):
+    """ Boolean mask of voxels not lower than any of their 26 neighbours. """
+    padded = np.pad(volume, 1, constant_values=-np.inf)
+    sx, sy, sz = volume.shape
+    neighbourMax = np.full(volume.shape, -np.inf, dtype=volume.dtype)
+    for dx, dy, dz in NEIGHBOURS:
+        np.maximum(neighbourMax,
+                   padded[1 + dx:1 + dx + sx, 1 + dy:1 + dy + sy, 1 + dz:1 + dz + sz],
+                   out=neighbourMax)
+    return volume >= neighbourMax
+
+
+def _shiftSlices(shape, offset):
+    """ Slices of the voxels and of their neighbours at offset. """
+    src, dst = [], []
+    for d, n in zip(offset, shape):
+        src.append(slice(max(0, -d), n - max(0, d)))
+        dst.append(slice(max(0, d), n - max(0, -d)))
+    return tuple(src), tuple(dst)
+
+
+def labelBasins(volume, mask):
+    """ Label the voxels of mask with the local maximum reached by the
+    steepest ascent (watershed basins). Each voxel points to its highest
+    neighbour and the pointers are followed by vectorized jumping.
+    Mask must contain all the voxels above its own voxels, e.g. a
+    threshold. Return the flat index of the maximum of each basin and
+    the label volume (-1 outside the mask). """
+    index = np.full(volume.shape, -1, dtype=np.intp)
+    index[mask] = np.arange(np.count_nonzero(mask))
+    best = volume.copy()
+    target = index.copy()
+    for offset in NEIGHBOURS:
+        src, dst = _shiftSlices(volume.shape, offset)
+        higher = volume[dst] > best[src]
+        np.copyto(best[src], volume[dst], where=higher)
+        np.copyto(target[src], index[dst], where=higher)
+
+    parent = target[mask]
+    while True:
+        jumped = parent[parent]
+        if np.array_equal(jumped, parent):
+            break
+        parent = jumped
+
+    roots, basins = np.unique(parent, return_inverse=True)
+    labels = np.full(volume.shape, -1, dtype=np.intp)
+    labels[mask] = basins
+    return np.flatnonzero(mask)[roots], labels
+
+
+def basinSaddles(volume, labels):
+    """ Pass level between adjacent basins: the highest of the lower
+    values of two neighbouring voxels in different basins. Return the
+    basin pairs (N, 2) and their levels, from the highest level. """
+    import pandas as pd
+
+    numBasins = labels.max() + 1
+    keys, levels = [], []
+    for offset in [n for n in NEIGHBOURS if n > (0, 0, 0)]:
+        src, dst = _shiftSlices(volume.shape, offset)
+        a, b = labels[src], labels[dst]
+        border = (a >= 0) & (b >= 0) & (a != b)
+        a, b = a[border], b[border]
+        keys.append(np.minimum(a, b) * numBasins + np.maximum(a, b))
+        levels.append(np.minimum(volume[src], volume[dst])[border])
+
+    saddles = pd.Series(np.concatenate(levels)).groupby(
+        np.concatenate(keys), sort=False).max()
+    keys, levels = saddles.index.to_numpy(), saddles.to_numpy()
+    order = np.argsort(-levels, kind="stable")
+    pairs = np.stack([keys[order] // numBasins, keys[order] % numBasins], axis=1)
+    return pairs, levels[order]
+
+
+def findPeaks(volume, tolerance, globalMin):
+    """ Find maxima above globalMin that stand out from the surrounding
+    by more than tolerance: taken in decreasing order, the region of
+    voxels within tolerance around a maximum must not reach a higher
+    voxel or the region of an accepted peak. Basins are labelled once
+    and merged from the highest saddle (union-find), a maximum is
+    rejected when its basin joins a better one above its tolerance
+    level. Return grid indexes, values and region sizes. """
+    mask = volume >= globalMin - tolerance
+    if not mask.any():
+        return (np.empty((0, 3), dtype=int), np.empty(0, dtype=np.float32),
+                np.empty(0, dtype=int))
+    maxima, labels = labelBasins(volume, mask)
+    values = volume.ravel()[maxima]
+    levels = values - tolerance
+    # same order as flooding the maxima by decreasing value
+    rank = np.empty(len(maxima), dtype=int)
+    rank[np.lexsort((maxima, -values))] = np.arange(len(maxima))
+
+    parent = list(range(len(maxima)))
+    members = [[i] for i in range(len(maxima))]
+    bestOf = list(range(len(maxima)))
+    regions = {}
+    rejected = values < globalMin
+
+    def _find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def _close(root, level):
+        # basins merged below the tolerance level of the best
+        # maximum do not belong to its region any more
+        peak = bestOf[root]
+        if peak not in regions and level < levels[peak]:
+            regions[peak] = list(members[root])
+
+    pairs, saddles = basinSaddles(volume, labels)
+    for (a, b), level in zip(pairs.tolist(), saddles.tolist()):
+        a, b = _find(a), _find(b)
+        if a == b:
+            continue
+        _close(a, level)
+        _close(b, level)
+        if rank[bestOf[a]] > rank[bestOf[b]]:
+            a, b = b, a
+        if bestOf[b] not in regions:
+            rejected[bestOf[b]] = True
+        if len(members[a]) < len(members[b]):
+            members[a], members[b] = members[b], members[a]
+        members[a].extend(members[b])
+        members[b] = []
+        parent[b] = a
+
+    for root in set(_find(i) for i in range(len(maxima))):
+        _close(root, -np.inf)
+
+    peaks = np.array([i for i in np.argsort(rank) if not rejected[i]], dtype=int)
+    owner = np.full(len(maxima), -1, dtype=int)
+    for i, peak in enumerate(peaks):
+        owner[regions[peak]] = i
+    voxelOwner = owner[labels[mask]]
+    inside = (voxelOwner >= 0) & (volume[mask] >= levels[peaks][voxelOwner])
+    sizes = np.bincount(voxelOwner[inside], minlength=len(peaks))
+
+    return (np.array(np.unravel_index(maxima[peaks], volume.shape)).T.reshape(-1, 3),
+            values[peaks].astype(np.float32), sizes)
+
+
+def boxOverlap(a, b, boxSize):
+    """ Intersection over union of two cubic boxes centered at a and b. """
+    inter = np.prod(np.clip(boxSize - np.abs(np.asarray(a) - b), 0, None))
+    return inter / (2 * boxSize ** 3 - inter)
+
+
+def nonMaxSuppression(coords, metric, boxSize, threshold=NMS_IOU_THRESHOLD):
+    """ Keep the best scoring boxes, dropping those that overlap a kept
+    box by more than threshold. Kept boxes are hashed in a grid of
+    boxSize cells, so each box is only compared to its 27 neighbouring
+    cells. Return indexes of the kept boxes. """
+    cells = {}
+    keep = []
+    for i in np.argsort(-np.asarray(metric), kind="stable"):
+        cell = tuple((coords[i] // boxSize).astype(int))
+        overlaps = False
+        for dx, dy, dz in NEIGHBOURS + [(0, 0, 0)]:
+            for j in cells.get((cell[0] + dx, cell[1] + dy, cell[2] + dz), []):
+                if boxOverlap(coords[i], coords[j], boxSize) > threshold:
+                    overlaps = True
+                    break
+            if overlaps:
+                break
+        if not overlaps:
+            keep.append(i)
+            cells.setdefault(cell, []).append(i)
+    return np.array(keep, dtype=int)
+
+
+def mapBounded(executor, func, items, window):
+    """ Like executor.map, but at most window items are submitted at a
+    time, so a generator of large items is not consumed all at once.
+    Return the results in order. """
+    results, pending = [], deque()
+    for item in items:
+        if len(pending) >= window:
+            results.append(pending.popleft().result())
+        pending.append(executor.submit(func, item))
+    results.extend(future.result() for future in pending)
+    return results
+
+
+def locateParticles(mapFn, outputDir, tolerance, boxSize, globalMin,
+                    numProcesses=1, writeHeatmaps=False, heatmapDtype=None,
+                    heatmapBinning=1):
+    """ Experimental alternative to "tomotwin_locate.py findmax": find
+    the peaks of each reference similarity volume (references are
+    distributed over a process pool, one volume per process at a time),
+    apply the non-maximum suppression per reference and write
+    outputDir/located.tloc. Coordinates are in the map units.
+    With heatmapDtype (float16 or uint8), heatmaps are written to a
+    compact store instead of one mrc volume per reference. """
+    import pandas as pd
+
+    table = readTable(mapFn)
+    refColumns = [c for c in table.columns if str(c).startswith("d")]
+    references = table.attrs.get("references", [])
+    indexes, origin, stride, shape = mapToVolumes(table)
+
+    def _volumes():
+        for column in refColumns:
+            yield getVolume(table[column].to_numpy(), indexes, shape)
+
+    if numProcesses > 1:
+        # spawned workers, forking from the protocol step threads may deadlock
+        context = multiprocessing.get_context("spawn")
+        func = partial(findPeaks, tolerance=tolerance, globalMin=globalMin)
+        with ProcessPoolExecutor(max_workers=numProcesses,
+                                 mp_context=context) as executor:
+            results = mapBounded(executor, func, _volumes(), numProcesses)
+    else:
+        results = [findPeaks(v, tolerance, globalMin) for v in _volumes()]
+
+    located = []
+    for classId, (peaks, values, sizes) in enumerate(results):
+        coords = peaks * stride + origin
+        keep = nonMaxSuppression(coords, values, boxSize)
+        classTable = pd.DataFrame(coords[keep], columns=["X", "Y", "Z"])
+        classTable["predicted_class"] = classId
+        classTable["metric"] = values[keep]
+        classTable["size"] = sizes[keep]
+        located.append(classTable)
+
+    located = pd.concat(located, ignore_index=True) if located else pd.DataFrame(
+        columns=["X", "Y", "Z", "predicted_class", "metric", "size"])
+    for dim in ["width", "height", "depth"]:
+        located[dim] = boxSize
+    located.attrs.update(table.attrs)
+    located.attrs["references"] = list(references)
+    writeTable(located, os.path.join(outputDir, "located.tloc"))
+
+    if writeHeatmaps and heatmapDtype:
+        writeHeatmapStore(table, refColumns, references, indexes, origin,
+                          stride, shape, os.path.join(outputDir, HEATMAPS_FILE),
+                          heatmapDtype, heatmapBinning)
+    elif writeHeatmaps:
+        writeHeatmapVolumes(table, refColumns, references, indexes, shape,
+                            outputDir)
+
+    return located
+
+
+def writeHeatmapVolumes(table, refColumns, references, indexes, shape,
+                        outputDir):
+    """ Write one similarity volume per reference on the map grid. """
+    import mrcfile
+    for column, name in zip(refColumns, _getHeatmapNames(refColumns, references)):
+        volume = getVolume(table[column].to_numpy(), indexes, shape)
+        volume[np.isinf(volume)] = 0
+        with mrcfile.new(os.path.join(outputDir, f"{name}.mrc"),
+                         overwrite=True) as mrc:
+            mrc.set_data(np.ascontiguousarray(volume.transpose(2, 1, 0)))
+
+
+def _getHeatmapNames(refColumns, references):
+    return [os.path.splitext(os.path.basename(str(references[i])))[0]
+            if i < len(references) else column
+            for i, column in enumerate(refColumns)]
+
+
+def writeHeatmapStore(table, refColumns, references, indexes, origin, stride,
+                      shape, outputFn, dtype, binning=1):
+    """ Write the similarity volumes of all the references to a compact
+    heatmap store, one z slab at a time. Missing positions are 0. """
+    order = np.argsort(indexes[:, 2], kind="stable")
+    zIndexes = indexes[order, 2]
+    sx, sy, sz = shape
+    with HeatmapWriter(outputFn, (sz, sy, sx), dtype, binning,
+                       origin, stride) as writer:
+        def _slabs(values):
+            for zStart, zEnd in writer.getInputSlabs():
+                rows = order[np.searchsorted(zIndexes, zStart):
+                             np.searchsorted(zIndexes, zEnd)]
+                slab = np.zeros((zEnd - zStart, sy, sx), dtype=np.float32)
+                x, y, z = indexes[rows].T
+                slab[z - zStart, y, x] = values[rows]
+                yield slab
+
+        for column, name in zip(refColumns, _getHeatmapNames(refColumns, references)):
+            writer.writeReference(name, _slabs(table[column].to_numpy()))
+
+
+SLAB_THRESHOLD = 0.2
+SLAB_SMOOTH = 5
+
+
+def sliceProfile(volumeFn, step=2):
+    """ Mean and variance of each z slice of a MRC volume. The file is
+    memory-mapped and read one (xy subsampled) slice at a time. """
+    import mrcfile
+    with mrcfile.mmap(volumeFn, mode="r", permissive=True) as mrc:
+        data = mrc.data
+        means = np.empty(data.shape[0], dtype=np.float64)
+        variances = np.empty(data.shape[0], dtype=np.float64)
+        for z in range(data.shape[0]):
+            values = np.asarray(data[z, ::step, ::step], dtype=np.float32)
+            means[z] = values.mean()
+            variances[z] = values.var()
+    return means, variances
+
+
+def detectSlab(variances, margin, threshold=SLAB_THRESHOLD,
+               smooth=SLAB_SMOOTH):
+    """ Find the specimen slab from the slice variance profile: the
+    slices above baseline + threshold * (peak - baseline), where the
+    baseline is the empty ice level. The slab is the widest run of
+    such slices, extended by margin on both sides. Return zMin and
+    zMax (inclusive), or None if there is no clear slab. """
+    depth = len(variances)
+    # median filter: removes single noisy slices, keeps the slab edges
+    padded = np.pad(np.asarray(variances, dtype=np.float64), smooth // 2, mode="edge")
+    profile = np.median(np.lib.stride_tricks.sliding_window_view(padded, smooth),
+                        axis=1)
+    baseline, peak = np.percentile(profile, [10, 99])
+    if peak <= baseline:
+        return None
+
+    above = profile > baseline + threshold * (peak - baseline)
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], above.astype(int), [0]])))
+    if not len(edges):
+        return None
+    runs = edges.reshape(-1, 2)
+    start, end = runs[np.argmax(runs[:, 1] - runs[:, 0])]
+    return int(max(0, start - margin)), int(min(depth - 1, end - 1 + margin))
+
+
+def writeWindowsMask(coords, shape, margin, outputFn, maskFn=None):
+    """ Write an int8 mrc mask of shape (z, y, x) that is 1 in cubes of
+    half-size margin around each xyz coordinate and, if maskFn is
+    given, inside that mask too. Only the windows are written, so the
+    memory used does not depend on the tomogram size. Return the
+    fraction of voxels in the mask. """
+    import mrcfile
+    coords = np.rint(np.asarray(coords, dtype=np.float64).reshape(-1, 3)).astype(int)
+    maskData = None
+    if maskFn is not None:
+        maskData = mrcfile.mmap(maskFn, mode="r", permissive=True)
+    tmpFn = outputFn + ".part.mrc"
+
+    try:
+        with mrcfile.new_mmap(tmpFn, shape=tuple(shape), mrc_mode=0,
+                              overwrite=True) as mrc:
+            for x, y, z in coords:
+                window = tuple(slice(max(0, c - margin), min(n, c + margin + 1))
+                               for c, n in zip((z, y, x), shape))
+                values = 1
+                if maskData is not None:
+                    values = (np.asarray(maskData.data[window]) != 0).astype(np.int8)
+                    values |= np.asarray(mrc.data[window])
+                mrc.data[window] = values
+            count = sum(int(np.count_nonzero(mrc.data[z])) for z in range(shape[0]))
+            mrc.header.dmin, mrc.header.dmax = 0, 1
+            mrc.header.dmean = count / np.prod(shape)
+    finally:
+        if maskData is not None:
+            maskData.close()
+    os.replace(tmpFn, outputFn)
+    return count / np.prod(shape)
+
+
+def insideWindows(coords, centers, margin):
+    """ Boolean mask of the xyz coordinates inside the cubes of
+    half-size margin around the centers, as in writeWindowsMask. """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    centers = np.rint(np.asarray(centers, dtype=np.float64).reshape(-1, 3))
+    inside = np.zeros(len(coords), dtype=bool)
+    for center in centers:
+        inside |= np.all(np.abs(coords - center) <= margin, axis=1)
+    return inside
+
+
+def otsuThreshold(values, bins=256):
+    """ Threshold that best separates the values in two classes. """
+    values = np.asarray(values, dtype=np.float64)
+    counts, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weights = np.cumsum(counts)
+    means = np.cumsum(counts * centers)
+    total, totalMean = weights[-1], means[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (totalMean * weights - means * total) ** 2 / (
+                weights * (total - weights))
+    return float(centers[np.nanargmax(between[:-1])])
+
+
+def medianEmbeddingMask(embeddingsFn, outputFn, shape, embeddedShape=None,
+                        threshold=None, numThreads=1):
+    """ Mask of the positions not similar to the median embedding of a
+    tomogram, i.e. likely not empty ice or background, computed from an
+    existing embedding table instead of embedding the tomogram again.
+    Positions with a cosine similarity to the median below threshold
+    (Otsu's threshold by default) are kept. Each voxel of the int8 mrc
+    of shape (z, y, x) takes the value of the nearest embedded position.
+    embeddedShape (z, y, x) is the shape of the embedded tomogram, if it
+    was rescaled. Return the threshold and the fraction of voxels kept. """
+    import mrcfile
+    table = readTable(embeddingsFn)
+    vectors = table[getEmbeddingColumns(table)].to_numpy()
+    median = np.median(vectors, axis=0)
+    similarity = computeDistanceMap(median[None], vectors,
+                                    numThreads=numThreads)[0]
+    if threshold is None:
+        threshold = otsuThreshold(similarity)
+
+    indexes, origin, stride, gridShape = mapToVolumes(table)
+    grid = getVolume((similarity < threshold).astype(np.float32), indexes,
+                     gridShape) > 0
+    grid = grid.transpose(2, 1, 0)  # zyx
+
+    # nearest grid index of each output voxel, -1 outside the grid
+    scale = np.ones(3) if embeddedShape is None else (
+            np.asarray(embeddedShape, dtype=np.float64) / shape)
+    axes = []
+    for n, s, o, st, g in zip(shape, scale, origin[::-1], stride[::-1], gridShape[::-1]):
+        index = np.floor((np.arange(n) * s - o) / st + 0.5).astype(int)
+        index[(index < 0) | (index >= g)] = -1
+        axes.append(index)
+    zIndex, yIndex, xIndex = axes
+    validY, validX = yIndex >= 0, xIndex >= 0
+    rows = np.ix_(yIndex[validY], xIndex[validX])
+    count = 0
+
+    tmpFn = outputFn + ".part.mrc"
+    with mrcfile.new_mmap(tmpFn, shape=tuple(shape), mrc_mode=0,
+                          overwrite=True) as mrc:
+        for z, gz in enumerate(zIndex):
+            if gz < 0:
+                continue
+            values = np.zeros(shape[1:], dtype=np.int8)
+            values[np.ix_(validY, validX)] = grid[gz][rows]
+            mrc.data[z] = values
+            count += int(np.count_nonzero(values))
+        mrc.header.dmin, mrc.header.dmax = 0, 1
+        mrc.header.dmean = count / np.prod(shape)
+    os.replace(tmpFn, outputFn)
+    return threshold, count / np.prod(shape)
+
+
+MAX_CLUSTERS = 10
+CLUSTER_SAMPLE_SIZE = 2000
+
+
+def kMeans(points, k, iterations=100, seed=0):
+    """ Lloyd's k-means with k-means++ seeding.
+    Return the labels and the centers. """
+    points = np.asarray(points, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    centers = [points[rng.integers(len(points))]]
+    for _ in range(1, k):
+        dist = np.min([np.sum((points - c) ** 2, axis=1) for c in centers], axis=0)
+        if not dist.sum():
+            break
+        centers.append(points[rng.choice(len(points), p=dist / dist.sum())])
+    centers = np.array(centers)
+
+    labels = None
+    for _ in range(iterations):
+        dist = ((points[:, None, :] - centers[None]) ** 2).sum(axis=2)
+        newLabels = dist.argmin(axis=1)
+        if labels is not None and np.array_equal(newLabels, labels):
+            break
+        labels = newLabels
+        for i in range(len(centers)):
+            if np.any(labels == i):
+                centers[i] = points[labels == i].mean(axis=0)
+    return labels, centers
+
+
+def silhouetteScore(points, labels, chunkSize=1000):
+    """ Mean silhouette coefficient of a clustering. Distances
+    are computed for chunkSize points at a time. """
+    points = np.asarray(points, dtype=np.float64)
+    clusters, own = np.unique(labels, return_inverse=True)
+    if len(clusters) < 2:
+        return -1.
+    oneHot = np.eye(len(clusters))[own]
+    sizes = oneHot.sum(axis=0)
+    norms = (points ** 2).sum(axis=1)
+    scores = []
+    for start in range(0, len(points), chunkSize):
+        chunk = slice(start, start + chunkSize)
+        dist = np.sqrt(np.maximum(norms[chunk, None] + norms[None] -
+                                  2 * points[chunk] @ points.T, 0))
+        sums = dist @ oneHot
+        rows, ownChunk = np.arange(len(sums)), own[chunk]
+        # the distance to itself is not counted
+        a = sums[rows, ownChunk] / np.maximum(sizes[ownChunk] - 1, 1)
+        means = sums / sizes
+        means[rows, ownChunk] = np.inf
+        b = means.min(axis=1)
+        score = (b - a) / np.maximum(np.maximum(a, b), 1e-12)
+        score[sizes[ownChunk] == 1] = 0
+        scores.append(score)
+    return float(np.concatenate(scores).mean())
+
+
+def autoKMeans(points, maxClusters=MAX_CLUSTERS,
+               sampleSize=CLUSTER_SAMPLE_SIZE, seed=0):
+    """ k-means where k (2 to maxClusters) is the one with the best
+    silhouette on a random sample of the points. Return the
+    labels and centers of all the points. """
+    points = np.asarray(points, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    sample = points[rng.choice(len(points), min(sampleSize, len(points)),
+                               replace=False)]
+    best, bestScore = 2, -np.inf
+    for k in range(2, min(maxClusters, len(sample) - 1) + 1):
+        labels, _ = kMeans(sample, k, seed=seed)
+        score = silhouetteScore(sample, labels)
+        if score > bestScore:
+            best, bestScore = k, score
+    _, centers = kMeans(sample, best, seed=seed)
+    return nearestCenter(points, centers), centers
+
+
+def nearestCenter(points, centers, chunkSize=MAP_CHUNK_SIZE):
+    """ Index of the nearest center of each point, in chunks. """
+    labels = np.empty(len(points), dtype=int)
+    for start in range(0, len(points), chunkSize):
+        chunk = points[start:start + chunkSize]
+        dist = ((chunk[:, None, :] - centers[None]) ** 2).sum(axis=2)
+        labels[start:start + chunkSize] = dist.argmin(axis=1)
+    return labels
+
+
+def getUmapColumns(table):
+    columns = [c for c in table.columns if str(c).startswith("umap_")]
+    return columns or list(table.columns[:2])
+
+
+def writeClusterTargets(umapFn, embeddingsFn, outputFn,
+                        maxClusters=MAX_CLUSTERS, minSize=0):
+    """ Replacement of the interactive cluster selection in Napari:
+    cluster the UMAP of a tomogram, which has a row for each row of
+    its embeddings, and write the mean embedding of each cluster as
+    a target (cluster_targets.temb). The largest cluster is taken as
+    the background and clusters smaller than minSize are skipped.
+    Return the sizes of the written clusters. """
+    import pandas as pd
+    umap = readTable(umapFn)
+    embeddings = readTable(embeddingsFn)
+    if len(umap) != len(embeddings):
+        raise ValueError(f"{umapFn} has {len(umap)} rows, but "
+                         f"{embeddingsFn} has {len(embeddings)}")
+
+    labels, _ = autoKMeans(umap[getUmapColumns(umap)].to_numpy(), maxClusters)
+    sizes = np.bincount(labels)
+    background = sizes.argmax()
+    columns = getEmbeddingColumns(embeddings)
+    vectors = embeddings[columns].to_numpy()
+
+    targets, names, targetSizes = [], [], []
+    for label in np.argsort(-sizes):
+        if label == background or sizes[label] < max(1, minSize):
+            continue
+        targets.append(vectors[labels == label].mean(axis=0))
+        names.append(f"cluster_{len(names)}")
+        targetSizes.append(int(sizes[label]))
+
+    table = pd.DataFrame(np.array(targets, dtype=np.float32).reshape(-1, len(columns)),
+                         columns=columns)
+    table.insert(0, "filepath", names)
+    writeTable(table, outputFn)
+    return targetSizes
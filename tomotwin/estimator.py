@@ -0,0 +1,147 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+
+import numpy as np
+
+EMBED_BOX = 37
+EMBEDDING_DIM = 32
+ROW_BYTES = 3 * 8 + EMBEDDING_DIM * 4  # X, Y, Z and the embedding vector
+MASK_STRIDE = 4
+UMAP_RAM_FACTOR = 20  # UMAP memory relative to the fitted sample
+UMAP_ROW_BYTES = EMBEDDING_DIM * 4 * UMAP_RAM_FACTOR
+MAP_COPIES = 3  # float32 distances per reference held while mapping
+
+# Default speed of each kind of job, in units per second:
+# subvolumes for embed, umap and mask, subvolumes x references for picking
+DEFAULT_RATES = {
+    "embed": 3000.,
+    "picking": 5e7,
+    "umap": 2e5,
+    "mask": 3000.
+}
+
+
+def countSubvolumes(dims, stride, zRange=None, coverage=1., box=EMBED_BOX):
+    """ Number of box positions of a sliding window over a tomogram
+    of dims (x, y, z), restricted to zRange and to the masked fraction. """
+    x, y, z = dims
+    if zRange is not None:
+        z = zRange[1] - zRange[0] + 1
+    count = 1
+    for size in (x, y, z):
+        count *= max(1, (size - box) // stride + 1)
+    return int(count * coverage)
+
+
+def maskCoverage(maskFn, step=4):
+    """ Fraction of non-zero voxels of a mask, from a subsampled
+    memory-mapped read. """
+    import mrcfile
+    with mrcfile.mmap(maskFn, mode="r", permissive=True) as mrc:
+        return float(np.count_nonzero(mrc.data[::step, ::step, ::step]) /
+                     mrc.data[::step, ::step, ::step].size)
+
+
+def mapFootprint(subvolumes, numRefs):
+    """ Memory to map and locate a tomogram with this many subvolumes. """
+    return subvolumes * (ROW_BYTES + numRefs * 4 * MAP_COPIES)
+
+
+def measureMapFootprint(embeddingsFn, mapFn):
+    """ Memory used to map and locate a tomogram, from the size
+    of the embeddings and map tables it loaded. """
+    return os.path.getsize(embeddingsFn) + MAP_COPIES * os.path.getsize(mapFn)
+
+
+def umapFootprint(rows, sampleSize):
+    """ Memory of the UMAP of a tomogram with rows embeddings. """
+    return rows * ROW_BYTES + min(sampleSize, rows) * UMAP_ROW_BYTES
+
+
+def estimateCost(subvolumes, stages, numRefs=0, umapSample=0, numGpus=1,
+                 numWorkers=1, rates=None):
+    """ Predict the cost of embedding and processing tomograms with the
+    given number of subvolumes each. Stages are the kinds of jobs run
+    per tomogram: GPU jobs ("embed", "umap", "mask") share numGpus and
+    "picking" runs on numWorkers CPU steps overlapped with embedding.
+    Return a dict with the total subvolumes, embedding size on disk,
+    peak RAM of map and UMAP, seconds per stage and wall time. """
+    rates = dict(DEFAULT_RATES, **(rates or {}))
+    total = sum(subvolumes)
+    largest = max(subvolumes, default=0)
+    seconds = {}
+    for stage in stages:
+        units = total * numRefs if stage == "picking" else total
+        seconds[stage] = units / rates[stage]
+
+    gpuTime = sum(t for s, t in seconds.items() if s != "picking") / max(1, numGpus)
+    cpuTime = seconds.get("picking", 0) / max(1, numWorkers)
+    # picking overlaps with embedding, except for the last tomogram
+    tail = seconds.get("picking", 0) / max(1, len(subvolumes))
+
+    return {
+        "subvolumes": total,
+        "diskBytes": total * ROW_BYTES,
+        "mapRam": (mapFootprint(largest, numRefs)
+                   if "picking" in stages else 0),
+        "umapRam": (umapFootprint(largest, umapSample)
+                    if "umap" in stages else 0),
+        "seconds": seconds,
+        "wall": max(gpuTime, cpuTime) + tail
+    }
+
+
+def _prettySize(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def _prettyTime(seconds):
+    hours, seconds = divmod(int(seconds), 3600)
+    return f"{hours}h {seconds // 60:02d}m"
+
+
+def formatCost(cost):
+    lines = [
+        f"Subvolumes to embed: {cost['subvolumes']:,}",
+        f"Embeddings on disk: {_prettySize(cost['diskBytes'])}"
+    ]
+    if cost["mapRam"]:
+        lines.append(f"RAM for the map of the largest tomogram: "
+                     f"{_prettySize(cost['mapRam'])}")
+    if cost["umapRam"]:
+        lines.append(f"RAM for the UMAP of the largest tomogram: "
+                     f"{_prettySize(cost['umapRam'])}")
+    lines.append("Time per stage: " + ", ".join(
+        f"{stage} {_prettyTime(t)}" for stage, t in cost["seconds"].items()))
+    lines.append(f"Estimated wall time: {_prettyTime(cost['wall'])}")
+    return lines
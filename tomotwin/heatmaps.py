@@ -0,0 +1,275 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+""" Compact heatmap store: the similarity volumes of all the references
+of a tomogram in a single zip file.
+
+Volumes (z, y, x) are cut in slabs of z slices, optionally binned
+(maximum of each block, so peaks are kept), stored as float16 or
+uint8 and compressed one by one. Slabs are written and read one at a
+time, so a whole heatmap is never held in memory. The script also runs
+in the Napari environment, where only numpy is required:
+
+    python heatmaps.py view heatmaps.zip --tomo tomo.mrc
+    python heatmaps.py export -i heatmaps.zip -r ref_1 -o ref_1.mrc
+"""
+
+import io
+import os
+import sys
+import json
+import zipfile
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+HEATMAPS_FILE = "heatmaps.zip"
+HEATMAP_DTYPES = ["float16", "uint8"]
+CHUNK_SLICES = 16
+CACHE_CHUNKS = 4
+COMPRESS_LEVEL = 1  # fast, most of the gain is from the smaller types
+INDEX_NAME = "index.json"
+
+
+def getHeatmapsScript():
+    return os.path.abspath(__file__)
+
+
+def quantize(values, dtype):
+    """ Similarities in [-1, 1] as float16 or uint8. """
+    if dtype == "uint8":
+        return np.rint((np.clip(values, -1, 1) + 1) * 127.5).astype(np.uint8)
+    return values.astype(np.float16)
+
+
+def dequantize(data):
+    if data.dtype == np.uint8:
+        return data.astype(np.float32) / 127.5 - 1
+    return data.astype(np.float32)
+
+
+def binSlab(slab, binning):
+    """ Maximum of each binning^3 block of a (z, y, x) slab. """
+    if binning == 1:
+        return slab
+    pad = [(0, -n % binning) for n in slab.shape]
+    slab = np.pad(slab, pad, constant_values=-np.inf)
+    z, y, x = (n // binning for n in slab.shape)
+    return slab.reshape(z, binning, y, binning, x, binning).max(axis=(1, 3, 5))
+
+
+class HeatmapWriter:
+    """ Write the heatmaps of a tomogram slab by slab. The shape (z, y, x)
+    is the one of the input volumes, before binning. Origin and stride
+    (x, y, z) place the voxels in tomogram pixels. """
+    def __init__(self, path, shape, dtype="float16", binning=1,
+                 origin=(0, 0, 0), stride=(1, 1, 1), chunkSlices=CHUNK_SLICES):
+        if dtype not in HEATMAP_DTYPES:
+            raise ValueError(f"Unsupported heatmap type: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.binning = max(1, int(binning))
+        self.chunkSlices = chunkSlices
+        self.inputShape = tuple(int(n) for n in shape)
+        self.index = {
+            "shape": [-(-n // self.binning) for n in self.inputShape],
+            "dtype": dtype,
+            "binning": self.binning,
+            "chunkSlices": chunkSlices,
+            "origin": [float(v) for v in origin],
+            "stride": [float(v) for v in stride],
+            "references": []
+        }
+        self._zip = zipfile.ZipFile(path + ".part", "w", zipfile.ZIP_DEFLATED,
+                                    compresslevel=COMPRESS_LEVEL)
+
+    def getInputSlabs(self):
+        """ Input z ranges of the slabs written for each reference. """
+        step = self.chunkSlices * self.binning
+        return [(z, min(z + step, self.inputShape[0]))
+                for z in range(0, self.inputShape[0], step)]
+
+    def writeReference(self, name, slabs):
+        """ Write the slabs (z, y, x float arrays over getInputSlabs)
+        of a reference. """
+        refIndex = len(self.index["references"])
+        for i, slab in enumerate(slabs):
+            data = quantize(binSlab(np.asarray(slab, dtype=np.float32),
+                                    self.binning), self.dtype)
+            buffer = io.BytesIO()
+            np.save(buffer, data)
+            self._zip.writestr(f"{refIndex}/{i}.npy", buffer.getvalue())
+        self.index["references"].append(str(name))
+
+    def close(self):
+        self._zip.writestr(INDEX_NAME, json.dumps(self.index, indent=2))
+        self._zip.close()
+        os.replace(self.path + ".part", self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self.close()
+        else:
+            self._zip.close()
+            os.remove(self.path + ".part")
+
+
+class HeatmapReader:
+    """ Open a heatmap store, volumes are only read when indexed. """
+    def __init__(self, path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        self.index = json.loads(self._zip.read(INDEX_NAME))
+        self.references = self.index["references"]
+        self.shape = tuple(self.index["shape"])
+        self._cache = OrderedDict()
+
+    def readChunk(self, refIndex, chunk):
+        """ Dequantized slab of a reference, the last ones are cached. """
+        key = (refIndex, chunk)
+        if key not in self._cache:
+            with self._zip.open(f"{refIndex}/{chunk}.npy") as f:
+                self._cache[key] = dequantize(np.load(io.BytesIO(f.read())))
+            if len(self._cache) > CACHE_CHUNKS:
+                self._cache.popitem(last=False)
+        self._cache.move_to_end(key)
+        return self._cache[key]
+
+    def getHeatmap(self, name):
+        return LazyHeatmap(self, self.references.index(name))
+
+    def getScale(self):
+        """ Voxel size (z, y, x) in tomogram pixels. """
+        return [s * self.index["binning"] for s in reversed(self.index["stride"])]
+
+    def getTranslate(self):
+        """ Position (z, y, x) of the first voxel in tomogram pixels,
+        the center of the first binned block. """
+        binning = self.index["binning"]
+        return [o + (binning - 1) * s / 2 for o, s in
+                zip(reversed(self.index["origin"]), reversed(self.index["stride"]))]
+
+    def close(self):
+        self._zip.close()
+
+
+class LazyHeatmap:
+    """ Array-like (z, y, x) heatmap of one reference that only reads
+    the slabs needed by each indexing, as Napari expects. """
+    dtype = np.dtype(np.float32)
+    ndim = 3
+
+    def __init__(self, reader, refIndex):
+        self.reader = reader
+        self.refIndex = refIndex
+        self.shape = reader.shape
+        self.chunkSlices = reader.index["chunkSlices"]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        first, rest = (key[0], key[1:]) if key else (slice(None), ())
+        if first is Ellipsis:
+            first, rest = slice(None), key
+        if isinstance(first, (int, np.integer)):
+            z = range(self.shape[0])[first]
+            chunk = self.reader.readChunk(self.refIndex, z // self.chunkSlices)
+            return chunk[z % self.chunkSlices][rest]
+
+        slices = range(self.shape[0])[first]
+        if not len(slices):
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+        chunks = sorted(set(z // self.chunkSlices for z in slices))
+        data = np.concatenate([self.reader.readChunk(self.refIndex, c)
+                               for c in range(chunks[0], chunks[-1] + 1)])
+        positions = np.asarray(slices) - chunks[0] * self.chunkSlices
+        return data[positions][(slice(None),) + rest]
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+
+def export(heatmapsFn, name, outputFn):
+    """ Write the heatmap of a reference as an mrc volume, slab by slab. """
+    import mrcfile
+    reader = HeatmapReader(heatmapsFn)
+    heatmap = reader.getHeatmap(name)
+    with mrcfile.new_mmap(outputFn, shape=heatmap.shape, mrc_mode=2,
+                          overwrite=True) as mrc:
+        for start in range(0, heatmap.shape[0], heatmap.chunkSlices):
+            end = min(start + heatmap.chunkSlices, heatmap.shape[0])
+            mrc.data[start:end] = heatmap[start:end]
+    reader.close()
+
+
+def view(heatmapsFn, tomoFn=None, references=None):
+    """ Show the heatmaps in Napari over the tomogram. """
+    import napari
+    viewer = napari.Viewer()
+    if tomoFn:
+        import mrcfile
+        viewer.add_image(mrcfile.mmap(tomoFn, mode="r", permissive=True).data,
+                         name=os.path.basename(tomoFn))
+    reader = HeatmapReader(heatmapsFn)
+    for name in references or reader.references:
+        # contrast limits are given, otherwise Napari reads the whole volume
+        viewer.add_image(reader.getHeatmap(name), name=name,
+                         scale=reader.getScale(),
+                         translate=reader.getTranslate(),
+                         contrast_limits=(0, 1), colormap="inferno",
+                         blending="additive", opacity=0.5, visible=False)
+    napari.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TomoTwin heatmaps")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    viewParser = subparsers.add_parser("view")
+    viewParser.add_argument("input")
+    viewParser.add_argument("--tomo")
+    viewParser.add_argument("-r", "--references", nargs="+")
+    exportParser = subparsers.add_parser("export")
+    exportParser.add_argument("-i", "--input", required=True)
+    exportParser.add_argument("-r", "--reference", required=True)
+    exportParser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+
+    if args.command == "view":
+        view(args.input, args.tomo, args.references)
+    else:
+        export(args.input, args.reference, args.output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,7 +25,12 @@
 # **************************************************************************
 
 import os
+import json
+import time
+import hashlib
+import threading
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 
 from pyworkflow import utils as pwutils
 import pyworkflow.protocol.params as params
@@ -37,7 +42,22 @@ from tomo.constants import BOTTOM_LEFT_CORNER
 
 from .. import Plugin
 from ..constants import TOMOTWIN_MODEL
-from ..convert import readSetOfCoordinates3D, convertToMrc
+from ..cache import getStagingCache, getEmbeddingCache
+from ..convert import readSetOfCoordinates3DFromTloc, convertToMrc
+from ..engine import mapEmbeddings, locateParticles, sliceProfile, detectSlab
+from ..scheduler import (getGpuScheduler, getResourceScheduler, Timeline,
+                         formatTimelineReport)
+from ..tuning import (getSizeProfile, runAdaptive, checkOutOfMemory,
+                      isOutOfMemory)
+from ..worker import startWorker, getSocketPath, getWorkerScript
+from ..estimator import (countSubvolumes, maskCoverage, estimateCost, formatCost,
+                         mapFootprint, umapFootprint, measureMapFootprint)
+from ..heatmaps import HEATMAP_DTYPES, HEATMAPS_FILE
+from ..budget import (ResourceBudget, getHostMemory, getHostCores,
+                      MIN_FIT_SAMPLE, GB)
+from ..rescale import (getScaleFactor, needsRescale, getRescaledShape,
+                       getCoordScale, rescaleToMrc, rescaleReference,
+                       TARGET_SAMPLING, REF_BOX)
 
 
 class ProtTomoTwinBase(ProtTomoPicking):
@@ -46,6 +66,8 @@ class ProtTomoTwinBase(ProtTomoPicking):
 
     def __init__(self, **kwargs):
         ProtTomoPicking.__init__(self, **kwargs)
+        self._outputLock = threading.Lock()
+        self._workerLock = threading.Lock()
 
     def _createFilenameTemplates(self):
         """ Centralize how files are called. """
@@ -63,16 +85,30 @@ class ProtTomoTwinBase(ProtTomoPicking):
                       label="Input tomograms", important=True,
                       help='Specify tomograms containing reference-like '
                            'particles to be extracted. It is recommended '
-                           'to rescale tomograms to 10 A/px in advance. '
-                           'Tomograms should be without denoising or '
-                           'lowpass filtering.')
+                           'to rescale tomograms to 10 A/px, in advance '
+                           'or with the option below. Tomograms should be '
+                           'without denoising or lowpass filtering.')
+        form.addParam('rescale', params.BooleanParam, default=False,
+                      label="Rescale to the TomoTwin pixel size?",
+                      help="Resample the tomograms (and masks) to the "
+                           "target pixel size while they are staged, "
+                           "instead of running a separate rescaling "
+                           "protocol. References are resampled to the same "
+                           "pixel size and cropped or padded to 37 px. "
+                           "Picked coordinates are given at the pixel size "
+                           "of the input tomograms.")
+        form.addParam('targetSampling', params.FloatParam,
+                      default=TARGET_SAMPLING, condition='rescale',
+                      label="Target pixel size (A/px)",
+                      help="TomoTwin was trained with 10 A/px.")
 
         if self._requiresRefs:
             form.addParam('inputRefs', params.PointerParam,
                           pointerClass="SetOfVolumes, Volume",
                           label='Reference volumes', important=True,
                           help='Specify a set of 3D volumes. They *must have '
-                               'the same pixel size as tomograms and 37 px dimensions*.')
+                               'the same pixel size as tomograms and 37 px '
+                               'dimensions*, unless they are rescaled.')
 
         form.addParam('inputMasks', params.PointerParam,
                       pointerClass='SetOfTomoMasks',
@@ -88,17 +124,31 @@ class ProtTomoTwinBase(ProtTomoPicking):
                             help="To have your tomograms embedded as quick "
                                  "as possible, you should choose a batch size that "
                                  "utilize your GPU memory as much as possible. "
-                                 "However, if you choose it too big, you might "
-                                 "run into memory problems. In those cases play "
-                                 "around with different batch sizes and check "
-                                 "the memory usage with nvidia-smi.")
+                                 "If a job runs out of memory, it is retried "
+                                 "with half the batch size, and the largest size "
+                                 "that worked on this host is used as the "
+                                 "start in later runs.")
         line.addParam('batchTomos', params.IntParam, default=256,
                       label="Tomograms")
         if self._requiresRefs:
             line.addParam('batchRefs', params.IntParam, default=12,
                           label="References")
 
-        line = form.addLine("Z-range for sliding (px)")
+        form.addParam('autoZRange', params.BooleanParam, default=False,
+                      label="Detect z-range automatically?",
+                      help="Find the specimen slab of each tomogram from "
+                           "the variance of its z slices, and only embed "
+                           "that slab (plus a margin) instead of the empty "
+                           "ice above and below.")
+        form.addParam('zMargin', params.IntParam, default=20,
+                      condition='autoZRange',
+                      label="Margin around the slab (px)",
+                      help="Slices added on both sides of the detected "
+                           "slab. Keep it above half the box size (37 px).")
+        line = form.addLine("Z-range for sliding (px)",
+                            condition='not autoZRange',
+                            help="Slices of the input tomograms, also "
+                                 "when they are rescaled.")
         line.addParam('zMin', params.IntParam, default=0,
                       label="Min")
         line.addParam('zMax', params.IntParam, default=0,
@@ -106,29 +156,75 @@ class ProtTomoTwinBase(ProtTomoPicking):
 
         if not self._requiresRefs:
             form.addParam('fitSampleSize', params.IntParam, default=400000,
+                          condition='not useBudget',
                           label="Sample size for the fit of the UMAP",
-                          help="If you encounter an out of memory error, "
-                               "you may need to reduce the Sample size and/or "
+                          help="If the UMAP runs out of memory, it is "
+                               "retried with half the Sample size and "
                                "Chunk size values (default 400,000).")
             form.addParam('chunkSize', params.IntParam, default=400000,
+                          condition='not useBudget',
                           label="Chunk size for transform all data",
-                          help="If you encounter an out of memory error, "
-                               "you may need to reduce the Sample size and/or "
+                          help="If the UMAP runs out of memory, it is "
+                               "retried with half the Sample size and "
                                "Chunk size values (default 400,000).")
 
+        form.addParam('tomosPerJob', params.IntParam, default=1,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Tomograms per job",
+                      help="Embed (and create the UMAPs of) this many "
+                           "tomograms in a single TomoTwin process, so that "
+                           "modules and the GPU context are loaded once per "
+                           "group. Results are still checked per tomogram "
+                           "and a failed tomogram does not stop the others.")
+        form.addParam('showEstimate', params.BooleanParam, default=False,
+                      label="Show cost estimate before running?",
+                      help="Before the run starts, show the predicted number "
+                           "of subvolumes, embedding size on disk, RAM and "
+                           "wall time. Speeds are measured by previous runs "
+                           "on this host, or defaults if there are none.")
+        form.addParam('useWorker', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Use a persistent TomoTwin worker?",
+                      help="Run TomoTwin programs in a background worker "
+                           "that keeps the environment, modules and model "
+                           "loaded, instead of starting a new process for "
+                           "each job. The worker is shared by all the runs "
+                           "with the same TomoTwin environment and model, "
+                           "and stops after one hour without jobs. If it "
+                           "cannot be started, new processes are used.")
+
     def _definePickingParams(self, form):
         form.addSection(label="Picking params")
         form.addParam('numCpus', params.IntParam, default=4,
+                      condition='not useBudget',
                       label="Number of CPUs",
                       help="*Important!* This is different from number of threads "
                            "above as threads are used for GPU parallelization. "
                            "Provide here the number of *CPU cores* for tomotwin locate "
                            "process.")
+        form.addParam('useNativeMap', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Compute maps inside Scipion?",
+                      help="Compute the similarity maps with NumPy on the "
+                           "CPU cores above instead of running "
+                           "tomotwin_map.py. Results are the same, but "
+                           "this avoids loading the TomoTwin environment "
+                           "for every tomogram.")
+        form.addParam('useNativeLocate', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Locate particles inside Scipion? (experimental)",
+                      help="Experimental: find the similarity maxima with "
+                           "the plugin implementation instead of running "
+                           "tomotwin_locate.py. References are distributed "
+                           "over the CPU cores above. The picks are not "
+                           "guaranteed to be the same as those of "
+                           "tomotwin_locate.py.")
         form.addParam('boxSize', params.IntParam, default=37,
                       label="Box size (px)",
                       help="The box size only influences the non-maximum "
                            "suppression. The ideal box size is a tight box "
-                           "size around the protein.")
+                           "size around the protein. If tomograms are "
+                           "rescaled, it is given at the target pixel size.")
         form.addParam('tolerance', params.FloatParam,
                       default=0.2,
                       label="Tolerance value")
@@ -145,89 +241,285 @@ class ProtTomoTwinBase(ProtTomoPicking):
                            "for each reference in your_tomo/locate/ - just "
                            "in case you are interested, this is akin to a "
                            "location confidence heatmap for each protein.")
+        form.addParam('heatmapFormat', params.EnumParam,
+                      choices=['compact', 'mrc'], default=0,
+                      condition='doHeatMaps and useNativeLocate',
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Heatmap format",
+                      help="Compact: the heatmaps of all references in a "
+                           "single compressed your_tomo/locate/heatmaps.zip "
+                           "file, read slab by slab by the viewer. "
+                           "Mrc: one full-size float volume per reference, "
+                           "as written by tomotwin_locate.py.")
+        line = form.addLine("Compact heatmaps",
+                            condition='doHeatMaps and useNativeLocate and '
+                                      'heatmapFormat == 0',
+                            help="Values are kept as float16 or uint8 "
+                                 "(steps of 1/127.5). Binning keeps the "
+                                 "maximum of each block, so peaks are not "
+                                 "lost.")
+        line.addParam('heatmapDtype', params.EnumParam,
+                      choices=HEATMAP_DTYPES, default=0, label="Values")
+        line.addParam('heatmapBinning', params.IntParam, default=1,
+                      label="Binning")
+
+    def _defineBudgetParams(self, form):
+        """ To be called after the parallel section. """
+        form.addParam('useBudget', params.BooleanParam, default=False,
+                      label="Derive sizes from a resource budget?",
+                      help="Set the memory and cores this run may use, "
+                           "instead of the UMAP sample and chunk sizes and "
+                           "the number of CPUs for locate. These are derived "
+                           "from the budget and the size of the largest "
+                           "tomogram, and picking steps only run at the same "
+                           "time while their memory (measured by previous "
+                           "runs on this host) and cores fit in the budget.")
+        line = form.addLine("Resource budget", condition='useBudget',
+                            help="Use 0 for 80% of the host memory and "
+                                 "all the host cores.")
+        line.addParam('memoryBudget', params.FloatParam, default=0,
+                      label="Memory (GB)")
+        line.addParam('coreBudget', params.IntParam, default=0,
+                      label="Cores")
 
     # --------------------------- STEPS functions -----------------------------
-    def convertInputStep(self):
-        """ Copy or link inputs to tmp. """
-        pwutils.makePath(self._getTmpPath("input_masks"))
+    def convertInputStep(self, *args):
+        """ Copy or link inputs to tmp. Step arguments are only used
+        to re-run the step when the inputs change. """
+        self._resetOutput()
+        cache = getStagingCache(self)
         if self._requiresRefs:
-            pwutils.makePath(self._getTmpPath("input_refs"))
-            refs = self.inputRefs.get()
-            if isinstance(refs, Volume):
-                refs = [refs]
-
-            for vol in refs:
-                inputFn = vol.getFileName()
-                refFn = pwutils.removeBaseExt(inputFn) + '.mrc'
-                refFn = self._getTmpPath(f"input_refs/{refFn}")
-                convertToMrc(inputFn, refFn)
-
-        for tomo in self._getInputTomos():
-            inputFn = tomo.getFileName()
-            tomoFn = self._getTmpPath(tomo.getTsId() + ".mrc")
-            convertToMrc(inputFn, tomoFn)
-
-            if self._hasMasks():
-                for mask in self.inputMasks.get():
-                    if os.path.basename(mask.getVolName()) == os.path.basename(inputFn):
-                        maskFn = self._getTmpPath(f"input_masks/{tomo.getTsId()}_mask.mrc")
-                        convertToMrc(mask.getFileName(), maskFn)
-                        break
+            self._convertRefs(cache)
+
+        tomos = [tomo.clone() for tomo in self._getInputTomos()]
+        # rescaling uses a pool of processes for each tomogram
+        numWorkers = 1 if self._isRescaled() else min(len(tomos),
+                                                      self.numberOfThreads.get())
+        if numWorkers > 1:
+            with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+                list(executor.map(lambda t: self._convertTomo(t, cache), tomos))
+        else:
+            for tomo in tomos:
+                self._convertTomo(tomo, cache)
+
+        self.info(f"Staging {cache.getStats()}")
+
+    def _convertRefs(self, cache):
+        pwutils.cleanPath(self._getTmpPath("input_refs"))
+        pwutils.makePath(self._getTmpPath("input_refs"))
+        refs = self.inputRefs.get()
+        if isinstance(refs, Volume):
+            refs = [refs]
+
+        for vol in refs:
+            inputFn = vol.getFileName()
+            refFn = pwutils.removeBaseExt(inputFn) + '.mrc'
+            refFn = self._getTmpPath(f"input_refs/{refFn}")
+            if self._isRescaled():
+                factor = getScaleFactor(vol.getSamplingRate(),
+                                        self._getTargetSampling())
+                rescaleReference(inputFn, refFn, factor, box=REF_BOX,
+                                 voxelSize=self._getTargetSampling())
+            else:
+                convertToMrc(inputFn, refFn, cache,
+                             voxelSize=vol.getSamplingRate())
+
+    def _convertTomo(self, tomo, cache):
+        tomoFn = self._stageVolume(tomo, tomo.getFileName(),
+                                   self._getTmpPath(tomo.getTsId() + ".mrc"),
+                                   cache)
+        if self._isAutoZRange():
+            self._detectZRange(tomo.getTsId(), tomoFn)
+
+        mask = self._getInputMask(tomo)
+        if mask is not None:
+            pwutils.makePath(self._getTmpPath("input_masks"))
+            maskFn = self._getTmpPath(f"input_masks/{tomo.getTsId()}_mask.mrc")
+            self._stageVolume(tomo, mask.getFileName(), maskFn, cache,
+                              nearest=True)
+
+    def _stageVolume(self, tomo, inputFn, outputFn, cache, nearest=False):
+        """ Convert or link a tomogram (or its mask) to outputFn,
+        rescaled to the staged dimensions if needed. """
+        if self._isRescaled():
+            x, y, z = self._getStagedDims(tomo)
+            rescaleToMrc(inputFn, outputFn, (z, y, x), cache, nearest=nearest,
+                         numProcesses=self.numberOfThreads.get(),
+                         voxelSize=self._getTargetSampling())
+        else:
+            convertToMrc(inputFn, outputFn, cache,
+                         voxelSize=tomo.getSamplingRate())
+        return outputFn
 
     def embedTomoStep(self, tomoId):
-        """ Embed each tomo. """
-        self.runProgram(self.getProgram("tomotwin_embed.py"),
-                        self._getEmbedTomoArgs(tomoId))
+        """ Embed each tomo, unless an equivalent embedding
+        is found in the project cache. """
+        cache = self._getEmbeddingCache()
+        outputFn = self._getEmbeddingFn(tomoId)
 
-    def pickingStep(self, tomoId):
-        """ Localize potential particles.  """
-        # map tomo
-        self.runProgram(self.getProgram("tomotwin_map.py", gpu=False),
-                        self._getMapArgs(tomoId))
+        timings = []
+        hit = cache.link(self._getEmbeddingKey(tomoId), outputFn,
+                         lambda: timings.append(self._embedTomo(tomoId)))
+        if hit:
+            self.info(f"Using cached embedding for {tomoId}")
+        else:
+            self._recordTiming("embed", *timings[0])
+        self.info(f"Embedding {cache.getStats()}")
+
+    def _embedTomo(self, tomoId):
+        """ Run the embedding of a tomogram. Return the number
+        of subvolumes embedded and the seconds it took. """
+        tomo = self._getInputTomo(tomoId)
+        seconds = self.runAdaptiveGpuProgram(
+            "tomotwin_embed.py",
+            lambda b: self._getEmbedTomoArgs(tomoId, batchSize=b),
+            "batchTomos", weight=self._getTomoWeight(tomo),
+            label=f"embed {tomoId}")
+        return self._getSubvolumes(tomo), seconds
+
+    def embedTomosStep(self, *tomoIds):
+        """ Embed a group of tomograms in one TomoTwin process. Cached
+        embeddings are only linked. A tomogram that fails is retried
+        alone if it ran out of memory, otherwise only its own picking
+        step fails later. """
+        cache = self._getEmbeddingCache()
+        missing = []
+        for tomoId in tomoIds:
+            if cache.lookup(self._getEmbeddingKey(tomoId), ".temb") is None:
+                missing.append(tomoId)
+            else:
+                self.embedTomoStep(tomoId)
+
+        if not missing:
+            return
+
+        profile = getSizeProfile()
+        key = profile.getKey(Plugin.getVar(TOMOTWIN_MODEL), "batchTomos")
+        batchSize = profile.getStart(key, self.batchTomos.get())
+        jobs = [{"id": tomoId, "program": "tomotwin_embed.py",
+                 "args": " ".join(self._getEmbedTomoArgs(tomoId, batchSize=batchSize)),
+                 "log": self._getJobLogFn(f"embed {tomoId}")}
+                for tomoId in missing]
+        weight = sum(self._getTomoWeight(self._getInputTomo(t)) for t in missing)
+        start = time.time()
+        results = self.runBatchGpuProgram(jobs, weight=weight,
+                                          label=f"embed {len(missing)} tomograms")
+        self._recordTiming("embed", sum(self._getSubvolumes(self._getInputTomo(t))
+                                        for t in missing if results.get(t) == 0),
+                           time.time() - start)
+
+        for job in jobs:
+            tomoId = job["id"]
+            if results.get(tomoId) == 0 and os.path.exists(self._getEmbeddingFn(tomoId)):
+                profile.update(key, ok=batchSize)
+                cache.link(self._getEmbeddingKey(tomoId),
+                           self._getEmbeddingFn(tomoId), lambda: None)
+            elif self._isOutOfMemory(job["log"]):
+                self.info(f"Embedding of {tomoId} ran out of memory, "
+                          f"retrying it alone")
+                try:
+                    self.embedTomoStep(tomoId)
+                except Exception as e:
+                    self.info(f"Embedding of {tomoId} failed: {e}")
+            else:
+                self.info(f"Embedding of {tomoId} failed, see {job['log']}")
 
-        # locate particles
-        self.runProgram(self.getProgram("tomotwin_locate.py", gpu=False),
-                        self._getLocateArgs(tomoId))
+    def pickingStep(self, tomoId):
+        """ Localize potential particles and add them to the output.  """
+        if not os.path.exists(self._getEmbeddingFn(tomoId)):
+            raise Exception(f"No embedding for {tomoId}, "
+                            f"see {self._getJobLogFn(f'embed {tomoId}')}")
+        start = time.time()
+        if self._useBudget():
+            tomo = self._getInputTomo(tomoId)
+            getResourceScheduler(self).run(
+                lambda: self._pickTomo(tomoId),
+                memory=self._getPickingFootprint(self._getSubvolumes(tomo)),
+                cores=self._getNumCpus())
+        else:
+            self._pickTomo(tomoId)
+        self._recordFootprint(tomoId)
+        if self._getNumRefs():
+            self._recordTiming("picking", self._getNumRefs() *
+                               self._getSubvolumes(self._getInputTomo(tomoId)),
+                               time.time() - start)
+        self._publishCoordinates(tomoId)
 
-        # output coords
-        self.runProgram(self.getProgram("tomotwin_pick.py", gpu=False),
-                        self._getPickArgs(tomoId))
+    def _pickTomo(self, tomoId):
+        with self._getTimeline().record(Timeline.CPU, f"picking {tomoId}"):
+            self._mapTomo(tomoId)
+            self._locateTomo(tomoId)
 
     def createOutputStep(self, fromViewer=False):
+        """ Close the output set. Coordinates were already added by
+        each picking step, only their manifests are read here. """
+        if fromViewer:
+            self._createViewerOutput()
+            return
+
+        manifests = [self._readManifest(fn) for fn in
+                     glob(self._getExtraPath("*", "coordinates.json"))]
+        self.info(f"Particles picked on {len(manifests)} tomograms: "
+                  f"{sum(m['count'] for m in manifests)}")
+        self._writeTimelineReport()
+
+        with self._outputLock:
+            outputSet = self._getOutputSet()
+            self._updateOutputSet(self.OUTPUT_PREFIX, outputSet,
+                                  state=outputSet.STREAM_CLOSED)
+
+    def _publishCoordinates(self, tomoId):
+        """ Append the coordinates of a tomogram to the open output
+        and write its manifest. Tomograms already published
+        (e.g. when the protocol is resumed) are skipped. """
+        tlocFn = self._getTlocFn(tomoId)
+        manifestFn = self._getManifestFn(tomoId)
+        if not os.path.exists(tlocFn):
+            self.info(f"No particles located for {tomoId}")
+            return
+        if os.path.exists(manifestFn):
+            self.info(f"Particles from {tomoId} are already in the output")
+            return
+
+        with self._outputLock:
+            outputSet = self._getOutputSet()
+            tomo = self._getInputTomo(tomoId)
+            count = readSetOfCoordinates3DFromTloc(tlocFn, outputSet, tomo,
+                                                   origin=BOTTOM_LEFT_CORNER,
+                                                   scale=self._getCoordScale(tomo))
+            self._updateOutputSet(self.OUTPUT_PREFIX, outputSet,
+                                  state=outputSet.STREAM_OPEN)
+            with open(manifestFn, "w") as f:
+                json.dump({"tomoId": tomoId, "count": count,
+                           "tloc": os.path.relpath(tlocFn, self._getExtraPath())}, f)
+        self.info(f"Added {count} particles from {tomoId}")
+
+    def _createViewerOutput(self):
+        """ Create a new output from the tables saved in Napari. """
         setOfTomograms = self._getInputTomos()
         suffix = self._getOutputSuffix(SetOfCoordinates3D)
-        coord3DSetDict = {}
-        setOfCoord3D = self._createSetOfCoordinates3D(setOfTomograms, suffix)
-        setOfCoord3D.setName("tomoCoord")
-        setOfCoord3D.setPrecedents(setOfTomograms)
-        setOfCoord3D.setSamplingRate(setOfTomograms.getSamplingRate())
-        setOfCoord3D.setBoxSize(self.boxSize.get())
+        setOfCoord3D = self._createCoordinatesSet(suffix)
 
         for tomo in setOfTomograms.iterItems():
-            tomoId = tomo.getTsId()
-            files = glob(f"{self.getOutputDir(fromViewer)}/{tomoId}/*_relion3.star")
-            if not files:
-                continue
-            else:
-                coord3DSetDict[tomo.getObjId()] = setOfCoord3D
-                for index, fn in enumerate(files):
-                    readSetOfCoordinates3D(fn, setOfCoord3D, tomo.clone(),
-                                           origin=BOTTOM_LEFT_CORNER,
-                                           groupId=index)
+            tlocFn = self._getTlocFn(tomo.getTsId(), fromViewer=True)
+            if os.path.exists(tlocFn):
+                readSetOfCoordinates3DFromTloc(tlocFn, setOfCoord3D,
+                                               tomo.clone(),
+                                               origin=BOTTOM_LEFT_CORNER,
+                                               scale=self._getCoordScale(tomo))
 
         name = self.OUTPUT_PREFIX + suffix
         self._defineOutputs(**{name: setOfCoord3D})
         self._defineSourceRelation(setOfTomograms, setOfCoord3D)
-
-        for tomoObjId, coord3DSet in coord3DSetDict.items():
-            self._updateOutputSet(name, coord3DSet,
-                                  state=coord3DSet.STREAM_CLOSED)
+        self._updateOutputSet(name, setOfCoord3D,
+                              state=setOfCoord3D.STREAM_CLOSED)
 
     # --------------------------- INFO functions ------------------------------
     def _warnings(self):
         warnings = []
 
-        if self._getInputTomos().getSamplingRate() - 10.0 > 0.5:
+        if (not self._isRescaled() and
+                self._getInputTomos().getSamplingRate() - 10.0 > 0.5):
             warnings.append("TomoTwin was trained on tomograms with a "
                             "pixel size of 10A. While in practice we've used "
                             "it with pixel sizes ranging from 9.2A to 25.0A, "
@@ -236,12 +528,24 @@ class ProtTomoTwinBase(ProtTomoPicking):
 
         warnings.extend(self._warningsExtra())
 
+        if getattr(self, "showEstimate", None) is not None and self.showEstimate:
+            warnings.append("Estimated cost:\n" + "\n".join(self._getCostSummary()))
+
         return warnings
 
     def _warningsExtra(self):
         """ To be implemented in subclasses. """
         return []
 
+    def _summary(self):
+        summary = ProtTomoPicking._summary(self)
+        summary.extend(self._getZRangeSummary())
+        reportFn = self._getExtraPath("timeline.json")
+        if os.path.exists(reportFn):
+            with open(reportFn) as f:
+                summary.append("Timeline: " + formatTimelineReport(json.load(f)))
+        return summary
+
     def getSummary(self, coord3DSet):
         summary = list()
         summary.append("Number of particles picked: %s" % coord3DSet.getSize())
@@ -257,28 +561,251 @@ class ProtTomoTwinBase(ProtTomoPicking):
         ]
 
     # --------------------------- UTILS functions ------------------------------
-    def _getEmbedTomoArgs(self, tomoId):
+    def _getEmbedTomoArgs(self, tomoId, batchSize=None, stride=None,
+                          outputDir="embed/tomos", maskFn=None):
+        """ Arguments of tomotwin_embed.py. A maskFn (relative to the
+        extra folder) replaces the input mask of the tomogram. """
         args = [
             f"tomogram -m {Plugin.getVar(TOMOTWIN_MODEL)}",
             f"-v ../tmp/{tomoId}.mrc",
-            f"-b {self.batchTomos.get()}",
-            "-s 2 -o embed/tomos"
+            f"-b {batchSize or self.batchTomos.get()}",
+            f"-s {stride or self._getStride()} -o {outputDir}"
         ]
 
-        if self.zMin > 0 and self.zMax > 0:
-            args.append(f"-z {self.zMin} {self.zMax}")
+        zRange = self._getZRange(tomoId)
+        if zRange is not None:
+            args.append(f"-z {zRange[0]} {zRange[1]}")
 
-        if self._hasMasks():
+        if maskFn is not None:
+            args.append(f"--mask {maskFn}")
+        elif self._hasMasks():
             maskFn = f"input_masks/{tomoId}_mask.mrc"
             if os.path.exists(self._getTmpPath(maskFn)):
                 args.append(f"--mask ../tmp/{maskFn}")
 
         return args
 
-    def _getMapArgs(self, tomoId):
-        """ Should be implemented in subclasses. """
+    def _getStride(self):
+        return 2
+
+    def _getEmbeddingKey(self, tomoId):
+        """ Parameters that make two tomogram embeddings equivalent. """
+        cache = self._getEmbeddingCache()
+        tomo = self._getInputTomo(tomoId)
+        mask = self._getInputMask(tomo)
+
+        fields = dict(
+            tomo=cache.getFingerprint(tomo.getFileName()),
+            model=Plugin.getVar(TOMOTWIN_MODEL),
+            version=Plugin.getActiveVersion(),
+            stride=self._getStride(),
+            zRange=self._getZRange(tomoId),
+            mask=cache.getFingerprint(mask.getFileName()) if mask else None
+        )
+        if self._isRescaled():
+            fields["dims"] = list(self._getStagedDims(tomo))
+        refine = self._getRefineKey()
+        if refine is not None:
+            fields["refine"] = refine
+        return cache.getKey(**fields)
+
+    def _getRefineKey(self):
+        """ Parameters of a coarse-to-fine embedding, if used. """
+        return None
+
+    def _getRescaleFactor(self):
+        """ Factor from the input to the staged pixel size,
+        1 if the tomograms are not rescaled. """
+        rescale = getattr(self, "rescale", None)
+        if rescale is None or not rescale.get():
+            return 1.
+        factor = getScaleFactor(self._getInputTomos().getSamplingRate(),
+                                self._getTargetSampling())
+        return factor if needsRescale(factor) else 1.
+
+    def _getTargetSampling(self):
+        return self.targetSampling.get()
+
+    def _isRescaled(self):
+        return self._getRescaleFactor() != 1.
+
+    def _getStagedDims(self, tomo):
+        """ Dimensions (x, y, z) of the staged tomogram. """
+        return getRescaledShape(tomo.getDimensions(), self._getRescaleFactor())
+
+    def _getCoordScale(self, tomo):
+        """ Factors from staged to input pixels, per axis. """
+        if not self._isRescaled():
+            return 1
+        return getCoordScale(tomo.getDimensions(), self._getRescaleFactor())
+
+    def _getViewerTomoFn(self, tomo):
+        """ Tomogram shown with the located particles, i.e.
+        the staged one if the coordinates are rescaled. """
+        tomoFn = self._getTmpPath(tomo.getTsId() + ".mrc")
+        if self._isRescaled() and os.path.exists(tomoFn):
+            return tomoFn
+        return tomo.getFileName()
+
+    def _isAutoZRange(self):
+        return getattr(self, "autoZRange", None) is not None and self.autoZRange.get()
+
+    def _detectZRange(self, tomoId, tomoFn):
+        """ Find the specimen slab of a staged tomogram and
+        save it in extra/<tomoId>/zrange.json. """
+        _, variances = sliceProfile(tomoFn)
+        depth = len(variances)
+        slab = detectSlab(variances, self.zMargin.get())
+        if slab is None:
+            self.info(f"No specimen slab found for {tomoId}, "
+                      f"the whole tomogram is embedded")
+            zMin, zMax = 0, depth - 1
+        else:
+            zMin, zMax = slab
+            self.info(f"Z-range for {tomoId}: {zMin}-{zMax} of {depth} slices")
+
+        pwutils.makePath(self._getExtraPath(tomoId))
+        with open(self._getExtraPath(tomoId, "zrange.json"), "w") as f:
+            json.dump({"zMin": zMin, "zMax": zMax, "depth": depth,
+                       "detected": slab is not None}, f)
+
+    def _getZRange(self, tomoId):
+        """ Slices to embed: the detected slab, the range set
+        by the user or None for the whole tomogram. """
+        if self._isAutoZRange():
+            zRangeFn = self._getExtraPath(tomoId, "zrange.json")
+            if os.path.exists(zRangeFn):
+                zRange = self._readManifest(zRangeFn)
+                if zRange["detected"]:
+                    return [zRange["zMin"], zRange["zMax"]]
+            return None
+        if self.zMin > 0 and self.zMax > 0:
+            factor = self._getRescaleFactor()
+            return [int(round(self.zMin.get() / factor)),
+                    int(round(self.zMax.get() / factor))]
+        return None
+
+    def _getZRangeSummary(self):
+        """ Detected z-ranges and the fraction of voxels not embedded. """
+        zRanges = {os.path.basename(os.path.dirname(fn)): self._readManifest(fn)
+                   for fn in sorted(glob(self._getExtraPath("*", "zrange.json")))}
+        if not zRanges:
+            return []
+        total = sum(z["depth"] for z in zRanges.values())
+        embedded = sum(z["zMax"] - z["zMin"] + 1 for z in zRanges.values())
+        summary = [f"Automatic z-range: {embedded} of {total} slices embedded "
+                   f"({100 * (1 - embedded / total):.0f}% fewer voxels)"]
+        for tomoId, z in zRanges.items():
+            summary.append(f"    {tomoId}: {z['zMin']}-{z['zMax']} of {z['depth']}"
+                           + ("" if z["detected"] else " (no slab found)"))
+        return summary
+
+    def _getSubvolumes(self, tomo):
+        """ Predicted number of subvolumes embedded for a tomogram. """
+        mask = self._getInputMask(tomo)
+        coverage = 1.
+        if mask is not None:
+            try:
+                coverage = maskCoverage(mask.getFileName())
+            except Exception:
+                pass
+        return countSubvolumes(self._getStagedDims(tomo), self._getStride(),
+                               self._getZRange(tomo.getTsId()), coverage)
+
+    def _getNumRefs(self):
+        """ Number of references mapped against each tomogram. """
+        return 0
+
+    def _getCostStages(self):
+        """ Kinds of jobs run for each tomogram, see estimateCost. """
+        return ["embed"]
+
+    def _recordTiming(self, stage, units, seconds):
+        profile = getSizeProfile()
+        profile.addTiming(profile.getKey(Plugin.getVar(TOMOTWIN_MODEL),
+                                         f"rate_{stage}"), units, seconds)
+
+    def _getCostSummary(self):
+        """ Cost estimate of the run, as text lines. """
+        profile = getSizeProfile()
+        model = Plugin.getVar(TOMOTWIN_MODEL)
+        stages = self._getCostStages()
+        rates = {}
+        for stage in stages:
+            rate = profile.getRate(profile.getKey(model, f"rate_{stage}"))
+            if rate is not None:
+                rates[stage] = rate
+
+        subvolumes = [self._getSubvolumes(tomo)
+                      for tomo in self._getInputTomos().iterItems()]
+        gpus = self._getGpuSlots()
+        cost = estimateCost(subvolumes, stages, numRefs=self._getNumRefs(),
+                            umapSample=self._getSizeParam("fitSampleSize")
+                            if "umap" in stages else 0,
+                            numGpus=gpus,
+                            numWorkers=self._getCpuSlots(),
+                            rates=rates)
+        lines = formatCost(cost)
+        defaults = [s for s in stages if s not in rates]
+        if defaults:
+            lines.append(f"Default speeds used for: {', '.join(defaults)} "
+                         f"(no previous runs on this host)")
+        if self._isAutoZRange():
+            lines.append("Z-ranges not detected yet are counted in full.")
+        return lines
+
+    def _getEmbeddingCache(self):
+        if getattr(self, "_embeddingCache", None) is None:
+            self._embeddingCache = getEmbeddingCache(self)
+        return self._embeddingCache
+
+    def _mapTomo(self, tomoId):
+        self._runMap(*self._getMapFiles(tomoId))
+
+    def _runMap(self, refsFn, embeddingsFn, outputDir):
+        """ Map the tomogram embeddings against the reference embeddings.
+        Paths are relative to the extra folder. """
+        if self.useNativeMap:
+            mapEmbeddings(self._getExtraPath(refsFn),
+                          self._getExtraPath(embeddingsFn),
+                          self._getExtraPath(outputDir, "map.tmap"),
+                          numThreads=self._getNumCpus())
+        else:
+            self.runProgram("tomotwin_map.py", gpu=False, args=[
+                f"distance -r {refsFn}",
+                f"-v {embeddingsFn}",
+                f"-o {outputDir}/"
+            ])
+
+    def _getMapFiles(self, tomoId):
+        """ Return references and tomogram embeddings and the output
+        folder for the map. Should be implemented in subclasses. """
         raise NotImplementedError
 
+    def _locateTomo(self, tomoId):
+        if self.useNativeLocate:
+            locateParticles(self._getExtraPath(tomoId, "map.tmap"),
+                            self._getExtraPath(tomoId, "locate"),
+                            tolerance=self.tolerance.get(),
+                            boxSize=self.boxSize.get(),
+                            globalMin=self.globalMin.get(),
+                            numProcesses=self._getNumCpus(),
+                            writeHeatmaps=self.doHeatMaps.get(),
+                            heatmapDtype=self._getHeatmapDtype(),
+                            heatmapBinning=self.heatmapBinning.get())
+        else:
+            self.runProgram("tomotwin_locate.py", self._getLocateArgs(tomoId),
+                            gpu=False)
+
+    def _getHeatmapDtype(self):
+        """ Type of the compact heatmaps, None for mrc volumes. """
+        if self.heatmapFormat.get() != 0:
+            return None
+        return HEATMAP_DTYPES[self.heatmapDtype.get()]
+
+    def _getHeatmapsFn(self, tomoId):
+        return self._getExtraPath(tomoId, "locate", HEATMAPS_FILE)
+
     def _getLocateArgs(self, tomoId):
         params = [
             f"findmax -m {tomoId}/map.tmap",
@@ -286,7 +813,7 @@ class ProtTomoTwinBase(ProtTomoPicking):
             f"-t {self.tolerance.get()}",
             f"-b {self.boxSize.get()}",
             f"-g {self.globalMin.get()}",
-            f"--processes {self.numCpus.get()}"
+            f"--processes {self._getNumCpus()}"
         ]
 
         if self.doHeatMaps:
@@ -294,22 +821,316 @@ class ProtTomoTwinBase(ProtTomoPicking):
 
         return params
 
-    def _getPickArgs(self, tomoId):
-        return [
-            f"-l {tomoId}/locate/located.tloc",
-            f"-o {tomoId}/"
-        ]
-
-    def getProgram(self, program, gpu=True):
+    def getProgram(self, program, gpu=True, gpuId=None):
         return Plugin.getProgram(program, gpus=gpu,
-                                 useQueue=self.useQueue())
+                                 useQueue=self.useQueue(), gpuId=gpuId)
+
+    def runGpuProgram(self, program, args, weight=1, label=None, logFn=None):
+        """ Run a GPU job on a single device given by the scheduler,
+        unless the job goes to a queue. Return the seconds it ran,
+        without the time waiting for a GPU. """
+        def _run(gpu=None):
+            start = time.time()
+            self.runProgram(program, args, gpuId=gpu, logFn=logFn)
+            return time.time() - start
+
+        with self._getTimeline().record(Timeline.GPU, label or program):
+            if self.useQueue():
+                return _run()
+            else:
+                return getGpuScheduler(self).run(_run, weight=weight)
+
+    def runAdaptiveGpuProgram(self, program, getArgs, paramName, weight=1,
+                              label=None):
+        """ Run a GPU job with the arguments returned by getArgs(value),
+        where value starts at the paramName value. After an out of memory
+        error the job is retried with a smaller value. Return the
+        seconds of the successful job. """
+        profile = getSizeProfile()
+        key = profile.getKey(Plugin.getVar(TOMOTWIN_MODEL), paramName)
+        label = label or program
+        logFn = self._getJobLogFn(label)
+        elapsed = []
+
+        def _run(value):
+            try:
+                elapsed.append(self.runGpuProgram(program, getArgs(value),
+                                                  weight=weight, label=label,
+                                                  logFn=logFn))
+            except Exception as e:
+                checkOutOfMemory(logFn, e)
+            finally:
+                if os.path.exists(logFn):
+                    with open(logFn, errors="replace") as f:
+                        self.info(f.read())
+
+        value = runAdaptive(_run, self._getSizeParam(paramName), profile, key,
+                            log=self.info)
+        self.info(f"{label}: {paramName} = {value}")
+        return elapsed[-1]
+
+    def runBatchGpuProgram(self, jobs, weight=1, label=None):
+        """ Run TomoTwin jobs (dicts with id, program, args and log)
+        one after the other in a single process on one GPU. Return the
+        exit status by job id, a failed job does not stop the others. """
+        batchFn = self._getTmpPath("logs", f"batch_{jobs[0]['id']}")
+        # the batch process runs in the extra folder
+        for job in jobs:
+            job["cwd"] = os.path.abspath(job.get("cwd", self._getExtraPath()))
+            job["log"] = os.path.abspath(job["log"])
+
+        def _run(gpu=None):
+            worker = self._getWorker()
+            if worker is not None:
+                env = {} if gpu is None else {"CUDA_VISIBLE_DEVICES": str(gpu)}
+                try:
+                    return {job["id"]: worker.run(job["program"], job["args"],
+                                                  job["cwd"], job["log"], env)
+                            for job in jobs}
+                except OSError as e:
+                    self.info(f"TomoTwin worker not available ({e}), "
+                              f"using a new process")
+                    self._worker = False
+
+            with open(batchFn + ".json", "w") as f:
+                json.dump(jobs, f, indent=2)
+            pwutils.cleanPath(batchFn + "_results.json")
+            try:
+                self.runJob(self.getProgram(f"python {getWorkerScript()}",
+                                            gpuId=gpu),
+                            f"batch --jobs {os.path.abspath(batchFn)}.json "
+                            f"--results {os.path.abspath(batchFn)}_results.json "
+                            f"--model {Plugin.getVar(TOMOTWIN_MODEL)}",
+                            env=Plugin.getEnviron(), cwd=self._getExtraPath())
+            except Exception as e:
+                self.info(f"Batch process failed: {e}")
+            if not os.path.exists(batchFn + "_results.json"):
+                return {}
+            with open(batchFn + "_results.json") as f:
+                return json.load(f)
+
+        with self._getTimeline().record(Timeline.GPU, label or "batch"):
+            if self.useQueue():
+                results = _run()
+            else:
+                results = getGpuScheduler(self).run(_run, weight=weight)
+
+        for job in jobs:
+            if os.path.exists(job["log"]):
+                with open(job["log"], errors="replace") as f:
+                    self.info(f.read())
+        return results
+
+    def _getJobLogFn(self, label):
+        """ Absolute path, jobs run in the extra folder. """
+        logFn = self._getTmpPath("logs", label.replace(" ", "_") + ".log")
+        pwutils.makePath(os.path.dirname(logFn))
+        return os.path.abspath(logFn)
+
+    @staticmethod
+    def _isOutOfMemory(logFn):
+        if not os.path.exists(logFn):
+            return False
+        with open(logFn, errors="replace") as f:
+            return isOutOfMemory(f.read())
+
+    def _getTomoGroups(self, tomoIds):
+        """ Split tomograms in groups embedded by the same job. """
+        size = max(1, self.tomosPerJob.get())
+        return [tomoIds[i:i + size] for i in range(0, len(tomoIds), size)]
+
+    def _getEmbeddingFn(self, tomoId):
+        return self._getExtraPath(f"embed/tomos/{tomoId}_embeddings.temb")
+
+    def _getGpuSlots(self):
+        """ Number of GPU jobs that can run at the same time. """
+        return max(1, len(pwutils.getListFromRangeString(self.gpuList.get())))
+
+    def _getCpuSlots(self):
+        """ Number of CPU steps that can run next to the GPU steps. """
+        return max(1, self.numberOfThreads.get() - 1 - self._getGpuSlots())
+
+    def _useBudget(self):
+        return self.useBudget.get()
+
+    def _getBudget(self):
+        return ResourceBudget(self.memoryBudget.get() * GB, self.coreBudget.get())
+
+    def _getLargestSubvolumes(self):
+        if getattr(self, "_largestSubvolumes", None) is None:
+            self._largestSubvolumes = max(
+                (self._getSubvolumes(tomo) for tomo in self._getInputTomos().iterItems()),
+                default=0)
+        return self._largestSubvolumes
 
-    def runProgram(self, program, args):
-        """ Execute runJob in tmpDir. """
-        self.runJob(program, " ".join(args),
+    def _getFootprintKey(self):
+        profile = getSizeProfile()
+        return profile.getKey(Plugin.getVar(TOMOTWIN_MODEL), "footprint_picking")
+
+    def _getPickingFootprint(self, subvolumes):
+        """ Memory to pick a tomogram, scaled by the ratio
+        measured in previous runs on this host. """
+        scale = getSizeProfile().getFootprintScale(self._getFootprintKey())
+        return int(mapFootprint(subvolumes, self._getNumRefs()) * scale)
+
+    def _recordFootprint(self, tomoId):
+        mapFn = self._getExtraPath(tomoId, "map.tmap")
+        if os.path.exists(mapFn):
+            getSizeProfile().addFootprint(
+                self._getFootprintKey(),
+                mapFootprint(self._getSubvolumes(self._getInputTomo(tomoId)),
+                             self._getNumRefs()),
+                measureMapFootprint(self._getEmbeddingFn(tomoId), mapFn))
+
+    def _getPickingConcurrency(self):
+        """ Picking steps that fit in the budget at the same time. """
+        return self._getBudget().getConcurrency(
+            self._getPickingFootprint(self._getLargestSubvolumes()),
+            self._getCpuSlots())
+
+    def _getNumCpus(self):
+        """ Processes to map and locate a tomogram. """
+        if not self._useBudget():
+            return self.numCpus.get()
+        return self._getBudget().getProcesses(self._getPickingConcurrency())
+
+    def _getSizeParam(self, paramName):
+        """ Value of a size parameter, derived from the budget if used.
+        UMAP transform chunks need the same memory per row as the fit. """
+        if self._useBudget() and paramName in ("fitSampleSize", "chunkSize"):
+            return self._getBudget().getFitSampleSize(self._getLargestSubvolumes(),
+                                                      jobs=self._getGpuSlots())
+        return getattr(self, paramName).get()
+
+    def _validateBudget(self, umap=False, picking=False):
+        """ Check that the budget fits in the host and is
+        large enough for the largest tomogram. """
+        errors = []
+        if not self._useBudget():
+            return errors
+        if self.memoryBudget.get() * GB > getHostMemory():
+            errors.append(f"The memory budget is larger than the memory of "
+                          f"this host ({getHostMemory() / GB:.1f} GB).")
+        if self.coreBudget.get() > getHostCores():
+            errors.append(f"The core budget is larger than the cores of "
+                          f"this host ({getHostCores()}).")
+        budget = self._getBudget()
+        if umap and self._getSizeParam("fitSampleSize") < MIN_FIT_SAMPLE:
+            errors.append(f"A memory budget of {budget.memory / GB:.1f} GB is "
+                          f"not enough for the UMAP of the largest tomogram.")
+        if picking:
+            footprint = self._getPickingFootprint(self._getLargestSubvolumes())
+            if footprint > budget.memory:
+                errors.append(f"Picking the largest tomogram needs {footprint / GB:.1f} "
+                              f"GB, more than the memory budget.")
+        return errors
+
+    def _warningsBudget(self, umap=False, picking=False):
+        """ Warn when the sizes set by hand exceed the host resources. """
+        warnings = []
+        if self._useBudget():
+            return warnings
+        memory, cores = getHostMemory(), getHostCores()
+        largest = self._getLargestSubvolumes()
+        if umap:
+            ram = umapFootprint(largest, self.fitSampleSize.get()) * self._getGpuSlots()
+            if ram > memory:
+                warnings.append(f"The UMAPs running at the same time may need "
+                                f"{ram / GB:.1f} GB, more than the memory of "
+                                f"this host ({memory / GB:.1f} GB).")
+        if picking:
+            steps = min(self._getCpuSlots(), self._getInputTomos().getSize())
+            if self.numCpus.get() * steps > cores:
+                warnings.append(f"{steps} picking steps with {self.numCpus.get()} "
+                                f"CPUs each may run at the same time, more than "
+                                f"the cores of this host ({cores}).")
+            ram = self._getPickingFootprint(largest) * steps
+            if ram > memory:
+                warnings.append(f"The picking steps running at the same time may "
+                                f"need {ram / GB:.1f} GB, more than the memory of "
+                                f"this host ({memory / GB:.1f} GB).")
+        return warnings
+
+    def _getTimeline(self):
+        return Timeline(self._getExtraPath("timeline.jsonl"))
+
+    def _writeTimelineReport(self):
+        """ Log how much CPU picking overlapped with GPU embedding. """
+        timeline = self._getTimeline()
+        if timeline.read():
+            report = timeline.getReport()
+            self.info(f"Timeline: {formatTimelineReport(report)}")
+            with open(self._getExtraPath("timeline.json"), "w") as f:
+                json.dump(report, f, indent=2)
+
+    @staticmethod
+    def _getTomoWeight(tomo):
+        """ Relative cost of a tomogram for GPU load balancing. """
+        x, y, z = tomo.getDimensions()
+        return x * y * z
+
+    def runProgram(self, program, args, gpu=True, gpuId=None, logFn=None):
+        """ Execute a TomoTwin program in the extra folder, with the
+        worker if enabled and available, otherwise with runJob.
+        If logFn is given, the program output is written there. """
+        if logFn is not None:
+            # the program runs in the extra folder
+            logFn = os.path.abspath(logFn)
+            pwutils.makePath(os.path.dirname(logFn))
+        worker = self._getWorker()
+        if worker is not None:
+            env = {}
+            if gpu:
+                env["CUDA_VISIBLE_DEVICES"] = str(
+                    gpuId if gpuId is not None else
+                    ",".join(str(g) for g in self.getGpuList()))
+            jobLogFn = logFn or os.path.abspath(
+                self._getTmpPath("logs", f"worker_{os.getpid()}_"
+                                         f"{threading.get_ident()}.log"))
+            pwutils.makePath(os.path.dirname(jobLogFn))
+            try:
+                status = worker.run(program, " ".join(args),
+                                    cwd=self._getExtraPath(), logFn=jobLogFn,
+                                    env=env)
+            except OSError as e:
+                self.info(f"TomoTwin worker not available ({e}), "
+                          f"using a new process")
+                self._worker = False
+            else:
+                if logFn is None:
+                    with open(jobLogFn, errors="replace") as f:
+                        self.info(f.read())
+                if status != 0:
+                    raise Exception(f"{program} failed with exit code {status}")
+                return
+
+        if logFn is not None:
+            args = args + [f"> {logFn} 2>&1"]
+        self.runJob(self.getProgram(program, gpu, gpuId), " ".join(args),
                     env=Plugin.getEnviron(),
                     cwd=self._getExtraPath())
 
+    def _getWorker(self):
+        """ Client of the TomoTwin worker, started on first use.
+        Return None if disabled, running on a queue or unavailable. """
+        useWorker = getattr(self, "useWorker", None)
+        if useWorker is None or not useWorker.get() or self.useQueue():
+            return None
+        with self._workerLock:
+            if getattr(self, "_worker", None) is None:
+                activation = Plugin.getActivationCmd()
+                model = Plugin.getVar(TOMOTWIN_MODEL)
+                name = hashlib.sha1(f"{activation} {model}".encode()).hexdigest()[:12]
+                self.info(f"Connecting to the TomoTwin worker {name}")
+                self._worker = startWorker(activation, getSocketPath(name),
+                                           modelFn=model,
+                                           logFn=self._getLogsPath("worker.log"))
+                if self._worker is None:
+                    self.info("TomoTwin worker did not start, "
+                              "programs will run in new processes")
+                    self._worker = False
+        return self._worker or None
+
     def getOutputDir(self, fromViewer=False):
         """ Results from the viewer will be in the project Tmp folder. """
         if fromViewer:
@@ -317,8 +1138,70 @@ class ProtTomoTwinBase(ProtTomoPicking):
         else:
             return self._getExtraPath()
 
+    def _getTlocFn(self, tomoId, fromViewer=False):
+        """ Located table written by tomotwin_locate.py or,
+        from the viewer, the one saved in Napari. """
+        return os.path.join(self.getOutputDir(fromViewer), tomoId,
+                            "locate", "located.tloc")
+
+    def _getManifestFn(self, tomoId):
+        return self._getExtraPath(tomoId, "coordinates.json")
+
+    @staticmethod
+    def _readManifest(fn):
+        with open(fn) as f:
+            return json.load(f)
+
+    def _createCoordinatesSet(self, suffix=""):
+        setOfTomograms = self._getInputTomos()
+        setOfCoord3D = self._createSetOfCoordinates3D(setOfTomograms, suffix)
+        setOfCoord3D.setName("tomoCoord")
+        setOfCoord3D.setPrecedents(setOfTomograms)
+        setOfCoord3D.setSamplingRate(setOfTomograms.getSamplingRate())
+        setOfCoord3D.setBoxSize(int(round(self.boxSize.get() *
+                                          self._getRescaleFactor())))
+        return setOfCoord3D
+
+    def _getOutputSet(self):
+        """ Return the output set opened for appending,
+        creating it the first time. """
+        outputSet = getattr(self, self.OUTPUT_PREFIX, None)
+        if outputSet is not None:
+            outputSet.enableAppend()
+            return outputSet
+
+        outputSet = self._createCoordinatesSet()
+        outputSet.setStreamState(outputSet.STREAM_OPEN)
+        self._defineOutputs(**{self.OUTPUT_PREFIX: outputSet})
+        self._defineSourceRelation(self._getInputTomos(), outputSet)
+        return outputSet
+
+    def _resetOutput(self):
+        """ Remove the output and manifests of a previous run,
+        since all the tomograms will be picked again. """
+        outputSet = getattr(self, self.OUTPUT_PREFIX, None)
+        if outputSet is not None:
+            outputFn = outputSet.getFileName()
+            self.deleteOutput(outputSet)
+            pwutils.cleanPath(outputFn)
+        pwutils.cleanPattern(self._getExtraPath("*", "coordinates.json"))
+        pwutils.cleanPath(self._getExtraPath("timeline.jsonl"))
+
     def _hasMasks(self):
         return self.inputMasks.hasValue()
 
     def _getInputTomos(self):
         return self.inputTomos.get()
+
+    def _getInputTomo(self, tomoId):
+        for tomo in self._getInputTomos().iterItems(where=f"_tsId='{tomoId}'"):
+            return tomo.clone()
+
+    def _getInputMask(self, tomo):
+        """ Return the input mask matching a tomogram or None. """
+        if self._hasMasks():
+            tomoName = os.path.basename(tomo.getFileName())
+            for mask in self.inputMasks.get():
+                if os.path.basename(mask.getVolName()) == tomoName:
+                    return mask.clone()
+        return None
@@ -25,8 +25,11 @@
 # **************************************************************************
 
 import os
+import time
+from glob import glob, escape
 
 from pyworkflow import BETA
+import pyworkflow.utils as pwutils
 import pyworkflow.protocol.params as params
 from pwem.protocols import ProtCreateMask3D
 
@@ -34,7 +37,12 @@ from tomo.objects import SetOfTomoMasks, TomoMask
 
 from .. import Plugin
 from ..constants import TOMOTWIN_MODEL
-from ..convert import convertToMrc
+from ..cache import getStagingCache
+from ..convert import convertAllToMrc
+from ..scheduler import getGpuScheduler
+from ..tuning import getSizeProfile
+from ..estimator import countSubvolumes, estimateCost, formatCost, MASK_STRIDE
+from ..engine import medianEmbeddingMask
 
 
 class ProtTomoTwinCreateMasks(ProtCreateMask3D):
@@ -67,16 +75,51 @@ class ProtTomoTwinCreateMasks(ProtCreateMask3D):
                       label='ROI estimation based on:',
                       help='Estimate potential ROIs based on median '
                            'embedding (default) or intensity values.')
+        form.addParam('fromEmbeddings', params.BooleanParam, default=False,
+                      condition='roiEstimate == 0',
+                      label="Use existing embeddings?",
+                      help="Compute the median embedding masks on the CPU "
+                           "from the tomogram embeddings of a previous "
+                           "TomoTwin protocol, instead of embedding the "
+                           "tomograms again on the GPU.")
+        form.addParam('inputEmbeddings', params.PointerParam,
+                      pointerClass='ProtTomoTwinCreateMasks, '
+                                   'ProtTomoTwinRefPicking, '
+                                   'ProtTomoTwinClusterCreateUmaps',
+                      condition='roiEstimate == 0 and fromEmbeddings',
+                      label="Protocol with the embeddings",
+                      help="Embeddings must be of the same tomograms.")
+        form.addParam('maskThreshold', params.FloatParam, default=-1,
+                      condition='roiEstimate == 0 and fromEmbeddings',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Similarity threshold",
+                      help="Positions with a cosine similarity to the median "
+                           "embedding below this value are kept in the mask. "
+                           "Use -1 to find the threshold automatically "
+                           "(Otsu's method).")
+        form.addParam('showEstimate', params.BooleanParam, default=False,
+                      label="Show cost estimate before running?",
+                      help="Before the run starts, show the predicted number "
+                           "of subvolumes and wall time. Speeds are measured "
+                           "by previous runs on this host, or defaults if "
+                           "there are none.")
 
         form.addParallelSection(threads=1)
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
-        convertStepId = self._insertFunctionStep(self.convertInputStep)
         deps = []
         tomoIds = self.inputTomos.get().aggregate(["COUNT"], "_tsId", ["_tsId"])
         tomoIds = set([d['_tsId'] for d in tomoIds])
 
+        if self._useEmbeddings():
+            for tomoId in tomoIds:
+                deps.append(self._insertFunctionStep(self.createMaskFromEmbeddingsStep,
+                                                     tomoId, prerequisites=[]))
+            self._insertFunctionStep(self.createOutputStep, prerequisites=deps)
+            return
+
+        convertStepId = self._insertFunctionStep(self.convertInputStep)
         for tomoId in tomoIds:
             stepId = self._insertFunctionStep(self.createMaskStep, tomoId,
                                               prerequisites=convertStepId)
@@ -87,10 +130,13 @@ class ProtTomoTwinCreateMasks(ProtCreateMask3D):
     # --------------------------- STEPS functions -----------------------------
     def convertInputStep(self):
         """ Convert or link input files to mrc format. """
-        for tomo in self.inputTomos.get():
-            inputFn = tomo.getFileName()
-            tomoFn = self._getTmpPath(tomo.getTsId() + ".mrc")
-            convertToMrc(inputFn, tomoFn)
+        cache = getStagingCache(self)
+        inputTomos = self.inputTomos.get()
+        files = [(tomo.getFileName(), self._getTmpPath(tomo.getTsId() + ".mrc"))
+                 for tomo in inputTomos]
+        convertAllToMrc(files, cache, numWorkers=self.numberOfThreads.get(),
+                        voxelSize=inputTomos.getSamplingRate())
+        self.info(f"Staging {cache.getStats()}")
 
     def createMaskStep(self, tomoId):
         """ Create mask for each tomo. """
@@ -102,9 +148,45 @@ class ProtTomoTwinCreateMasks(ProtCreateMask3D):
             "-o ../extra/"
         ]
 
-        self.runJob(self.getProgram("tomotwin_tools.py"), " ".join(args),
-                    env=Plugin.getEnviron(),
-                    cwd=self._getTmpPath())
+        def _run(gpu=None):
+            start = time.time()
+            self.runJob(self.getProgram("tomotwin_tools.py", gpuId=gpu),
+                        " ".join(args), env=Plugin.getEnviron(),
+                        cwd=self._getTmpPath())
+            return time.time() - start
+
+        tomo = self._getInputTomo(tomoId)
+        if self.useQueue():
+            elapsed = _run()
+        else:
+            x, y, z = tomo.getDimensions()
+            elapsed = getGpuScheduler(self).run(_run, weight=x * y * z)
+
+        profile = getSizeProfile()
+        profile.addTiming(profile.getKey(Plugin.getVar(TOMOTWIN_MODEL), "rate_mask"),
+                          self._getSubvolumes(tomo), elapsed)
+
+    def createMaskFromEmbeddingsStep(self, tomoId):
+        """ Create the median embedding mask of a tomo from
+        an existing embedding, on the CPU. """
+        embeddingsFn = self._getSourceEmbeddingFn(tomoId)
+        tomo = self._getInputTomo(tomoId)
+        x, y, z = tomo.getDimensions()
+        # embeddings of rescaled tomograms
+        embeddedShape = None
+        sourceProt = self.inputEmbeddings.get()
+        if hasattr(sourceProt, "_isRescaled") and sourceProt._isRescaled():
+            ex, ey, ez = sourceProt._getStagedDims(tomo)
+            embeddedShape = (ez, ey, ex)
+
+        threshold = self.maskThreshold.get()
+        threshold, fraction = medianEmbeddingMask(
+            embeddingsFn, self._getExtraPath(f"{tomoId}_mask.mrc"), (z, y, x),
+            embeddedShape=embeddedShape,
+            threshold=None if threshold < 0 else threshold,
+            numThreads=self.numberOfThreads.get())
+        self.info(f"Mask of {tomoId} from {embeddingsFn}: similarity threshold "
+                  f"{threshold:.3f}, {100 * fraction:.1f}% of the voxels kept")
 
     def createOutputStep(self):
         inTomos = self.inputTomos.get()
@@ -121,7 +203,64 @@ class ProtTomoTwinCreateMasks(ProtCreateMask3D):
         self._defineOutputs(outputMasks=outputSet)
         self._defineSourceRelation(inTomos, outputSet)
 
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self._useEmbeddings() and not self.inputEmbeddings.hasValue():
+            errors.append("Select the protocol with the tomogram embeddings.")
+        return errors
+
+    def _warnings(self):
+        warnings = []
+        if self.showEstimate and not self._useEmbeddings():
+            warnings.append("Estimated cost:\n" + "\n".join(self._getCostSummary()))
+        return warnings
+
     # --------------------------- UTILS functions ------------------------------
-    def getProgram(self, program, gpu=True):
+    def getProgram(self, program, gpu=True, gpuId=None):
         return Plugin.getProgram(program, gpus=gpu,
-                                 useQueue=self.useQueue())
+                                 useQueue=self.useQueue(), gpuId=gpuId)
+
+    @staticmethod
+    def _getSubvolumes(tomo):
+        return countSubvolumes(tomo.getDimensions(), MASK_STRIDE)
+
+    def _getCostSummary(self):
+        profile = getSizeProfile()
+        rate = profile.getRate(profile.getKey(Plugin.getVar(TOMOTWIN_MODEL),
+                                              "rate_mask"))
+        gpus = len(pwutils.getListFromRangeString(self.gpuList.get()))
+        cost = estimateCost([self._getSubvolumes(tomo)
+                             for tomo in self.inputTomos.get().iterItems()],
+                            ["mask"], numGpus=gpus,
+                            rates={"mask": rate} if rate else None)
+        lines = [f"Subvolumes to embed: {cost['subvolumes']:,}",
+                 formatCost(cost)[-1]]
+        if rate is None:
+            lines.append("Default speed used (no previous runs on this host)")
+        return lines
+
+    def _useEmbeddings(self):
+        return self.roiEstimate.get() == 0 and self.fromEmbeddings.get()
+
+    def _getSourceEmbeddingFn(self, tomoId):
+        """ Embedding of a tomogram in the selected protocol. """
+        sourceProt = self.inputEmbeddings.get()
+        if getattr(sourceProt, "_getEmbeddingFn", None) is not None:
+            fns = [sourceProt._getEmbeddingFn(tomoId)]
+        else:
+            # tomo1 must not match tomo10_embeddings.temb
+            pattern = f"{escape(tomoId)}_embeddings*.temb"
+            fns = sorted(glob(sourceProt._getExtraPath("**", pattern),
+                              recursive=True))
+        fns = [fn for fn in fns if os.path.exists(fn)]
+        if not fns:
+            raise FileNotFoundError(f"No embedding of {tomoId} found in "
+                                    f"{sourceProt.getRunName()}")
+        if len(fns) > 1:
+            raise ValueError(f"Several embeddings of {tomoId} found in "
+                             f"{sourceProt.getRunName()}: {', '.join(fns)}")
+        return fns[0]
+
+    def _getInputTomo(self, tomoId):
+        return self.inputTomos.get().getItem("_tsId", tomoId).clone()
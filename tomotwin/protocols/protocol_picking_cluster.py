@@ -26,6 +26,7 @@
 
 import os
 import glob
+import shutil
 
 from pyworkflow import BETA
 from pyworkflow.utils import yellowStr, makePath, createAbsLink
@@ -33,7 +34,9 @@ import pyworkflow.protocol.params as params
 from tomo.objects import SetOfCoordinates3D
 
 from .. import Plugin
-from ..convert import convertToMrc
+from ..cache import getStagingCache
+from ..convert import readTable
+from ..engine import writeClusterTargets, MAX_CLUSTERS
 from .protocol_base import ProtTomoTwinBase
 
 
@@ -48,37 +51,111 @@ class ProtTomoTwinClusterPicking(ProtTomoTwinBase):
     _devStatus = BETA
     _possibleOutputs = {'output3DCoordinates': SetOfCoordinates3D}
 
+    def __init__(self, **kwargs):
+        ProtTomoTwinBase.__init__(self, **kwargs)
+        self.stepsExecutionMode = params.STEPS_PARALLEL
+
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
         form.addSection(label='Input')
         form.addParam("inputUmaps", params.PointerParam,
                       pointerClass="ProtTomoTwinClusterCreateUmaps",
                       label="Previous cluster picking protocol (step 1)")
+        form.addParam('autoTargets', params.BooleanParam, default=False,
+                      label="Select cluster targets automatically?",
+                      help="Cluster the UMAP of each tomogram with k-means, "
+                           "where the number of clusters is chosen "
+                           "automatically, instead of selecting the clusters "
+                           "in Napari. The mean embedding of each cluster, "
+                           "except the largest one (background), is used as "
+                           "a target. Tomograms are then processed in "
+                           "parallel without any interaction.")
+        form.addParam('maxClusters', params.IntParam, default=MAX_CLUSTERS,
+                      condition='autoTargets',
+                      label="Maximum number of clusters")
+        form.addParam('minClusterSize', params.IntParam, default=100,
+                      condition='autoTargets',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Minimum cluster size",
+                      help="Clusters with fewer embedded positions are "
+                           "not used as targets.")
+        form.addParam('sharedTargets', params.BooleanParam, default=False,
+                      label="Use the same cluster targets for all tomograms?",
+                      help="Select the cluster targets once, on a single "
+                           "tomogram or from a file, and map them against "
+                           "the embeddings of every tomogram. All the "
+                           "tomograms are then picked in parallel. The UMAP "
+                           "of step 1 is best fitted once for all tomograms.")
+        form.addParam('targetsTomoId', params.StringParam, default='',
+                      condition='sharedTargets',
+                      label="Tomogram to select the targets on",
+                      help="Tomogram id (tsId) of a representative tomogram. "
+                           "If empty, the first tomogram is used.")
+        form.addParam('targetsFile', params.FileParam, default='',
+                      condition='sharedTargets',
+                      label="Cluster targets file (optional)",
+                      help="Use the targets of an existing "
+                           "cluster_targets.temb file instead of "
+                           "selecting them.")
 
         self._definePickingParams(form)
 
+        form.addParallelSection(threads=1)
+        self._defineBudgetParams(form)
+
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
         self._createFilenameTemplates()
-        self._insertFunctionStep(self.convertInputStep)
+        convertStepId = self._insertFunctionStep(self.convertInputStep)
 
         tomoIds = self._getInputTomos().aggregate(["COUNT"], "_tsId", ["_tsId"])
-        tomoIds = set([d['_tsId'] for d in tomoIds])
+        tomoIds = sorted(set([d['_tsId'] for d in tomoIds]))
+        pickStepIds = []
+        # interactive sessions are opened one after the other,
+        # while the tomograms already clustered are picked
+        clustersStepId = convertStepId
+
+        if self.sharedTargets:
+            # targets are selected once and all tomograms picked in parallel
+            clustersStepId = self._insertSharedTargetsSteps(tomoIds, convertStepId)
 
         for tomoId in tomoIds:
             makePath(self._getExtraPath(tomoId))
-            self._insertFunctionStep(self.pickClustersStep, tomoId)
-            self._insertFunctionStep(self.pickingStep, tomoId)
+            if self.autoTargets and not self.sharedTargets:
+                clustersStepId = self._insertFunctionStep(self.autoClustersStep, tomoId,
+                                                          prerequisites=convertStepId)
+            elif not self.sharedTargets:
+                clustersStepId = self._insertFunctionStep(self.pickClustersStep, tomoId,
+                                                          prerequisites=clustersStepId)
+            pickStepIds.append(self._insertFunctionStep(self.pickingStep, tomoId,
+                                                        prerequisites=clustersStepId))
 
-        self._insertFunctionStep(self.createOutputStep)
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=pickStepIds)
+
+    def _insertSharedTargetsSteps(self, tomoIds, convertStepId):
+        """ Insert the steps selecting the targets of all tomograms. """
+        sourceFn = self.targetsFile.get()
+        stepId = convertStepId
+        if not sourceFn:
+            tomoId = self._getTargetsTomoId(tomoIds)
+            makePath(self._getExtraPath(tomoId))
+            selectStep = self.autoClustersStep if self.autoTargets else self.pickClustersStep
+            stepId = self._insertFunctionStep(selectStep, tomoId,
+                                              prerequisites=convertStepId)
+            sourceFn = self._getTomoClustersFn(tomoId)
+        return self._insertFunctionStep(self.shareTargetsStep,
+                                        os.path.abspath(sourceFn),
+                                        prerequisites=stepId)
 
     # --------------------------- STEPS functions -----------------------------
     def convertInputStep(self):
         """ Copy or link inputs to tmp. """
+        cache = getStagingCache(self)
         for tomo in self._getInputTomos():
-            inputFn = tomo.getFileName()
-            tomoFn = self._getTmpPath(tomo.getTsId() + ".mrc")
-            convertToMrc(inputFn, tomoFn)
+            self._stageVolume(tomo, tomo.getFileName(),
+                              self._getTmpPath(tomo.getTsId() + ".mrc"), cache)
+        self.info(f"Staging {cache.getStats()}")
 
     def pickClustersStep(self, tomoId):
         """ Link embeddings from the previous protocol and
@@ -111,44 +188,102 @@ class ProtTomoTwinClusterPicking(ProtTomoTwinBase):
 
         Plugin.runNapariBoxManager(self._getExtraPath(tomoId), "napari", args)
 
-    def pickingStep(self, tomoId):
-        """ Localize potential particles.  """
-        # map tomo
-        self.runProgram(self.getProgram("tomotwin_map.py", gpu=False),
-                        self._getMapArgs(tomoId))
+    def autoClustersStep(self, tomoId):
+        """ Cluster the UMAP of a tomogram and write its
+        cluster targets, without Napari. """
+        inputUmapsProt = self._getInputProt()
+        sizes = writeClusterTargets(
+            inputUmapsProt._getExtraPath(tomoId, f"{tomoId}_embeddings.tumap"),
+            inputUmapsProt._getEmbeddingFn(tomoId),
+            self._getTomoClustersFn(tomoId),
+            maxClusters=self.maxClusters.get(),
+            minSize=self.minClusterSize.get())
+        self.info(f"Cluster targets for {tomoId}: {len(sizes)} "
+                  f"(positions: {', '.join(map(str, sizes))})")
 
-        # locate particles
-        self.runProgram(self.getProgram("tomotwin_locate.py", gpu=False),
-                        self._getLocateArgs(tomoId))
+    def shareTargetsStep(self, sourceFn):
+        """ Copy the cluster targets used for all the tomograms. """
+        if not os.path.exists(sourceFn):
+            raise FileNotFoundError(f"Missing cluster targets: {sourceFn}")
+        shutil.copyfile(sourceFn, self._getSharedClustersFn())
+        self.info(f"Cluster targets for all tomograms from {sourceFn}: "
+                  f"{len(readTable(sourceFn))}")
 
-        # output coords
-        self.runProgram(self.getProgram("tomotwin_pick.py", gpu=False),
-                        self._getPickArgs(tomoId))
+    def pickingStep(self, tomoId):
+        clustersFn = self._getClustersFn(tomoId)
+        if os.path.exists(clustersFn) and not len(readTable(clustersFn)):
+            self.info(f"No cluster targets for {tomoId}, nothing to pick")
+            return
+        ProtTomoTwinBase.pickingStep(self, tomoId)
 
     # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self.sharedTargets:
+            targetsFn = self.targetsFile.get()
+            if targetsFn and not os.path.exists(targetsFn):
+                errors.append(f"Cluster targets file {targetsFn} not found.")
+            tomoId = self.targetsTomoId.get()
+            if (not targetsFn and tomoId and
+                    self._getInputTomos().getItem("_tsId", tomoId) is None):
+                errors.append(f"No tomogram {tomoId} in the input tomograms.")
+        errors.extend(self._validateBudget(picking=True))
+        return errors
+
     def _warnings(self):
-        return []
+        return self._warningsBudget(picking=True)
 
     def _methods(self):
         return []
 
     # --------------------------- UTILS functions ------------------------------
-    def _getMapArgs(self, tomoId):
-        clustersFn = self._getExtraPath(tomoId, "cluster_targets.temb")
+    def _getClustersFn(self, tomoId):
+        """ Cluster targets mapped against a tomogram. """
+        if self.sharedTargets:
+            return self._getSharedClustersFn()
+        return self._getTomoClustersFn(tomoId)
+
+    def _getTomoClustersFn(self, tomoId):
+        """ Cluster targets selected on a tomogram. """
+        return self._getExtraPath(tomoId, "cluster_targets.temb")
+
+    def _getSharedClustersFn(self):
+        return self._getExtraPath("cluster_targets.temb")
+
+    def _getTargetsTomoId(self, tomoIds):
+        return self.targetsTomoId.get() or tomoIds[0]
+
+    def _getEmbeddingFn(self, tomoId):
+        """ Embeddings are in step 1. """
+        return self._getInputProt()._getEmbeddingFn(tomoId)
+
+    def _getMapFiles(self, tomoId):
+        clustersFn = self._getClustersFn(tomoId)
         if not os.path.exists(clustersFn):
             raise FileNotFoundError(f"Missing file from Napari: {clustersFn}")
 
-        tomoEmbedded = self._getInputProt()._getExtraPath(f"embed/tomos/{tomoId}_embeddings.temb")
-
-        return [
-            f"distance -r {tomoId}/cluster_targets.temb",
-            f"-v {os.path.abspath(tomoEmbedded)}",
-            f"-o {tomoId}/"
-        ]
+        return (os.path.relpath(clustersFn, self._getExtraPath()),
+                os.path.abspath(self._getEmbeddingFn(tomoId)),
+                tomoId)
 
     def _getInputProt(self):
         return self.inputUmaps.get()
 
+    def _getCpuSlots(self):
+        """ No GPU steps here. """
+        return max(1, self.numberOfThreads.get() - 1)
+
+    def _getSubvolumes(self, tomo):
+        """ Tomograms are embedded in step 1. """
+        return self._getInputProt()._getSubvolumes(tomo)
+
     def _getInputTomos(self):
         """ Override base class. """
         return self._getInputProt().inputTomos.get()
+
+    def _getRescaleFactor(self):
+        """ Tomograms are staged as in step 1. """
+        return self._getInputProt()._getRescaleFactor()
+
+    def _getTargetSampling(self):
+        return self._getInputProt()._getTargetSampling()
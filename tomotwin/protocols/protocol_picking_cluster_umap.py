@@ -24,8 +24,12 @@
 # *
 # **************************************************************************
 
+import os
+import time
+
 from pyworkflow import BETA
 import pyworkflow.protocol.params as params
+from ..umap_tools import getUmapScript
 from .protocol_base import ProtTomoTwinBase
 
 
@@ -46,8 +50,24 @@ class ProtTomoTwinClusterCreateUmaps(ProtTomoTwinBase):
     def _defineParams(self, form):
         self._defineInputParams(form)
         self._defineEmbedParams(form)
+        form.addParam('sharedUmap', params.BooleanParam, default=False,
+                      label="Fit one UMAP for all tomograms?",
+                      help="Fit a single UMAP on a sample of all the "
+                           "tomograms (in proportion to their size) and only "
+                           "transform each tomogram with it, instead of "
+                           "fitting a UMAP per tomogram. All the tomograms "
+                           "then share the same 2D space.")
+        form.addParam('inputUmapProt', params.PointerParam,
+                      pointerClass='ProtTomoTwinClusterCreateUmaps',
+                      allowsNull=True, condition='sharedUmap',
+                      label="Reuse the UMAP of a previous run",
+                      help="Transform the tomograms with the UMAP fitted by "
+                           "a previous run with a shared UMAP, e.g. for "
+                           "tomograms added later, instead of fitting a "
+                           "new one.")
 
         form.addParallelSection(threads=1)
+        self._defineBudgetParams(form)
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
@@ -55,30 +75,138 @@ class ProtTomoTwinClusterCreateUmaps(ProtTomoTwinBase):
         convertStepId = self._insertFunctionStep(self.convertInputStep)
 
         tomoIds = self._getInputTomos().aggregate(["COUNT"], "_tsId", ["_tsId"])
-        tomoIds = set([d['_tsId'] for d in tomoIds])
+        tomoIds = sorted(set([d['_tsId'] for d in tomoIds]))
+
+        embedSteps = {}
+        for group in self._getTomoGroups(tomoIds):
+            if len(group) == 1:
+                tomoStep = self._insertFunctionStep(self.embedTomoStep, group[0],
+                                                    prerequisites=convertStepId)
+            else:
+                tomoStep = self._insertFunctionStep(self.embedTomosStep, *group,
+                                                    prerequisites=convertStepId)
+            if self.sharedUmap:
+                embedSteps.update({tomoId: tomoStep for tomoId in group})
+            else:
+                self._insertFunctionStep(self.createUmapsStep, *group,
+                                         prerequisites=tomoStep)
 
-        for tomoId in tomoIds:
-            tomoStep = self._insertFunctionStep(self.embedTomoStep, tomoId,
-                                                prerequisites=convertStepId)
-            self._insertFunctionStep(self.createUmapsStep, tomoId,
-                                     prerequisites=tomoStep)
+        if self.sharedUmap:
+            # the UMAP is fitted once, when all the tomograms are embedded
+            deps = []
+            if not self.inputUmapProt.hasValue():
+                deps.append(self._insertFunctionStep(self.fitUmapStep, *tomoIds,
+                                                     prerequisites=list(embedSteps.values())))
+            for tomoId in tomoIds:
+                self._insertFunctionStep(self.transformUmapStep, tomoId,
+                                         prerequisites=[embedSteps[tomoId]] + deps)
 
     # --------------------------- STEPS functions -----------------------------
-    def createUmapsStep(self, tomoId):
-        """ Estimate UMAP manifold and Generate Embedding Mask. """
-        self.runProgram(self.getProgram("tomotwin_tools.py"),
-                        self._getUmapArgs(tomoId))
+    def createUmapsStep(self, *tomoIds):
+        """ Estimate UMAP manifold and Generate Embedding Mask.
+        Several tomograms are processed by the same job. """
+        if len(tomoIds) == 1:
+            self._createUmap(tomoIds[0])
+            return
+
+        failed = [t for t in tomoIds if not os.path.exists(self._getEmbeddingFn(t))]
+        tomoIds = [t for t in tomoIds if t not in failed]
+        jobs = [{"id": tomoId, "program": "tomotwin_tools.py",
+                 "args": " ".join(self._getUmapArgs(tomoId)),
+                 "log": self._getJobLogFn(f"umap {tomoId}")}
+                for tomoId in tomoIds]
+        start = time.time()
+        results = (self.runBatchGpuProgram(jobs, label=f"umap {len(jobs)} tomograms")
+                   if jobs else {})
+        self._recordTiming("umap", sum(self._getSubvolumes(self._getInputTomo(t))
+                                       for t in tomoIds if results.get(t) == 0),
+                           time.time() - start)
+
+        for job in jobs:
+            tomoId = job["id"]
+            if results.get(tomoId) == 0:
+                continue
+            try:
+                if not self._isOutOfMemory(job["log"]):
+                    raise Exception(f"see {job['log']}")
+                self.info(f"UMAP of {tomoId} ran out of memory, retrying it alone")
+                self._createUmap(tomoId)
+            except Exception as e:
+                self.info(f"UMAP of {tomoId} failed: {e}")
+                failed.append(tomoId)
+
+        if failed:
+            raise Exception(f"UMAP failed for: {', '.join(failed)}")
+
+    def _createUmap(self, tomoId):
+        elapsed = self.runAdaptiveGpuProgram("tomotwin_tools.py",
+                                             lambda n: self._getUmapArgs(tomoId, n),
+                                             "fitSampleSize", label=f"umap {tomoId}")
+        self._recordTiming("umap", self._getSubvolumes(self._getInputTomo(tomoId)),
+                           elapsed)
+
+    def fitUmapStep(self, *tomoIds):
+        """ Fit the UMAP shared by all the tomograms. """
+        self.runAdaptiveGpuProgram(f"python {getUmapScript()}",
+                                   lambda n: self._getFitUmapArgs(tomoIds, n),
+                                   "fitSampleSize", label="umap fit")
+
+    def transformUmapStep(self, tomoId):
+        """ Create the UMAP of a tomogram with the shared model. """
+        start = time.time()
+        self.runGpuProgram(f"python {getUmapScript()}", [
+            f"transform -m {self._getUmapModelFn()}",
+            f"-i embed/tomos/{tomoId}_embeddings.temb",
+            f"-o {tomoId}/{tomoId}_embeddings.tumap",
+            f"--chunk_size {self._getSizeParam('chunkSize')}"
+        ], label=f"umap {tomoId}")
+        self._recordTiming("umap", self._getSubvolumes(self._getInputTomo(tomoId)),
+                           time.time() - start)
 
     # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self.sharedUmap and self.inputUmapProt.hasValue():
+            prot = self.inputUmapProt.get()
+            if not prot.sharedUmap or not os.path.exists(prot._getUmapModelFn()):
+                errors.append(f"{prot.getRunName()} has no shared UMAP.")
+        errors.extend(self._validateBudget(umap=True))
+        return errors
+
+    def _warningsExtra(self):
+        return self._warningsBudget(umap=True)
+
     def _summary(self):
         if self.isFinished():
-            return ["UMAP embeddings created for input tomograms."]
+            return (["UMAP embeddings created for input tomograms."] +
+                    self._getZRangeSummary())
 
     # --------------------------- UTILS functions ------------------------------
-    def _getUmapArgs(self, tomoId):
+    def _getCostStages(self):
+        return ["embed", "umap"]
+
+    def _getUmapModelFn(self):
+        if self.sharedUmap and self.inputUmapProt.hasValue():
+            return self.inputUmapProt.get()._getUmapModelFn()
+        return os.path.abspath(self._getExtraPath("umap", "model.pkl"))
+
+    def _getFitUmapArgs(self, tomoIds, fitSampleSize=None):
+        return [
+            "fit -i " + " ".join(f"embed/tomos/{tomoId}_embeddings.temb"
+                                 for tomoId in tomoIds),
+            f"-o {self._getUmapModelFn()}",
+            f"--fit_sample_size {fitSampleSize or self._getSizeParam('fitSampleSize')}"
+        ]
+
+    def _getUmapArgs(self, tomoId, fitSampleSize=None):
+        """ The chunk size is reduced in proportion to the sample size. """
+        startSize = self._getSizeParam("fitSampleSize")
+        fitSampleSize = fitSampleSize or startSize
+        chunkSize = max(1, self._getSizeParam("chunkSize") * fitSampleSize //
+                        max(1, startSize))
         return [
             f"umap -i embed/tomos/{tomoId}_embeddings.temb",
             f"-o {tomoId}/",
-            f"--fit_sample_size {self.fitSampleSize.get()}",
-            f"--chunk_size {self.chunkSize.get()}"
+            f"--fit_sample_size {fitSampleSize}",
+            f"--chunk_size {chunkSize}"
         ]
@@ -24,12 +24,24 @@
 # *
 # **************************************************************************
 
+import os
+import json
+import hashlib
+from glob import glob
+
 from pyworkflow import BETA
+from pyworkflow import utils as pwutils
 import pyworkflow.protocol.params as params
+from pwem.objects import Volume
 from tomo.objects import SetOfCoordinates3D
 
 from .. import Plugin
 from ..constants import TOMOTWIN_MODEL
+from ..cache import contentHash, fileFingerprint
+from ..convert import (readTable, writeTable, concatEmbeddings, mergeMaps,
+                       mergeEmbeddings)
+from ..engine import (mapEmbeddings, locateParticles, writeWindowsMask,
+                      insideWindows)
 from .protocol_base import ProtTomoTwinBase
 
 
@@ -50,36 +62,119 @@ class ProtTomoTwinRefPicking(ProtTomoTwinBase):
         self._defineInputParams(form)
         self._defineEmbedParams(form)
         self._definePickingParams(form)
+        form.addParam('reuseMaps', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Reuse maps from a previous run?",
+                      help="When the protocol is continued with more "
+                           "references, only the new references are "
+                           "embedded and mapped against the tomograms. "
+                           "Distances for the other references are taken "
+                           "from the previous maps.")
+        form.addParam('coarseToFine', params.BooleanParam, default=False,
+                      label="Coarse-to-fine embedding?",
+                      help="Embed the tomograms with a coarse stride, "
+                           "locate candidates with a relaxed global minimum "
+                           "and embed again with the fine stride (2) only "
+                           "in windows around them. Both embeddings are "
+                           "merged before the final picking. This is "
+                           "faster for sparse samples.")
+        line = form.addLine("Coarse pass", condition='coarseToFine',
+                            help="Stride of the coarse embedding (a multiple "
+                                 "of 2), global minimum of the candidates "
+                                 "and half-size (px) of the windows embedded "
+                                 "again around them.")
+        line.addParam('coarseStride', params.IntParam, default=8,
+                      label="Stride")
+        line.addParam('coarseMin', params.FloatParam, default=0.3,
+                      label="Global minimum")
+        line.addParam('refineMargin', params.IntParam, default=8,
+                      label="Window (px)")
 
         form.addParallelSection(threads=1)
+        self._defineBudgetParams(form)
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
         self._createFilenameTemplates()
-        convertStepId = self._insertFunctionStep(self.convertInputStep)
-        deps = []
+        convertStepId = self._insertFunctionStep(self.convertInputStep,
+                                                 self._getRefsSignature())
         embedRefStepId = self._insertFunctionStep(self.embedRefsStep,
                                                   prerequisites=convertStepId)
-        deps.append(embedRefStepId)
 
-        tomoIds = self._getInputTomos().aggregate(["COUNT"], "_tsId", ["_tsId"])
-        tomoIds = set([d['_tsId'] for d in tomoIds])
+        # GPU pool: embedding steps are chained in one lane per GPU, so
+        # at most one embedding per GPU is ready at a time and the other
+        # step threads (CPU pool) pick the tomograms already embedded.
+        # Largest tomograms are embedded first. The coarse-to-fine
+        # embedding needs the references in all the lanes.
+        lanes = [embedRefStepId] + [embedRefStepId if self.coarseToFine
+                                    else convertStepId] * (self._getGpuSlots() - 1)
+        tomoIds = sorted(((self._getTomoWeight(tomo), tomo.getTsId())
+                          for tomo in self._getInputTomos().iterItems()),
+                         reverse=True)
+        pickStepIds = []
+
+        groups = self._getTomoGroups([tomoId for _, tomoId in tomoIds])
 
-        for tomoId in tomoIds:
-            embedTomoStepId = self._insertFunctionStep(self.embedTomoStep,
-                                                       tomoId,
-                                                       prerequisites=convertStepId)
-            deps.append(embedTomoStepId)
-            self._insertFunctionStep(self.pickingStep, tomoId,
-                                     prerequisites=deps)
+        for i, group in enumerate(groups):
+            lane = i % len(lanes)
+            if len(group) == 1:
+                embedTomoStepId = self._insertFunctionStep(self.embedTomoStep,
+                                                           group[0],
+                                                           prerequisites=[convertStepId,
+                                                                          lanes[lane]])
+            else:
+                embedTomoStepId = self._insertFunctionStep(self.embedTomosStep,
+                                                           *group,
+                                                           prerequisites=[convertStepId,
+                                                                          lanes[lane]])
+            lanes[lane] = embedTomoStepId
+            for tomoId in group:
+                pickStepIds.append(
+                    self._insertFunctionStep(self.pickingStep, tomoId,
+                                             prerequisites=[embedTomoStepId,
+                                                            embedRefStepId]))
 
-        self._insertFunctionStep(self.createOutputStep)
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=pickStepIds)
 
     # --------------------------- STEPS functions -----------------------------
     def embedRefsStep(self):
-        """ Embed the references. """
-        self.runProgram(self.getProgram("tomotwin_embed.py"),
-                        self._getEmbedRefsArgs())
+        """ Embed the references. Embeddings are cached per reference,
+        so only references not seen before are embedded. """
+        cache = self._getEmbeddingCache()
+        refFns = self._getRefFiles()
+        refKeys = self._getRefKeys()
+        missing = [fn for fn, key in zip(refFns, refKeys)
+                   if cache.lookup(key, ".temb") is None]
+
+        if missing:
+            self.info(f"Embedding {len(missing)} of {len(refFns)} references")
+            newRefsDir = self._getTmpPath("new_refs")
+            pwutils.cleanPath(newRefsDir)
+            pwutils.makePath(newRefsDir)
+            for fn in missing:
+                pwutils.createAbsLink(os.path.abspath(fn),
+                                      os.path.join(newRefsDir, os.path.basename(fn)))
+
+            self.runAdaptiveGpuProgram(
+                "tomotwin_embed.py",
+                lambda b: self._getEmbedRefsArgs("../tmp/new_refs/*.mrc",
+                                                 "embed/refs_new", batchSize=b),
+                "batchRefs", label="embed references")
+
+            newEmbeddings = readTable(self._getExtraPath("embed/refs_new/embeddings.temb"))
+            newNames = [os.path.basename(fn) for fn in newEmbeddings["filepath"]]
+            for fn in missing:
+                row = newEmbeddings.iloc[[newNames.index(os.path.basename(fn))]]
+                cache.get(refKeys[refFns.index(fn)], ".temb",
+                          lambda outFn, row=row: writeTable(row, outFn))
+
+        embeddings = concatEmbeddings(
+            [readTable(cache.get(key, ".temb", self._missingRefEmbedding))
+             for key in refKeys],
+            filepaths=[f"../tmp/input_refs/{os.path.basename(fn)}" for fn in refFns])
+        writeTable(embeddings, self._getExtraPath("embed/refs/embeddings.temb"))
+        self.info(f"Embedding {cache.getStats()}")
 
     # --------------------------- INFO functions ------------------------------
     def _validate(self):
@@ -88,16 +183,30 @@ class ProtTomoTwinRefPicking(ProtTomoTwinBase):
         refs = self.inputRefs.get()
         scale = refs.getSamplingRate() / self._getInputTomos().getSamplingRate()
         doScale = abs(scale - 1.0) > 0.001
-        if doScale:
-            errors.append("Tomograms and references must have the same pixel size!")
+        if doScale and not self.rescale:
+            errors.append("Tomograms and references must have the same "
+                          "pixel size, unless they are rescaled!")
 
+        if self.coarseToFine and (self.coarseStride.get() <= self._getStride() or
+                                  self.coarseStride.get() % self._getStride()):
+            errors.append(f"The coarse stride must be a multiple of "
+                          f"{self._getStride()} and larger than it.")
+
+        errors.extend(self._validateBudget(picking=True))
         return errors
 
     def _warningsExtra(self):
         warnings = []
 
+        gpus = self._getGpuSlots()
+        if not self.useQueue() and 1 < self.numberOfThreads <= gpus + 1:
+            warnings.append(f"With {self.numberOfThreads.get()} threads and "
+                            f"{gpus} GPU(s), picking of embedded tomograms will "
+                            f"wait for the embedding of the others. Use at "
+                            f"least {gpus + 2} threads to overlap them.")
+
         refs = self.inputRefs.get()
-        if refs.getXDim() != 37:
+        if refs.getXDim() != 37 and not self.rescale:
             warnings.append("Because TomoTwin was trained on many proteins at "
                             "once, we needed to find a box size that worked "
                             "for all proteins. Therefore, all proteins were "
@@ -114,20 +223,174 @@ class ProtTomoTwinRefPicking(ProtTomoTwinBase):
                             "bigger, however we’ve found that for proteins down "
                             "to 100 kDa, 10Å/pix is sufficient for the 37 box.")
 
+        warnings.extend(self._warningsBudget(picking=True))
         return warnings
 
     # --------------------------- UTILS functions ------------------------------
-    def _getEmbedRefsArgs(self):
+    def _getEmbedRefsArgs(self, refs="../tmp/input_refs/*.mrc",
+                          outputDir="embed/refs", batchSize=None):
         return [
             f"subvolumes -m {Plugin.getVar(TOMOTWIN_MODEL)}",
-            "-v ../tmp/input_refs/*.mrc",
-            f"-b {self.batchRefs.get()}",
-            "-o embed/refs"
+            f"-v {refs}",
+            f"-b {batchSize or self.batchRefs.get()}",
+            f"-o {outputDir}"
         ]
 
-    def _getMapArgs(self, tomoId):
-        return [
-            "distance -r embed/refs/embeddings.temb",
-            f"-v embed/tomos/{tomoId}_embeddings.temb",
-            f"-o {tomoId}/"
-        ]
+    def _embedTomo(self, tomoId):
+        """ Coarse-to-fine embedding: embed with the coarse stride, locate
+        the candidates and embed with the fine stride only around them. """
+        if not self.coarseToFine:
+            return ProtTomoTwinBase._embedTomo(self, tomoId)
+
+        tomo = self._getInputTomo(tomoId)
+        weight = self._getTomoWeight(tomo)
+        seconds = self.runAdaptiveGpuProgram(
+            "tomotwin_embed.py",
+            lambda b: self._getEmbedTomoArgs(tomoId, batchSize=b,
+                                             stride=self.coarseStride.get(),
+                                             outputDir="embed/coarse"),
+            "batchTomos", weight=weight, label=f"embed {tomoId} coarse")
+        tables = [readTable(self._getExtraPath(f"embed/coarse/{tomoId}_embeddings.temb"))]
+        subvolumes = len(tables[0])
+
+        candidates = self._locateCandidates(tomoId)
+        if len(candidates):
+            # coarse rows left between the windows would be isolated
+            # peaks on the fine grid
+            coarse = tables[0]
+            tables[0] = coarse[insideWindows(coarse[["X", "Y", "Z"]].to_numpy(),
+                                             candidates, self.refineMargin.get())]
+            maskFn = f"refine/{tomoId}_mask.mrc"
+            pwutils.makePath(self._getExtraPath("refine"))
+            x, y, z = self._getStagedDims(tomo)
+            inputMaskFn = self._getTmpPath(f"input_masks/{tomoId}_mask.mrc")
+            fraction = writeWindowsMask(candidates, (z, y, x),
+                                        self.refineMargin.get(),
+                                        self._getExtraPath(maskFn),
+                                        inputMaskFn if os.path.exists(inputMaskFn)
+                                        else None)
+            self.info(f"{len(candidates)} candidates in {tomoId}, embedding "
+                      f"{100 * fraction:.1f}% of the tomogram again")
+            seconds += self.runAdaptiveGpuProgram(
+                "tomotwin_embed.py",
+                lambda b: self._getEmbedTomoArgs(tomoId, batchSize=b,
+                                                 outputDir="embed/refine",
+                                                 maskFn=maskFn),
+                "batchTomos", weight=weight * fraction,
+                label=f"embed {tomoId} refine")
+            tables.append(readTable(self._getExtraPath(f"embed/refine/{tomoId}_embeddings.temb")))
+            subvolumes += len(tables[-1])
+        else:
+            self.info(f"No candidates found in {tomoId}")
+
+        writeTable(mergeEmbeddings(tables), self._getEmbeddingFn(tomoId))
+        return subvolumes, seconds
+
+    def _locateCandidates(self, tomoId):
+        """ Positions (xyz) of the peaks of the coarse embedding above
+        the relaxed global minimum, for all the references. """
+        coarseDir = self._getExtraPath(tomoId, "coarse")
+        mapEmbeddings(self._getExtraPath("embed/refs/embeddings.temb"),
+                      self._getExtraPath(f"embed/coarse/{tomoId}_embeddings.temb"),
+                      os.path.join(coarseDir, "map.tmap"),
+                      numThreads=self._getNumCpus())
+        located = locateParticles(os.path.join(coarseDir, "map.tmap"), coarseDir,
+                                  tolerance=self.tolerance.get(),
+                                  boxSize=self.boxSize.get(),
+                                  globalMin=self.coarseMin.get(),
+                                  numProcesses=self._getNumCpus())
+        return located[["X", "Y", "Z"]].to_numpy()
+
+    def _getRefineKey(self):
+        if not self.coarseToFine:
+            return None
+        return {"stride": self.coarseStride.get(),
+                "globalMin": self.coarseMin.get(),
+                "margin": self.refineMargin.get(),
+                "tolerance": self.tolerance.get(),
+                "boxSize": self.boxSize.get(),
+                "references": self._getRefKeys()}
+
+    def _getTomoGroups(self, tomoIds):
+        """ Coarse-to-fine embeddings are run per tomogram. """
+        if self.coarseToFine:
+            return [[tomoId] for tomoId in tomoIds]
+        return ProtTomoTwinBase._getTomoGroups(self, tomoIds)
+
+    def _mapTomo(self, tomoId):
+        """ Map only the references missing from a previous map
+        of the same tomogram embedding and merge the results. """
+        mapFn = self._getExtraPath(tomoId, "map.tmap")
+        infoFn = self._getExtraPath(tomoId, "map.json")
+        embeddingKey = self._getEmbeddingKey(tomoId)
+        refKeys = self._getRefKeys()
+        prevKeys = []
+
+        if self.reuseMaps and os.path.exists(mapFn) and os.path.exists(infoFn):
+            with open(infoFn) as f:
+                info = json.load(f)
+            if info["embedding"] == embeddingKey:
+                prevKeys = info["references"]
+
+        missing = [key for key in refKeys if key not in prevKeys]
+        if len(missing) == len(refKeys):
+            ProtTomoTwinBase._mapTomo(self, tomoId)
+        else:
+            refs = readTable(self._getExtraPath("embed/refs/embeddings.temb"))
+            prevMap = readTable(mapFn)
+            newMap = None
+            if missing:
+                self.info(f"Mapping {len(missing)} new references for {tomoId}")
+                newRefsFn = self._getExtraPath(tomoId, "new_refs.temb")
+                writeTable(refs.iloc[[refKeys.index(k) for k in missing]], newRefsFn)
+                self._runMap(f"{tomoId}/new_refs.temb",
+                             f"embed/tomos/{tomoId}_embeddings.temb",
+                             f"{tomoId}/new_map")
+                newMap = readTable(self._getExtraPath(tomoId, "new_map", "map.tmap"))
+
+            columns = [(newMap, missing.index(key)) if key in missing
+                       else (prevMap, prevKeys.index(key)) for key in refKeys]
+            mergeMaps(columns, mapFn, references=refs["filepath"].tolist())
+
+        with open(infoFn, "w") as f:
+            json.dump({"embedding": embeddingKey, "references": refKeys}, f)
+
+    def _getNumRefs(self):
+        refs = self.inputRefs.get()
+        return 1 if isinstance(refs, Volume) else refs.getSize()
+
+    def _getCostStages(self):
+        return ["embed", "picking"]
+
+    def _getRefFiles(self):
+        return sorted(glob(self._getTmpPath("input_refs", "*.mrc")))
+
+    def _getRefKeys(self):
+        """ Cache keys of the references embeddings, in the same
+        order as _getRefFiles. """
+        if getattr(self, "_refKeys", None) is None:
+            cache = self._getEmbeddingCache()
+            self._refKeys = [cache.getKey(ref=contentHash(fn),
+                                          model=Plugin.getVar(TOMOTWIN_MODEL),
+                                          version=Plugin.getActiveVersion())
+                             for fn in self._getRefFiles()]
+        return self._refKeys
+
+    def _getRefsSignature(self):
+        """ Identify the input references, so that the protocol
+        can be continued when they change. """
+        refs = self.inputRefs.get()
+        if isinstance(refs, Volume):
+            refs = [refs]
+        fns = sorted(fileFingerprint(vol.getFileName()) for vol in refs)
+        return hashlib.sha1(" ".join(fns).encode()).hexdigest()
+
+    @staticmethod
+    def _missingRefEmbedding(fn):
+        raise FileNotFoundError(f"Reference embedding was evicted from "
+                                f"the cache: {fn}")
+
+    def _getMapFiles(self, tomoId):
+        return ("embed/refs/embeddings.temb",
+                f"embed/tomos/{tomoId}_embeddings.temb",
+                tomoId)
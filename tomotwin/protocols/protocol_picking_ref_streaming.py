@@ -0,0 +1,194 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+from glob import glob
+
+from pyworkflow import BETA
+from pyworkflow.protocol import ProtStreamingBase
+import pyworkflow.utils as pwutils
+from tomo.objects import SetOfCoordinates3D
+
+from ..cache import getStagingCache
+from .protocol_picking_ref import ProtTomoTwinRefPicking
+
+
+class ProtTomoTwinRefPickingStreaming(ProtTomoTwinRefPicking,
+                                      ProtStreamingBase):
+    """ Reference-based picking with TomoTwin in streaming.
+
+    New tomograms of the input set are converted, embedded and picked
+    as they arrive. Their coordinates are appended to the output
+    by the picking step as soon as they are located. A tomogram that
+    fails does not stop the others, the protocol fails once the
+    output is closed. Failed tomograms are recorded in their extra
+    folder, so they are still reported (and not picked again) when
+    the protocol is continued.
+    """
+
+    _label = 'reference-based picking (streaming)'
+    _devStatus = BETA
+    _possibleOutputs = {'output3DCoordinates': SetOfCoordinates3D}
+    STREAM_SLEEP = 60  # seconds between input checks
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        ProtTomoTwinRefPicking._defineParams(self, form)
+        form.getParam('numberOfThreads').default.set(3)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._createFilenameTemplates()
+        ProtStreamingBase._insertAllSteps(self)
+
+    def stepsGeneratorStep(self):
+        """ Insert the steps for each new input tomogram
+        until the input set is closed. Tomograms already in the
+        output or failed (e.g. when the protocol is resumed) are
+        skipped. """
+        insertedIds = self._getPublishedIds() | self._getFailedIds()
+        pickStepIds = []
+        convertRefsStepId = self._insertFunctionStep(self.convertRefsStep,
+                                                     prerequisites=[])
+        embedRefsStepId = self._insertFunctionStep(self.embedRefsStep,
+                                                   prerequisites=convertRefsStepId)
+
+        while True:
+            inputTomos = self._getInputTomos()
+            streamClosed = inputTomos.isStreamClosed()
+            newIds = [tomo.getTsId() for tomo in inputTomos.iterItems()
+                      if tomo.getTsId() not in insertedIds]
+            inputTomos.close()
+
+            for tomoId in newIds:
+                self.info(f"Inserting steps for new tomogram {tomoId}")
+                convertStepId = self._insertFunctionStep(self.convertTomoStep, tomoId,
+                                                         prerequisites=[])
+                embedDeps = [convertStepId]
+                if self.coarseToFine:
+                    embedDeps.append(embedRefsStepId)
+                embedStepId = self._insertFunctionStep(self.embedTomoStep, tomoId,
+                                                       prerequisites=embedDeps)
+                pickStepIds.append(
+                    self._insertFunctionStep(self.pickingStep, tomoId,
+                                             prerequisites=[embedStepId,
+                                                            embedRefsStepId]))
+                insertedIds.add(tomoId)
+
+            # the state is read before the items, all were seen
+            if streamClosed:
+                break
+            time.sleep(self.STREAM_SLEEP)
+
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=pickStepIds)
+
+    # --------------------------- STEPS functions -----------------------------
+    def convertRefsStep(self):
+        cache = getStagingCache(self)
+        self._convertRefs(cache)
+        self.info(f"Staging {cache.getStats()}")
+
+    def convertTomoStep(self, tomoId):
+        def _convert():
+            cache = getStagingCache(self)
+            self._convertTomo(self._getInputTomo(tomoId), cache)
+            self.info(f"Staging {cache.getStats()}")
+
+        self._runTomoStep(tomoId, _convert)
+
+    def embedTomoStep(self, tomoId):
+        self._runTomoStep(
+            tomoId, lambda: ProtTomoTwinRefPicking.embedTomoStep(self, tomoId))
+
+    def pickingStep(self, tomoId):
+        def _pick():
+            ProtTomoTwinRefPicking.pickingStep(self, tomoId)
+            if not os.path.exists(self._getTlocFn(tomoId)):
+                raise FileNotFoundError(f"Missing {self._getTlocFn(tomoId)}")
+
+        self._runTomoStep(tomoId, _pick)
+
+    def createOutputStep(self, fromViewer=False):
+        """ Close the output, then report the failed tomograms. """
+        ProtTomoTwinRefPicking.createOutputStep(self, fromViewer)
+        failedIds = self._getFailedIds()
+        if failedIds and not fromViewer:
+            raise Exception(f"Picking failed for {len(failedIds)} "
+                            f"tomograms: {', '.join(sorted(failedIds))}")
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = ProtTomoTwinRefPicking._validate(self)
+        if self.numberOfThreads < 2:
+            errors.append("At least 2 threads are required: one for "
+                          "checking the input and one for processing.")
+        return errors
+
+    # --------------------------- UTILS functions ------------------------------
+    def _runTomoStep(self, tomoId, func):
+        """ Run a step of a tomogram. A failure is recorded instead of
+        failing the step, so that the steps of the other tomograms and
+        createOutputStep still run. """
+        failedFn = self._getFailedFn(tomoId)
+        if os.path.exists(failedFn):
+            self.info(f"Skipping {tomoId}, a previous step failed")
+            return
+        try:
+            func()
+        except Exception as e:
+            self.error(f"Processing of {tomoId} failed: {e}")
+            pwutils.makePath(os.path.dirname(failedFn))
+            with open(failedFn, "w") as f:
+                json.dump({"tomoId": tomoId, "error": str(e)}, f)
+
+    def _getPublishedIds(self):
+        """ Tomograms whose coordinates are already in the output. """
+        return {self._readManifest(fn)["tomoId"]
+                for fn in glob(self._getExtraPath("*", "coordinates.json"))}
+
+    def _getFailedIds(self):
+        """ Tomograms with a failed step. """
+        return {self._readManifest(fn)["tomoId"]
+                for fn in glob(self._getExtraPath("*", "failed.json"))}
+
+    def _getFailedFn(self, tomoId):
+        return self._getExtraPath(tomoId, "failed.json")
+
+    def _getInputTomos(self):
+        """ Override base class: read the input set again
+        from disk to see new items. """
+        inputTomos = self.inputTomos.get().clone()
+        inputTomos.loadAllProperties()
+        return inputTomos
+
+    def _getInputTomo(self, tomoId):
+        inputTomos = self._getInputTomos()
+        tomo = inputTomos.getItem("_tsId", tomoId).clone()
+        inputTomos.close()
+        return tomo
@@ -0,0 +1,248 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+""" Rescaling of tomograms, masks and references to the pixel size
+TomoTwin was trained on, done while they are staged.
+
+Volumes are resampled by cropping (or zero padding) their Fourier
+transform. The transform is separable, so a tomogram is processed in
+two passes that only need a slab in memory: each z slice is resampled
+in xy into an intermediate file, then each block of y rows is
+resampled along z into the output mrc. Slabs and blocks are
+distributed over a pool of processes. """
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import pyworkflow.utils as pwutils
+
+from .convert import isMrcFile, _mapVolume, _convertImage, MRC_HEADER_BYTES
+
+TARGET_SAMPLING = 10.0
+REF_BOX = 37
+RESCALE_TOLERANCE = 0.01
+RESCALE_SLAB_BYTES = 128 * 1024 ** 2
+
+
+def getScaleFactor(sampling, targetSampling=TARGET_SAMPLING):
+    """ Factor from input to rescaled pixels, > 1 for binning. """
+    return targetSampling / sampling
+
+
+def needsRescale(factor):
+    return abs(factor - 1.) > RESCALE_TOLERANCE
+
+
+def getRescaledShape(shape, factor):
+    """ Dimensions (in any order) of a volume rescaled by factor. """
+    return tuple(max(1, int(round(n / factor))) for n in shape)
+
+
+def getCoordScale(dims, factor):
+    """ Per-axis factors that take coordinates from the rescaled
+    volume back to the input one, in the order of dims. Sample i of
+    the rescaled volume is at position i * n / m of the input. """
+    dims = np.asarray(dims, dtype=np.float64)
+    return dims / np.asarray(getRescaledShape(dims, factor))
+
+
+def resampleAxis(data, n, axis, nearest=False):
+    """ Resample an array to n samples along axis. By default the
+    Fourier transform is cropped or zero padded, which keeps the mean.
+    With nearest, the nearest samples are taken (e.g. for masks). """
+    size = data.shape[axis]
+    if n == size:
+        return np.asarray(data, dtype=np.float32)
+
+    if nearest:
+        index = np.minimum(np.round(np.arange(n) * size / n).astype(int),
+                           size - 1)
+        return np.take(data, index, axis=axis).astype(np.float32)
+
+    spectrum = np.fft.rfft(data, axis=axis)
+    shape = list(spectrum.shape)
+    shape[axis] = n // 2 + 1
+    resized = np.zeros(shape, dtype=spectrum.dtype)
+    keep = [slice(None)] * data.ndim
+    keep[axis] = slice(0, min(n, size) // 2 + 1)
+    resized[tuple(keep)] = spectrum[tuple(keep)]
+    return (np.fft.irfft(resized, n=n, axis=axis) * (n / size)).astype(np.float32)
+
+
+def resampleVolume(data, shape, nearest=False):
+    """ Resample a whole (z, y, x) array to shape. """
+    for axis, n in enumerate(shape):
+        data = resampleAxis(data, n, axis, nearest)
+    return data
+
+
+def _openVolume(fn):
+    """ Read-only memory map of a MRC, SPIDER or EM volume,
+    or None for other formats. """
+    if pwutils.getExt(fn) == ".mrc" or isMrcFile(fn):
+        import mrcfile
+        from mrcfile.utils import data_dtype_from_header
+        with mrcfile.open(fn, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            dtype = data_dtype_from_header(header)
+            shape = (int(header.nz), int(header.ny), int(header.nx))
+            offset = MRC_HEADER_BYTES + int(header.nsymbt)
+        return np.memmap(fn, dtype=dtype, mode="r", offset=offset, shape=shape)
+    return _mapVolume(fn)
+
+
+def _resampleSlices(inputFn, tmpFn, tmpShape, z0, z1, nearest):
+    """ First pass: resample slices z0:z1 in xy. """
+    data = _openVolume(inputFn)
+    _, ny, nx = tmpShape
+    values = resampleAxis(np.asarray(data[z0:z1], dtype=np.float32), ny, 1, nearest)
+    values = resampleAxis(values, nx, 2, nearest)
+    output = np.memmap(tmpFn, dtype=np.float32, mode="r+", shape=tmpShape)
+    output[z0:z1] = values
+    output.flush()
+
+
+def _resampleRows(tmpFn, tmpShape, outputFn, offset, dtype, nz, y0, y1, nearest):
+    """ Second pass: resample rows y0:y1 along z. Return the
+    min, max and sum of the written values. """
+    data = np.memmap(tmpFn, dtype=np.float32, mode="r", shape=tmpShape)
+    values = resampleAxis(np.asarray(data[:, y0:y1]), nz, 0, nearest)
+    shape = (nz,) + tmpShape[1:]
+    output = np.memmap(outputFn, dtype=dtype, mode="r+", offset=offset, shape=shape)
+    output[:, y0:y1] = values
+    output.flush()
+    return values.min(), values.max(), values.sum(dtype=np.float64)
+
+
+def _runTasks(func, tasks, numProcesses):
+    if numProcesses > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=numProcesses) as executor:
+            futures = [executor.submit(func, *task) for task in tasks]
+            return [f.result() for f in futures]
+    return [func(*task) for task in tasks]
+
+
+def rescaleVolume(inputFn, outputFn, shape, nearest=False, numProcesses=1,
+                  voxelSize=None, slabBytes=RESCALE_SLAB_BYTES):
+    """ Resample a volume to shape (z, y, x) and write it as float32
+    mrc. The volume is streamed in slabs of about slabBytes, so
+    the memory used is bounded by numProcesses slabs. """
+    import mrcfile
+    data = _openVolume(inputFn)
+    convertedFn = None
+    if data is None:
+        # formats without a known layout are converted first
+        convertedFn = outputFn + ".input.mrc"
+        _convertImage(inputFn, convertedFn)
+        inputFn = convertedFn
+        data = _openVolume(inputFn)
+
+    inZ, inY, inX = data.shape
+    nz, ny, nx = shape
+    tmpShape = (inZ, ny, nx)
+    tmpFn = outputFn + ".xy.part"
+    partFn = outputFn + ".part.mrc"
+
+    try:
+        np.memmap(tmpFn, dtype=np.float32, mode="w+", shape=tmpShape).flush()
+        slab = max(1, slabBytes // (inY * inX * 4))
+        _runTasks(_resampleSlices,
+                  [(inputFn, tmpFn, tmpShape, z, min(z + slab, inZ), nearest)
+                   for z in range(0, inZ, slab)], numProcesses)
+
+        with mrcfile.new_mmap(partFn, shape=tuple(shape), mrc_mode=2,
+                              overwrite=True) as mrc:
+            offset = MRC_HEADER_BYTES + int(mrc.header.nsymbt)
+            dtype = mrc.data.dtype.str
+
+        rows = max(1, slabBytes // (max(inZ, nz) * nx * 4))
+        stats = _runTasks(_resampleRows,
+                          [(tmpFn, tmpShape, partFn, offset, dtype, nz, y,
+                            min(y + rows, ny), nearest)
+                           for y in range(0, ny, rows)], numProcesses)
+
+        with mrcfile.mmap(partFn, mode="r+") as mrc:
+            mrc.header.dmin = min(s[0] for s in stats)
+            mrc.header.dmax = max(s[1] for s in stats)
+            mrc.header.dmean = sum(s[2] for s in stats) / (nz * ny * nx)
+            if voxelSize:
+                mrc.voxel_size = voxelSize
+        os.replace(partFn, outputFn)
+    finally:
+        pwutils.cleanPath(tmpFn, partFn)
+        if convertedFn:
+            pwutils.cleanPath(convertedFn)
+
+
+def rescaleToMrc(inputFn, outputFn, shape, cache=None, nearest=False,
+                 numProcesses=1, voxelSize=None):
+    """ Rescale a tomogram (or mask) to shape (z, y, x). If a
+    StagingCache is provided, the rescaled file is taken from (or
+    added to) the cache and linked to outputFn. """
+    def _rescale(inFn, outFn):
+        rescaleVolume(inFn, outFn, shape, nearest=nearest,
+                      numProcesses=numProcesses, voxelSize=voxelSize)
+
+    if cache is not None:
+        variant = f"rescale {'x'.join(map(str, shape))} {nearest}"
+        cache.stage(inputFn, outputFn, _rescale, variant=variant)
+    else:
+        _rescale(inputFn, outputFn)
+
+
+def fitBox(data, box):
+    """ Crop or pad (with the mean) a (z, y, x) array
+    around its center to a cube of size box. """
+    result = np.full((box,) * 3, data.mean(), dtype=np.float32)
+    src, dst = [], []
+    for n in data.shape:
+        size = min(n, box)
+        start = (n - size) // 2
+        dstStart = (box - size) // 2
+        src.append(slice(start, start + size))
+        dst.append(slice(dstStart, dstStart + size))
+    result[tuple(dst)] = data[tuple(src)]
+    return result
+
+
+def rescaleReference(inputFn, outputFn, factor, box=REF_BOX, voxelSize=None):
+    """ Resample a reference by factor and crop or pad it to box. """
+    import mrcfile
+    data = _openVolume(inputFn)
+    if data is None:
+        _convertImage(inputFn, outputFn)
+        data = _openVolume(outputFn)
+    data = np.array(data, dtype=np.float32)
+
+    if needsRescale(factor):
+        data = resampleVolume(data, getRescaledShape(data.shape, factor))
+    data = fitBox(data, box)
+
+    with mrcfile.new(outputFn, data, overwrite=True) as mrc:
+        if voxelSize:
+            mrc.voxel_size = voxelSize
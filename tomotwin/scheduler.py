@@ -0,0 +1,238 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+
+import pyworkflow.utils as pwutils
+
+
+class GpuScheduler:
+    """ Give each GPU job exactly one free device from a list.
+    Jobs wait while all devices are busy. When a device becomes free,
+    the heaviest waiting job (e.g. the largest tomogram) gets it, and
+    among free devices the one with the lowest accumulated load is used.
+    """
+    def __init__(self, gpus):
+        if not gpus:
+            raise ValueError("At least one GPU is required")
+        self.gpus = list(gpus)
+        self.load = {gpu: 0 for gpu in self.gpus}
+        self._busy = set()
+        self._waiting = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def _isNext(self, ticket):
+        """ Heaviest job first, then first come first served. """
+        return ticket == min(self._waiting, key=lambda t: (-t[0], t[1]))
+
+    def acquire(self, weight=1):
+        """ Block until a device is free and return it. """
+        ticket = (weight, next(self._counter))
+        with self._cond:
+            self._waiting.append(ticket)
+            while len(self._busy) == len(self.gpus) or not self._isNext(ticket):
+                self._cond.wait()
+            self._waiting.remove(ticket)
+            gpu = min((g for g in self.gpus if g not in self._busy),
+                      key=lambda g: self.load[g])
+            self._busy.add(gpu)
+            self.load[gpu] += weight
+            self._cond.notify_all()
+        return gpu
+
+    def release(self, gpu):
+        with self._cond:
+            self._busy.discard(gpu)
+            self._cond.notify_all()
+
+    def run(self, runner, weight=1):
+        """ Call runner(gpu) with an exclusive device. """
+        gpu = self.acquire(weight)
+        try:
+            return runner(gpu)
+        finally:
+            self.release(gpu)
+
+
+_schedulerLock = threading.Lock()
+
+
+def getGpuScheduler(protocol):
+    """ Return the scheduler shared by all the steps of a protocol
+    run, created from its GPU list. """
+    with _schedulerLock:
+        scheduler = getattr(protocol, "_gpuScheduler", None)
+        if scheduler is None:
+            gpus = pwutils.getListFromRangeString(protocol.gpuList.get())
+            scheduler = GpuScheduler(gpus)
+            protocol._gpuScheduler = scheduler
+        return scheduler
+
+
+class ResourceScheduler:
+    """ Let jobs run while the sum of their memory and cores fits in a
+    budget. Jobs wait until running jobs release enough, but a job
+    larger than the whole budget runs when no other job is running. """
+    def __init__(self, memory, cores):
+        self.memory = memory
+        self.cores = cores
+        self.used = [0, 0]
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, memory, cores):
+        return (self.used[0] + memory <= self.memory and
+                self.used[1] + cores <= self.cores)
+
+    def acquire(self, memory, cores=1):
+        with self._cond:
+            while self._running and not self._fits(memory, cores):
+                self._cond.wait()
+            self.used[0] += memory
+            self.used[1] += cores
+            self._running += 1
+
+    def release(self, memory, cores=1):
+        with self._cond:
+            self.used[0] -= memory
+            self.used[1] -= cores
+            self._running -= 1
+            self._cond.notify_all()
+
+    def run(self, runner, memory, cores=1):
+        """ Call runner() once memory and cores are available. """
+        self.acquire(memory, cores)
+        try:
+            return runner()
+        finally:
+            self.release(memory, cores)
+
+
+def getResourceScheduler(protocol):
+    """ Return the scheduler shared by all the steps of a protocol
+    run, created from its resource budget. """
+    with _schedulerLock:
+        scheduler = getattr(protocol, "_resourceScheduler", None)
+        if scheduler is None:
+            budget = protocol._getBudget()
+            scheduler = ResourceScheduler(budget.memory, budget.cores)
+            protocol._resourceScheduler = scheduler
+        return scheduler
+
+
+class Timeline:
+    """ Record when each step used a GPU or CPU resource.
+    Intervals are appended as json lines, so all the steps
+    of a run (and of a resumed run) write to the same file. """
+    GPU = "gpu"
+    CPU = "cpu"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def record(self, resource, label):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self._lock, open(self.path, "a") as f:
+                f.write(json.dumps({"resource": resource, "label": label,
+                                    "start": start, "end": end}) + "\n")
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def getReport(self):
+        return timelineReport(self.read())
+
+
+def _mergeIntervals(intervals):
+    """ Union of (start, end) intervals as a sorted disjoint list. """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _intersectIntervals(a, b):
+    """ Total length of the intersection of two disjoint sorted lists. """
+    i = j = 0
+    total = 0.
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        total += max(0., end - start)
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
+
+def timelineReport(records):
+    """ Summarize the GPU and CPU intervals of a timeline: busy time
+    of each resource, time both were busy and the wall time. The
+    overlap ratio is the fraction of the shorter busy time that ran
+    concurrently with the other resource. """
+    gpu = _mergeIntervals((r["start"], r["end"]) for r in records
+                          if r["resource"] == Timeline.GPU)
+    cpu = _mergeIntervals((r["start"], r["end"]) for r in records
+                          if r["resource"] == Timeline.CPU)
+    gpuTime = sum(e - s for s, e in gpu)
+    cpuTime = sum(e - s for s, e in cpu)
+    overlap = _intersectIntervals(gpu, cpu)
+    wall = (max(r["end"] for r in records) -
+            min(r["start"] for r in records)) if records else 0.
+    shortest = min(gpuTime, cpuTime)
+
+    return {
+        "wall": wall,
+        "gpu": gpuTime,
+        "cpu": cpuTime,
+        "overlap": overlap,
+        "overlapRatio": overlap / shortest if shortest else 0.,
+        "steps": len(records)
+    }
+
+
+def formatTimelineReport(report):
+    return (f"wall {report['wall']:.1f}s, GPU busy {report['gpu']:.1f}s, "
+            f"CPU busy {report['cpu']:.1f}s, overlapped {report['overlap']:.1f}s "
+            f"({100 * report['overlapRatio']:.0f}%)")
@@ -0,0 +1,329 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.object import Float
+from pyworkflow.utils import magentaStr, runJob
+from emtable import Table
+
+from tomo.objects import SetOfCoordinates3D, Coordinate3D
+from tomo.protocols import ProtImportTomograms
+from tomo.constants import BOTTOM_LEFT_CORNER
+from tomo.tests import DataSet
+
+from .. import Plugin
+from ..convert import (readSetOfCoordinates3D, readCoordinate3D,
+                       readTable, writeTable, mergeEmbeddings)
+from ..engine import (mapEmbeddings, locateParticles, writeWindowsMask,
+                      insideWindows)
+
+
+class TestTomoTwinBenchmarks(BaseTest):
+    """ Timings of the plugin-side code paths. These are not run
+    as part of the protocol tests, e.g.:
+    scipion tests tomotwin.tests.test_benchmarks_tomotwin """
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.dataset = DataSet.getDataSet("tomotwin")
+        cls.tomo = cls.dataset.getFile('tomo')
+
+    def _getTomogram(self):
+        protImportTomo = self.newProtocol(ProtImportTomograms,
+                                          filesPath=self.tomo,
+                                          samplingRate=13.60)
+        self.launchProtocol(protImportTomo)
+        return protImportTomo.Tomograms.getFirstItem()
+
+    def _createCoordSet(self, tomo, suffix):
+        coordSet = SetOfCoordinates3D.create(self.getOutputPath(),
+                                             suffix=suffix)
+        coordSet.setSamplingRate(tomo.getSamplingRate())
+        coordSet.setBoxSize(37)
+        return coordSet
+
+    def _writeStar(self, fn, coords):
+        with open(fn, "w") as f:
+            f.write("\ndata_\n\nloop_\n_rlnCoordinateX #1\n"
+                    "_rlnCoordinateY #2\n_rlnCoordinateZ #3\n")
+            np.savetxt(f, coords, fmt="%d")
+
+    def test_readCoordinates(self):
+        numCoords = 1000000
+        print(magentaStr(f"\n==> Reading {numCoords} coordinates:"))
+        tomo = self._getTomogram()
+        coords = np.random.randint(0, 200, size=(numCoords, 3))
+        starFn = self.getOutputPath("coords_relion3.star")
+        self._writeStar(starFn, coords)
+
+        # legacy row by row path
+        t0 = time.time()
+        rowSet = self._createCoordSet(tomo, "rows")
+        coord = Coordinate3D()
+        coord._confidence = Float()
+        rowSet.enableAppend()
+        for row in Table.iterRows(fileName=starFn):
+            readCoordinate3D(coord, row, tomo, origin=BOTTOM_LEFT_CORNER)
+            rowSet.append(coord)
+        rowSet.write()
+        rowTime = time.time() - t0
+
+        t0 = time.time()
+        bulkSet = self._createCoordSet(tomo, "bulk")
+        readSetOfCoordinates3D(starFn, bulkSet, tomo,
+                               origin=BOTTOM_LEFT_CORNER)
+        bulkSet.write()
+        bulkTime = time.time() - t0
+
+        print(f"Row by row: {rowTime:.1f}s, columnar: {bulkTime:.1f}s "
+              f"(x{rowTime / bulkTime:.1f})")
+        self.assertEqual(rowSet.getSize(), bulkSet.getSize())
+        self.assertEqual(rowSet.getFirstItem().getPosition(BOTTOM_LEFT_CORNER),
+                         bulkSet.getFirstItem().getPosition(BOTTOM_LEFT_CORNER))
+        self.assertLess(bulkTime, rowTime)
+
+    def _writeEmbeddings(self, fn, numRows, isRefs=False, dim=32):
+        """ Synthetic .temb: tomogram positions or references. """
+        import pandas as pd
+        rng = np.random.default_rng(0)
+        table = pd.DataFrame(rng.normal(size=(numRows, dim)).astype(np.float32),
+                             columns=[str(i) for i in range(dim)])
+        if not isRefs:
+            table.insert(0, "X", rng.integers(0, 500, numRows))
+            table.insert(1, "Y", rng.integers(0, 500, numRows))
+            table.insert(2, "Z", rng.integers(0, 200, numRows))
+            table.attrs.update({"stride": [2, 2, 2], "window_size": 37,
+                                "tomogram_input_shape": (200, 500, 500)})
+        else:
+            table.insert(0, "filepath", [f"ref_{i}.mrc" for i in range(numRows)])
+        writeTable(table, fn)
+
+    def test_mapEmbeddings(self):
+        numRows, numRefs = 2000000, 20
+        print(magentaStr(f"\n==> Mapping {numRefs} references against "
+                         f"{numRows} embeddings:"))
+        workDir = self.getOutputPath("map")
+        refsFn = os.path.join(workDir, "refs.temb")
+        volFn = os.path.join(workDir, "tomo_embeddings.temb")
+        self._writeEmbeddings(refsFn, numRefs, isRefs=True)
+        self._writeEmbeddings(volFn, numRows)
+
+        t0 = time.time()
+        runJob(None, Plugin.getProgram("tomotwin_map.py", gpus=False),
+               "distance -r refs.temb -v tomo_embeddings.temb -o subprocess/",
+               env=Plugin.getEnviron(), cwd=workDir)
+        subprocessTime = time.time() - t0
+
+        t0 = time.time()
+        mapEmbeddings(refsFn, volFn, os.path.join(workDir, "native/map.tmap"),
+                      numThreads=4)
+        nativeTime = time.time() - t0
+
+        print(f"tomotwin_map.py: {subprocessTime:.1f}s, numpy: {nativeTime:.1f}s "
+              f"(x{subprocessTime / nativeTime:.1f})")
+        expected = readTable(os.path.join(workDir, "subprocess/map.tmap"))
+        result = readTable(os.path.join(workDir, "native/map.tmap"))
+        for i in range(numRefs):
+            np.testing.assert_allclose(result[f"d{i}"], expected[f"d{i}"],
+                                       atol=1e-4)
+
+    def _syntheticEmbeddings(self, centers, positions, sigma=6., dim=32):
+        """ Stand-in for the network: the embedding of a position moves
+        from the background (axis 1) to the reference direction (axis 0)
+        near a particle, plus noise. """
+        import pandas as pd
+        rng = np.random.default_rng(len(positions))
+        dist = np.min(np.linalg.norm(positions[:, None, :] - centers[None], axis=2),
+                      axis=1)
+        weight = np.exp(-dist ** 2 / (2 * sigma ** 2))
+        vectors = rng.normal(scale=0.3, size=(len(positions), dim)) / np.sqrt(dim)
+        vectors[:, 0] += weight
+        vectors[:, 1] += 1 - weight
+        table = pd.DataFrame(vectors.astype(np.float32),
+                             columns=[str(i) for i in range(dim)])
+        for i, axis in enumerate("XYZ"):
+            table.insert(i, axis, positions[:, i])
+        return table
+
+    def _writeReference(self):
+        """ Single reference along the particle direction (axis 0). """
+        self._refsDir = self.getOutputPath("refs")
+        os.makedirs(self._refsDir, exist_ok=True)
+        refs = self._syntheticEmbeddings(np.zeros((1, 3)), np.zeros((1, 3)))
+        refs.iloc[0, 3:] = np.eye(1, 32)[0]
+        refs = refs.drop(columns=["X", "Y", "Z"])
+        refs.insert(0, "filepath", ["ref_0.mrc"])
+        writeTable(refs, os.path.join(self._refsDir, "refs.temb"))
+
+    @staticmethod
+    def _grid(shape, stride):
+        axes = [np.arange(0, n, stride) for n in shape]
+        return np.stack(np.meshgrid(*axes, indexing="ij"), -1).reshape(-1, 3)
+
+    def _pick(self, centers, positions, workDir, stride, tables=(),
+              globalMin=0.5, sigma=6.):
+        """ Embed the positions, map and locate. Return the located
+        table and the number of embedded positions. """
+        table = self._syntheticEmbeddings(centers, positions, sigma=sigma)
+        table.attrs.update({"stride": [stride] * 3, "window_size": 37})
+        table = mergeEmbeddings(list(tables) + [table])
+        writeTable(table, os.path.join(workDir, "tomo.temb"))
+        mapEmbeddings(os.path.join(self._refsDir, "refs.temb"),
+                      os.path.join(workDir, "tomo.temb"),
+                      os.path.join(workDir, "map.tmap"), numThreads=4)
+        return table, locateParticles(os.path.join(workDir, "map.tmap"), workDir,
+                                      tolerance=0.2, boxSize=37,
+                                      globalMin=globalMin, numProcesses=4)
+
+    @staticmethod
+    def _precision(centers, located, distance=4.):
+        picks = located[["X", "Y", "Z"]].to_numpy(dtype=np.float64)
+        if not len(picks):
+            return 0.
+        dist = np.linalg.norm(picks[:, None, :] - centers[None], axis=2)
+        return np.mean(dist.min(axis=1) <= distance)
+
+    @staticmethod
+    def _recall(centers, located, distance=4.):
+        picks = located[["X", "Y", "Z"]].to_numpy(dtype=np.float64)
+        if not len(picks):
+            return 0.
+        dist = np.linalg.norm(centers[:, None, :] - picks[None], axis=2)
+        return np.mean(dist.min(axis=1) <= distance)
+
+    def test_locate(self):
+        nx, ny, nz = 120, 120, 60
+        numParticles = 12
+        print(magentaStr(f"\n==> Locating {numParticles} particles in "
+                         f"{nx}x{ny}x{nz}:"))
+        rng = np.random.default_rng(2)
+        centers = rng.uniform(10, [nx - 10, ny - 10, nz - 10],
+                              size=(numParticles, 3))
+        self._writeReference()
+        workDir = self.getOutputPath("locate")
+        for outputDir in ["subprocess", "native"]:
+            os.makedirs(os.path.join(workDir, outputDir), exist_ok=True)
+        table = self._syntheticEmbeddings(centers, self._grid((nx, ny, nz), 2))
+        table.attrs.update({"stride": [2, 2, 2], "window_size": 37})
+        writeTable(table, os.path.join(workDir, "tomo.temb"))
+        mapEmbeddings(os.path.join(self._refsDir, "refs.temb"),
+                      os.path.join(workDir, "tomo.temb"),
+                      os.path.join(workDir, "map.tmap"), numThreads=4)
+
+        t0 = time.time()
+        runJob(None, Plugin.getProgram("tomotwin_locate.py", gpus=False),
+               "findmax -m map.tmap -o subprocess/ -t 0.2 -b 37 -g 0.5 "
+               "--processes 4", env=Plugin.getEnviron(), cwd=workDir)
+        subprocessTime = time.time() - t0
+
+        t0 = time.time()
+        result = locateParticles(os.path.join(workDir, "map.tmap"),
+                                 os.path.join(workDir, "native"),
+                                 tolerance=0.2, boxSize=37, globalMin=0.5,
+                                 numProcesses=4)
+        nativeTime = time.time() - t0
+
+        expected = readTable(os.path.join(workDir, "subprocess/located.tloc"))
+        print(f"tomotwin_locate.py: {len(expected)} picks, {subprocessTime:.1f}s, "
+              f"numpy: {len(result)} picks, {nativeTime:.1f}s")
+        self.assertEqual(len(result), len(expected))
+        picks = result[["X", "Y", "Z"]].to_numpy(dtype=np.float64)
+        expectedPicks = expected[["X", "Y", "Z"]].to_numpy(dtype=np.float64)
+        dist = np.linalg.norm(picks[:, None, :] - expectedPicks[None], axis=2)
+        # same picks, up to one map position
+        self.assertTrue(np.all(dist.min(axis=0) <= 2))
+        self.assertTrue(np.all(dist.min(axis=1) <= 2))
+        np.testing.assert_allclose(result["metric"],
+                                   expected["metric"].to_numpy()[dist.argmin(axis=1)],
+                                   atol=1e-4)
+
+    def test_coarseToFine(self):
+        import mrcfile
+        nx, ny, nz = 400, 400, 100
+        numParticles = 40
+        print(magentaStr(f"\n==> Coarse-to-fine embedding of {numParticles} "
+                         f"particles in {nx}x{ny}x{nz}:"))
+        # particles well apart for their width
+        rng = np.random.default_rng(1)
+        centers = np.empty((0, 3))
+        while len(centers) < numParticles:
+            center = rng.uniform(20, [nx - 20, ny - 20, nz - 20])
+            if np.all(np.linalg.norm(centers - center, axis=1) > 60):
+                centers = np.vstack([centers, center])
+        self._writeReference()
+
+        def _grid(stride):
+            return self._grid((nx, ny, nz), stride)
+
+        t0 = time.time()
+        plainDir = self.getOutputPath("plain")
+        os.makedirs(plainDir, exist_ok=True)
+        # wide particles, so that coarse positions next to them are
+        # above the global minimum
+        sigma = 12.
+        plainTable, plainLocated = self._pick(centers, _grid(2), plainDir, 2,
+                                              sigma=sigma)
+        plainTime = time.time() - t0
+
+        t0 = time.time()
+        coarseDir = self.getOutputPath("coarse")
+        os.makedirs(coarseDir, exist_ok=True)
+        coarseTable, candidates = self._pick(centers, _grid(8), coarseDir, 8,
+                                             globalMin=0.3, sigma=sigma)
+        maskFn = os.path.join(coarseDir, "windows.mrc")
+        writeWindowsMask(candidates[["X", "Y", "Z"]].to_numpy(), (nz, ny, nx), 8, maskFn)
+        with mrcfile.open(maskFn) as mrc:
+            z, y, x = np.nonzero(mrc.data)
+        positions = np.column_stack([x, y, z])
+        positions = positions[np.all(positions % 2 == 0, axis=1)]
+        fineDir = self.getOutputPath("fine")
+        os.makedirs(fineDir, exist_ok=True)
+        coarseTable = coarseTable[insideWindows(coarseTable[["X", "Y", "Z"]].to_numpy(),
+                                                candidates[["X", "Y", "Z"]].to_numpy(), 8)]
+        fineTable, fineLocated = self._pick(centers, positions, fineDir, 2,
+                                            tables=[coarseTable], sigma=sigma)
+        fineTime = time.time() - t0
+
+        # the maxima of wide particles move with the noise
+        plainRecall = self._recall(centers, plainLocated, distance=8.)
+        fineRecall = self._recall(centers, fineLocated, distance=8.)
+        plainPrecision = self._precision(centers, plainLocated, distance=8.)
+        finePrecision = self._precision(centers, fineLocated, distance=8.)
+        print(f"Stride 2: {len(plainTable)} subvolumes, {len(plainLocated)} picks, "
+              f"recall {plainRecall:.2f}, precision {plainPrecision:.2f}, "
+              f"{plainTime:.1f}s\n"
+              f"Coarse-to-fine: {len(fineTable)} subvolumes "
+              f"(x{len(plainTable) / len(fineTable):.1f} fewer), "
+              f"{len(fineLocated)} picks, recall {fineRecall:.2f}, "
+              f"precision {finePrecision:.2f}, {fineTime:.1f}s")
+        self.assertGreaterEqual(fineRecall, plainRecall - 0.05)
+        self.assertGreaterEqual(finePrecision, plainPrecision - 0.05)
+        self.assertLessEqual(len(fineLocated), len(plainLocated) + 2)
+        self.assertLess(len(fineTable), len(plainTable) / 4)
@@ -24,15 +24,26 @@
 # *
 # **************************************************************************
 
+import os
+import sys
+import json
+from collections import Counter
+from glob import glob
+
 from pyworkflow.tests import BaseTest, setupTestProject
+import pyworkflow.utils as pwutils
 from pyworkflow.utils import magentaStr
 from pwem.protocols import ProtImportVolumes
 
 from tomo.protocols import ProtImportTomograms
 from tomo.tests import DataSet
 
+from ..convert import readTable, writeTable
+from ..worker import WorkerClient
 from ..protocols import (ProtTomoTwinCreateMasks, ProtTomoTwinRefPicking,
-                         ProtTomoTwinClusterCreateUmaps)
+                         ProtTomoTwinRefPickingStreaming,
+                         ProtTomoTwinClusterCreateUmaps,
+                         ProtTomoTwinClusterPicking)
 
 
 class TestTomoTwinBase(BaseTest):
@@ -92,6 +103,96 @@ class TestTomoTwinRefBased(TestTomoTwinBase):
         self.assertEqual(outputCoords.getBoxSize(), 37)
 
 
+class TestTomoTwinPublish(TestTomoTwinBase):
+    def test_run(self):
+        """ Picking steps of two tomograms run at the same time, each
+        one appends its coordinates to the output once. """
+        tomosDir = self.proj.getTmpPath("publish")
+        pwutils.makePath(tomosDir)
+        for name in ["tomo_a.mrc", "tomo_b.mrc"]:
+            pwutils.createAbsLink(os.path.abspath(self.tomo),
+                                  os.path.join(tomosDir, name))
+        print(magentaStr("\n==> Importing data - two tomograms:"))
+        protImportTomo = self.newProtocol(ProtImportTomograms,
+                                          filesPath=tomosDir,
+                                          filesPattern="tomo_*.mrc",
+                                          samplingRate=13.60)
+        self.launchProtocol(protImportTomo)
+        protImportVols = self.runImportVolumes()
+
+        print(magentaStr("\n==> Testing tomotwin - concurrent picking steps:"))
+        protPicking = self.newProtocol(ProtTomoTwinRefPicking,
+                                       inputTomos=protImportTomo.Tomograms,
+                                       inputRefs=protImportVols.outputVolume,
+                                       batchTomos=400,
+                                       batchRefs=12,
+                                       numberOfThreads=4)
+        self.launchProtocol(protPicking)
+        outputCoords = protPicking.output3DCoordinates
+        self.assertIsNotNone(outputCoords, "Tomotwin reference-based picking has failed")
+        self.assertTrue(outputCoords.isStreamClosed())
+
+        counts = Counter(coord.getTomoId() for coord in outputCoords.iterItems())
+        for tomo in protImportTomo.Tomograms:
+            tomoId = tomo.getTsId()
+            with open(protPicking._getManifestFn(tomoId)) as f:
+                manifest = json.load(f)
+            located = readTable(protPicking._getTlocFn(tomoId))
+            self.assertEqual(manifest["count"], len(located))
+            self.assertEqual(counts[tomoId], len(located))
+        self.assertEqual(outputCoords.getSize(), sum(counts.values()))
+
+
+class TestTomoTwinRefBasedStreaming(TestTomoTwinBase):
+    def test_run(self):
+        protImportTomo = self.runImportTomos()
+        protImportVols = self.runImportVolumes()
+
+        print(magentaStr("\n==> Testing tomotwin - reference-based picking "
+                         "(streaming):"))
+        protPicking = self.newProtocol(ProtTomoTwinRefPickingStreaming,
+                                       inputTomos=protImportTomo.Tomograms,
+                                       inputRefs=protImportVols.outputVolume,
+                                       batchTomos=400,
+                                       batchRefs=12,
+                                       numberOfThreads=3)
+        self.launchProtocol(protPicking)
+        outputCoords = protPicking.output3DCoordinates
+        self.assertIsNotNone(outputCoords,
+                             "Tomotwin reference-based picking in streaming has failed")
+        self.assertTrue(outputCoords.isStreamClosed())
+        self.assertGreater(outputCoords.getSize(), 0)
+        numTomos = protImportTomo.Tomograms.getSize()
+        manifests = protPicking._getExtraPath("*", "coordinates.json")
+        self.assertEqual(len(glob(manifests)), numTomos)
+
+        print(magentaStr("\n==> Resuming tomotwin - reference-based picking "
+                         "(streaming):"))
+        size = outputCoords.getSize()
+        self.launchProtocol(protPicking)
+        outputCoords = protPicking.output3DCoordinates
+        self.assertTrue(outputCoords.isStreamClosed())
+        self.assertEqual(outputCoords.getSize(), size)
+        self.assertEqual(len(glob(manifests)), numTomos)
+
+    def test_failed(self):
+        """ Failed tomograms are kept when the protocol is loaded again
+        and their next steps are skipped. """
+        protPicking = self.newProtocol(ProtTomoTwinRefPickingStreaming)
+        self.saveProtocol(protPicking)
+
+        def _fail():
+            raise Exception("no embedding")
+
+        protPicking._runTomoStep("tomo_a", _fail)
+        protPicking = self.proj.getProtocol(protPicking.getObjId())
+        self.assertEqual(protPicking._getFailedIds(), {"tomo_a"})
+        calls = []
+        protPicking._runTomoStep("tomo_a", lambda: calls.append("tomo_a"))
+        protPicking._runTomoStep("tomo_b", lambda: calls.append("tomo_b"))
+        self.assertEqual(calls, ["tomo_b"])
+
+
 class TestTomoTwinClusterBased(TestTomoTwinBase):
     def test_run(self):
         protImportTomo = self.runImportTomos()
@@ -111,3 +212,112 @@ class TestTomoTwinClusterBased(TestTomoTwinBase):
         self.launchProtocol(protPicking)
         self.assertTrue(protPicking.isFinished(),
                         "Tomotwin cluster-based embedding has failed")
+
+
+class TestTomoTwinClusterTargets(TestTomoTwinBase):
+    """ Where step 2 reads the cluster targets, with and
+    without the targets shared by all tomograms. """
+    def _newPicking(self, **kwargs):
+        protUmaps = self.newProtocol(ProtTomoTwinClusterCreateUmaps)
+        self.saveProtocol(protUmaps)
+        protPicking = self.newProtocol(ProtTomoTwinClusterPicking, **kwargs)
+        protPicking.inputUmaps.set(protUmaps)
+        self.saveProtocol(protPicking)
+        pwutils.makePath(protPicking._getExtraPath("tomo_a"))
+        return protPicking
+
+    def _writeTargets(self, fn, numTargets):
+        import pandas as pd
+        targets = pd.DataFrame({"filepath": [f"cluster_{i}" for i in range(numTargets)],
+                                "0": [1.] * numTargets, "1": [0.] * numTargets})
+        writeTable(targets, fn)
+
+    def test_perTomogram(self):
+        protPicking = self._newPicking(sharedTargets=False)
+        clustersFn = protPicking._getClustersFn("tomo_a")
+        self.assertEqual(clustersFn, protPicking._getExtraPath("tomo_a",
+                                                               "cluster_targets.temb"))
+        with self.assertRaises(FileNotFoundError):
+            protPicking._getMapFiles("tomo_a")
+        self._writeTargets(clustersFn, 2)
+        refsFn, embeddingsFn, outputDir = protPicking._getMapFiles("tomo_a")
+        self.assertEqual(refsFn, os.path.join("tomo_a", "cluster_targets.temb"))
+        self.assertEqual(embeddingsFn, os.path.abspath(
+            protPicking._getInputProt()._getEmbeddingFn("tomo_a")))
+        self.assertEqual(outputDir, "tomo_a")
+
+    def test_shared(self):
+        protPicking = self._newPicking(sharedTargets=True)
+        self.assertEqual(protPicking._getTargetsTomoId(["tomo_a", "tomo_b"]), "tomo_a")
+        protPicking.targetsTomoId.set("tomo_b")
+        self.assertEqual(protPicking._getTargetsTomoId(["tomo_a", "tomo_b"]), "tomo_b")
+
+        # targets from a file, copied once and used for every tomogram
+        targetsFn = self.proj.getTmpPath("my_targets.temb")
+        self._writeTargets(targetsFn, 3)
+        protPicking.targetsFile.set(targetsFn)
+        protPicking.shareTargetsStep(os.path.abspath(targetsFn))
+        for tomoId in ["tomo_a", "tomo_b"]:
+            clustersFn = protPicking._getClustersFn(tomoId)
+            self.assertEqual(clustersFn, protPicking._getSharedClustersFn())
+            self.assertEqual(len(readTable(clustersFn)), 3)
+            self.assertEqual(protPicking._getMapFiles(tomoId)[0],
+                             "cluster_targets.temb")
+
+    def test_emptyTargets(self):
+        """ A tomogram without targets is skipped, not failed
+        (its embedding does not even exist here). """
+        protPicking = self._newPicking(sharedTargets=False)
+        self._writeTargets(protPicking._getClustersFn("tomo_a"), 0)
+        protPicking.pickingStep("tomo_a")
+        self.assertFalse(os.path.exists(protPicking._getManifestFn("tomo_a")))
+
+
+class TestTomoTwinJobs(TestTomoTwinBase):
+    """ Jobs run in the extra folder of a protocol, whose paths
+    are relative to the project. """
+    def _newProtocol(self):
+        prot = self.newProtocol(ProtTomoTwinRefPicking)
+        self.saveProtocol(prot)
+        pwutils.makePath(prot._getExtraPath(), prot._getTmpPath())
+        self.assertFalse(os.path.isabs(prot._getExtraPath()))
+        # plain commands instead of the TomoTwin environment
+        prot.getProgram = lambda program, gpu=True, gpuId=None: program
+        prot.runJob = lambda program, args, env=None, cwd=None: pwutils.runJob(
+            None, program, args, env=env, cwd=cwd)
+        return prot
+
+    def test_runProgram(self):
+        prot = self._newProtocol()
+        logFn = prot._getJobLogFn("test job")
+        prot.runProgram(f"{sys.executable} -c", ['"print(42)"'], gpu=False,
+                        logFn=logFn)
+        with open(logFn) as f:
+            self.assertEqual(f.read().strip(), "42")
+
+    def test_workerFallback(self):
+        """ A job falls back to a new process when the worker is gone,
+        also with a log path relative to the project. """
+        prot = self._newProtocol()
+        prot._getWorker = lambda: WorkerClient(self.proj.getTmpPath("none.sock"))
+        logFn = prot._getTmpPath("logs", "fallback.log")
+        self.assertFalse(os.path.isabs(logFn))
+        prot.runProgram(f"{sys.executable} -c", ['"print(42)"'], gpu=False,
+                        logFn=logFn)
+        with open(logFn) as f:
+            self.assertEqual(f.read().strip(), "42")
+
+    def test_runBatch(self):
+        """ The batch process runs in the extra folder, with
+        log paths given relative to the project. """
+        prot = self._newProtocol()
+        with open(prot._getExtraPath("job.py"), "w") as f:
+            f.write("import sys\nprint(sys.argv[1])\n")
+        jobs = [{"id": tomoId, "program": "python job.py", "args": tomoId,
+                 "log": prot._getTmpPath(f"{tomoId}.log")}
+                for tomoId in ["tomo_a", "tomo_b"]]
+        results = prot.runBatchGpuProgram(jobs)
+        self.assertEqual(results, {"tomo_a": 0, "tomo_b": 0})
+        for job in jobs:
+            with open(job["log"]) as f:
+                self.assertEqual(f.read().strip(), job["id"])
@@ -0,0 +1,807 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import sys
+import glob
+import json
+import time
+import subprocess
+import socket
+import threading
+import unittest.mock
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+import pyworkflow.utils as pwutils
+
+from ..cache import StagingCache, EmbeddingCache
+from ..engine import (computeDistanceMap, findPeaks, nonMaxSuppression,
+                      locateParticles, detectSlab, writeWindowsMask,
+                      medianEmbeddingMask, autoKMeans, writeClusterTargets,
+                      insideWindows)
+from ..convert import (readTable, writeTable, isMrcFile, convertAllToMrc, writeMrcSlabs,
+                       mergeEmbeddings)
+from ..scheduler import GpuScheduler, ResourceScheduler, Timeline, timelineReport
+from ..tuning import (SizeProfile, OutOfMemoryError, runAdaptive,
+                      checkOutOfMemory)
+from ..worker import (WorkerClient, startWorker, getWorkerScript, getSocketDir,
+                      getSocketPath, getPeerUid)
+from ..umap_tools import stratifiedSample, writeLabelMask, getLabelMaskFn
+from ..heatmaps import HeatmapReader, HEATMAPS_FILE, CACHE_CHUNKS
+from ..estimator import countSubvolumes, estimateCost, umapFootprint, ROW_BYTES
+from ..budget import ResourceBudget, GB
+from ..rescale import (getRescaledShape, getCoordScale, resampleVolume,
+                       rescaleVolume, rescaleReference)
+
+
+class BaseOutputTest(BaseTest):
+    """ Each test runs in its own empty folder of the test output. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+
+
+class TestCache(BaseOutputTest):
+    def setUp(self):
+        BaseOutputTest.setUp(self)
+        self.calls = 0
+
+    def _writeInput(self, name, size):
+        fn = os.path.join(self.path, name)
+        with open(fn, "wb") as f:
+            f.write(b"0" * size)
+        return fn
+
+    def _convert(self, inputFn, outputFn):
+        self.calls += 1
+        with open(inputFn, "rb") as fIn, open(outputFn, "wb") as fOut:
+            fOut.write(fIn.read())
+
+    def test_stage(self):
+        cache = StagingCache(os.path.join(self.path, "cache"), quota=250)
+        inputs = [self._writeInput(f"tomo{i}.rec", 100) for i in range(3)]
+
+        # each input is converted once, whatever the number of protocols
+        for prot in range(4):
+            for i, fn in enumerate(inputs[:2]):
+                cache.stage(fn, os.path.join(self.path, f"p{prot}_{i}.mrc"),
+                            self._convert)
+                time.sleep(0.01)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(cache.hits, 6)
+
+        # the third entry goes over the quota, the oldest is evicted
+        cache.lookup(cache.getKey(inputs[0]), ".mrc")
+        cache.stage(inputs[2], os.path.join(self.path, "p0_2.mrc"),
+                    self._convert)
+        self.assertIsNone(cache.lookup(cache.getKey(inputs[1]), ".mrc"))
+        self.assertIsNotNone(cache.lookup(cache.getKey(inputs[0]), ".mrc"))
+        self.assertLessEqual(cache.getSize(), 250)
+        # linked outputs survive the eviction
+        self.assertTrue(os.path.exists(os.path.join(self.path, "p0_1.mrc")))
+
+    def _embed(self, outputFn):
+        def _producer():
+            self.calls += 1
+            os.makedirs(os.path.dirname(outputFn), exist_ok=True)
+            with open(outputFn, "wb") as f:
+                f.write(b"1" * 100)
+        return _producer
+
+    def test_embeddings(self):
+        cache = EmbeddingCache(os.path.join(self.path, "cache"), quota=250)
+        tomoFn = self._writeInput("tomo.mrc", 100)
+
+        def _key(stride=2):
+            return cache.getKey(tomo=cache.getFingerprint(tomoFn), stride=stride)
+
+        def _link(prot, key):
+            outputFn = os.path.join(self.path, prot, "tomo_embeddings.temb")
+            return cache.link(key, outputFn, self._embed(outputFn))
+
+        # miss: the embedding is produced and added to the cache
+        self.assertFalse(_link("p0", _key()))
+        # hit from another protocol, checked first as embedTomosStep does
+        self.assertIsNotNone(cache.lookup(_key(), ".temb"))
+        self.assertTrue(_link("p1", _key()))
+        self.assertTrue(os.path.exists(os.path.join(self.path, "p1",
+                                                    "tomo_embeddings.temb")))
+        self.assertEqual((self.calls, cache.hits, cache.misses), (1, 1, 1))
+
+        # other parameters or a modified tomogram invalidate the key
+        firstKey = _key()
+        self.assertNotEqual(_key(stride=4), firstKey)
+        time.sleep(0.01)
+        self._writeInput("tomo.mrc", 100)
+        self.assertNotEqual(_key(), firstKey)
+        self.assertFalse(_link("p2", _key()))
+        self.assertEqual(self.calls, 2)
+
+        # the third entry goes over the quota, the least recently used
+        # (the modified tomogram, as the first one is used again) goes
+        time.sleep(0.01)
+        cache.lookup(firstKey, ".temb")
+        time.sleep(0.01)
+        self.assertFalse(_link("p3", _key(stride=4)))
+        self.assertIsNone(cache.lookup(_key(), ".temb"))
+        self.assertIsNotNone(cache.lookup(firstKey, ".temb"))
+        self.assertLessEqual(cache.getSize(), 250)
+
+
+class TestEngine(BaseOutputTest):
+    def test_distanceMap(self):
+        rng = np.random.default_rng(0)
+        refs = rng.normal(size=(5, 32))
+        embeddings = rng.normal(size=(1001, 32))
+        expected = np.array([[np.dot(r, e) / np.linalg.norm(r) / np.linalg.norm(e)
+                              for e in embeddings] for r in refs])
+
+        for numThreads in [1, 3]:
+            result = computeDistanceMap(refs, embeddings, chunkSize=100,
+                                        numThreads=numThreads)
+            self.assertEqual(result.shape, (5, 1001))
+            np.testing.assert_allclose(result, expected, atol=1e-5)
+
+    def _blobs(self, centers, shape=(40, 40, 30), sigma=3.0):
+        grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape],
+                                    indexing="ij"), axis=-1)
+        volume = np.zeros(shape, dtype=np.float32)
+        for center, height in centers:
+            dist2 = ((grid - center) ** 2).sum(axis=-1)
+            volume = np.maximum(volume, height * np.exp(-dist2 / (2 * sigma ** 2)))
+        return volume
+
+    def test_findPeaks(self):
+        centers = [((10, 10, 10), 0.9), ((30, 28, 15), 0.8),
+                   ((10, 30, 20), 0.4)]
+        volume = self._blobs(centers)
+        # a local maximum on the shoulder of the first blob
+        volume[13, 10, 10] += 0.3
+
+        peaks, values, sizes = findPeaks(volume, tolerance=0.2, globalMin=0.5)
+        self.assertEqual(sorted(map(tuple, peaks)), [(10, 10, 10), (30, 28, 15)])
+        self.assertTrue(np.all(sizes > 1))
+
+        peaks, _, _ = findPeaks(volume, tolerance=0.05, globalMin=0.5)
+        self.assertIn((13, 10, 10), list(map(tuple, peaks)))
+
+        # a plateau gives a single peak, the first voxel, whose region
+        # holds the voxels within tolerance
+        plateau = np.zeros((5, 5, 5), dtype=np.float32)
+        plateau[1:3, 2, 2] = 1.
+        plateau[3, 2, 2] = 0.85
+        peaks, values, sizes = findPeaks(plateau, tolerance=0.2, globalMin=0.5)
+        self.assertEqual(list(map(tuple, peaks)), [(1, 2, 2)])
+        self.assertEqual(list(sizes), [3])
+
+    def test_nonMaxSuppression(self):
+        coords = np.array([[0, 0, 0], [2, 0, 0], [40, 0, 0], [0, 30, 0]], dtype=float)
+        metric = np.array([0.5, 0.9, 0.7, 0.6])
+        keep = nonMaxSuppression(coords, metric, boxSize=37)
+        self.assertEqual(keep.tolist(), [1, 2, 3])
+
+    def test_detectSlab(self):
+        rng = np.random.default_rng(0)
+        volume = rng.normal(scale=0.2, size=(120, 64, 64))
+        volume[40:81] += rng.normal(size=(41, 64, 64))
+        variances = volume.reshape(120, -1).var(axis=1)
+        self.assertEqual(detectSlab(variances, margin=10), (30, 90))
+        self.assertEqual(detectSlab(variances, margin=100), (0, 119))
+        self.assertIsNone(detectSlab(np.ones(50), margin=10))
+
+    def test_medianEmbeddingMask(self):
+        import mrcfile
+        import pandas as pd
+        rng = np.random.default_rng(0)
+        positions = np.stack(np.meshgrid(np.arange(18, 80, 2), np.arange(18, 60, 2),
+                                         np.arange(4, 30, 2), indexing="ij"),
+                             -1).reshape(-1, 3)
+        vectors = rng.normal(scale=0.05, size=(len(positions), 32))
+        particle = np.all(np.abs(positions - [40, 30, 16]) <= 4, axis=1)
+        vectors[~particle, 0] += 1
+        vectors[particle, 1] += 1
+        table = pd.DataFrame(vectors.astype(np.float32),
+                             columns=[str(i) for i in range(32)])
+        for i, axis in enumerate("XYZ"):
+            table.insert(i, axis, positions[:, i])
+        table.attrs["stride"] = [2, 2, 2]
+
+        embeddingsFn = os.path.join(self.path, "tomo_embeddings.temb")
+        writeTable(table, embeddingsFn)
+        maskFn = os.path.join(self.path, "mask.mrc")
+        # tomogram embedded at half the size
+        _, fraction = medianEmbeddingMask(embeddingsFn, maskFn, (68, 140, 200),
+                                          embeddedShape=(34, 70, 100))
+        with mrcfile.open(maskFn) as mrc:
+            voxels = np.argwhere(mrc.data)
+        np.testing.assert_array_equal(voxels.min(axis=0), [22, 50, 70])
+        np.testing.assert_array_equal(voxels.max(axis=0), [41, 69, 89])
+        self.assertAlmostEqual(fraction, len(voxels) / (68 * 140 * 200))
+
+    def test_clusterTargets(self):
+        import pandas as pd
+        rng = np.random.default_rng(0)
+        sizes = [3000, 500, 300]
+        centers = [[0, 0], [10, 0], [0, 10]]
+        points = np.concatenate([rng.normal(c, 1., size=(n, 2))
+                                 for c, n in zip(centers, sizes)])
+        labels, _ = autoKMeans(points, maxClusters=6)
+        self.assertEqual(sorted(np.bincount(labels)), sorted(sizes))
+
+        vectors = np.zeros((len(points), 32), dtype=np.float32)
+        vectors[:3000, 0] = 1
+        vectors[3000:3500, 1] = 1
+        vectors[3500:, 2] = 1
+        umap = pd.DataFrame(points, columns=["umap_0", "umap_1"])
+        embeddings = pd.DataFrame(vectors, columns=[str(i) for i in range(32)])
+        umapFn = os.path.join(self.path, "tomo_embeddings.tumap")
+        embeddingsFn = os.path.join(self.path, "tomo_embeddings.temb")
+        targetsFn = os.path.join(self.path, "cluster_targets.temb")
+        writeTable(umap, umapFn)
+        writeTable(embeddings, embeddingsFn)
+        # the largest cluster is the background
+        self.assertEqual(writeClusterTargets(umapFn, embeddingsFn, targetsFn,
+                                             maxClusters=6), [500, 300])
+        targets = readTable(targetsFn)
+        self.assertEqual(targets["filepath"].tolist(), ["cluster_0", "cluster_1"])
+        np.testing.assert_allclose(targets[["1", "2"]].to_numpy(), np.eye(2))
+        self.assertEqual(writeClusterTargets(umapFn, embeddingsFn, targetsFn,
+                                             maxClusters=6, minSize=400), [500])
+
+    def test_coarseToFine(self):
+        import mrcfile
+        import pandas as pd
+        maskFn = os.path.join(self.path, "mask.mrc")
+        mrcfile.new(maskFn, data=np.ones((20, 30, 40), dtype=np.int8)
+                    * (np.arange(40) < 35).astype(np.int8)).close()
+        outputFn = os.path.join(self.path, "windows.mrc")
+        fraction = writeWindowsMask([[5, 5, 5], [36, 10, 10]], (20, 30, 40),
+                                    2, outputFn, maskFn=maskFn)
+        with mrcfile.open(outputFn) as mrc:
+            self.assertEqual(mrc.data[5, 5, 5], 1)
+            self.assertEqual(mrc.data[10, 10, 34], 1)
+            self.assertEqual(mrc.data[10, 10, 36], 0)
+            self.assertEqual(mrc.data.sum(), 125 + 25)
+        self.assertAlmostEqual(fraction, 150 / (20 * 30 * 40))
+
+        coarse = pd.DataFrame({"X": [0, 8], "Y": [0, 0], "Z": [0, 0], "0": [1., 2.]})
+        coarse.attrs["stride"] = [8, 8, 8]
+        fine = pd.DataFrame({"X": [6, 8], "Y": [0, 0], "Z": [0, 0], "0": [3., 4.]})
+        fine.attrs["stride"] = [2, 2, 2]
+        merged = mergeEmbeddings([coarse, fine])
+        self.assertEqual(merged["X"].tolist(), [0, 6, 8])
+        # coarse rows outside the refined windows are dropped
+        inside = insideWindows(coarse[["X", "Y", "Z"]].to_numpy(), [[7, 0, 0]], 2)
+        self.assertEqual(inside.tolist(), [False, True])
+        self.assertEqual(merged["0"].tolist(), [1., 3., 4.])
+        self.assertEqual(merged.attrs["stride"], [2, 2, 2])
+
+    def test_locateParticles(self):
+        import pandas as pd
+        volume = self._blobs([((10, 10, 10), 0.9), ((30, 28, 15), 0.8)])
+        idx = np.argwhere(np.ones(volume.shape, dtype=bool))
+        table = pd.DataFrame(idx * 2 + 5, columns=["X", "Y", "Z"])
+        table["d0"] = volume[tuple(idx.T)]
+        table["d1"] = volume[tuple(idx.T)][::-1]
+        table.attrs.update({"stride": 2, "references": ["a.mrc", "b.mrc"]})
+
+        mapFn = os.path.join(self.path, "map.tmap")
+        writeTable(table, mapFn)
+        for numProcesses in [1, 2]:
+            located = locateParticles(mapFn, self.path, tolerance=0.2,
+                                      boxSize=7, globalMin=0.5,
+                                      numProcesses=numProcesses)
+            self.assertEqual(len(located), 4)
+            first = located[located["predicted_class"] == 0]
+            self.assertEqual(first[["X", "Y", "Z"]].values.tolist(),
+                             [[25, 25, 25], [65, 61, 35]])
+
+    def test_heatmapStore(self):
+        import pandas as pd
+        volume = self._blobs([((10, 10, 10), 0.9), ((30, 28, 15), 0.8)])
+        missing = np.zeros(volume.shape, dtype=bool)
+        missing[18:24, :, 3:9] = True  # masked positions are 0
+        idx = np.argwhere(~missing)
+        table = pd.DataFrame(idx * 2 + 5, columns=["X", "Y", "Z"])
+        table["d0"] = volume[tuple(idx.T)]
+        table.attrs.update({"stride": 2, "references": ["a.mrc"]})
+        expected = np.where(missing, 0, volume).transpose(2, 1, 0)
+
+        mapFn = os.path.join(self.path, "map.tmap")
+        writeTable(table, mapFn)
+        for dtype, binning, atol in [("float16", 1, 1e-3), ("uint8", 1, 5e-3),
+                                     ("float16", 3, 1e-3)]:
+            locateParticles(mapFn, self.path, tolerance=0.2, boxSize=7,
+                            globalMin=0.5, writeHeatmaps=True,
+                            heatmapDtype=dtype, heatmapBinning=binning)
+            reader = HeatmapReader(os.path.join(self.path, HEATMAPS_FILE))
+            self.assertEqual(reader.references, ["a"])
+            heatmap = reader.getHeatmap("a")
+            ref = expected
+            if binning > 1:
+                ref = np.pad(ref, [(0, -n % 3) for n in ref.shape])
+                ref = ref.reshape(10, 3, 14, 3, 14, 3).max(axis=(1, 3, 5))
+            self.assertEqual(heatmap.shape, ref.shape)
+            np.testing.assert_allclose(np.asarray(heatmap), ref, atol=atol)
+            # slices across chunks and single slices are read lazily
+            np.testing.assert_allclose(heatmap[3:25:2, 5], ref[3:25:2, 5], atol=atol)
+            np.testing.assert_allclose(heatmap[-1], ref[-1], atol=atol)
+            self.assertLessEqual(len(reader._cache), CACHE_CHUNKS)
+            reader.close()
+        self.assertEqual(reader.getScale(), [6, 6, 6])
+        self.assertEqual(reader.getTranslate(), [7, 7, 7])
+        self.assertFalse(glob.glob(os.path.join(self.path, "*.mrc")))
+
+
+class TestGpuScheduler(BaseTest):
+    def test_run(self):
+        scheduler = GpuScheduler(["a", "b"])
+        lock = threading.Lock()
+        running, used = set(), []
+
+        def _runner(gpu):
+            with lock:
+                self.assertNotIn(gpu, running)
+                running.add(gpu)
+                used.append(gpu)
+            time.sleep(0.05)
+            with lock:
+                running.remove(gpu)
+
+        threads = [threading.Thread(target=scheduler.run, args=(_runner, w))
+                   for w in [1, 5, 2, 8, 3, 1]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(used), 6)
+        self.assertEqual(set(used), {"a", "b"})
+        self.assertEqual(sum(scheduler.load.values()), 20)
+
+    def test_order(self):
+        scheduler = GpuScheduler(["a"])
+        gpu = scheduler.acquire()
+        order = []
+        threads = []
+        for weight in [1, 10, 5]:
+            t = threading.Thread(target=scheduler.run,
+                                 args=(lambda g, w=weight: order.append(w), weight))
+            t.start()
+            threads.append(t)
+            time.sleep(0.05)  # all three are queued before the release
+        scheduler.release(gpu)
+        for t in threads:
+            t.join()
+        self.assertEqual(order, [10, 5, 1])
+
+
+class TestResourceScheduler(BaseTest):
+    def test_run(self):
+        scheduler = ResourceScheduler(memory=10, cores=4)
+        lock = threading.Lock()
+        peak = [0, 0, 0]
+
+        def _runner():
+            with lock:
+                peak[0] = max(peak[0], scheduler.used[0])
+                peak[1] = max(peak[1], scheduler.used[1])
+                peak[2] += 1
+            time.sleep(0.05)
+
+        # the last job is larger than the budget and runs alone
+        jobs = [(4, 2), (4, 2), (4, 2), (6, 1), (20, 1)]
+        threads = [threading.Thread(target=scheduler.run, args=(_runner, m, c))
+                   for m, c in jobs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(peak[2], 5)
+        self.assertLessEqual(peak[1], 4)
+        self.assertEqual(scheduler.used, [0, 0])
+
+
+class TestTimeline(BaseOutputTest):
+    def test_report(self):
+        records = [
+            {"resource": Timeline.GPU, "label": "embed a", "start": 0, "end": 10},
+            {"resource": Timeline.GPU, "label": "embed b", "start": 10, "end": 20},
+            {"resource": Timeline.CPU, "label": "picking a", "start": 10, "end": 14},
+            {"resource": Timeline.CPU, "label": "picking b", "start": 20, "end": 24},
+        ]
+        report = timelineReport(records)
+        self.assertEqual(report["wall"], 24)
+        self.assertEqual(report["gpu"], 20)
+        self.assertEqual(report["cpu"], 8)
+        self.assertEqual(report["overlap"], 4)
+        self.assertEqual(report["overlapRatio"], 0.5)
+
+    def test_record(self):
+        timeline = Timeline(os.path.join(self.path, "timeline.jsonl"))
+        with timeline.record(Timeline.GPU, "embed"):
+            time.sleep(0.01)
+        with timeline.record(Timeline.CPU, "picking"):
+            pass
+        records = timeline.read()
+        self.assertEqual([r["label"] for r in records], ["embed", "picking"])
+        self.assertGreater(timeline.getReport()["gpu"], 0)
+
+
+STUB_EMBED = """#!/bin/sh
+# fails like tomotwin_embed.py when the batch size (-b) is above 48
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-b" ]; then batch=$2; fi
+    shift
+done
+echo "batch $batch"
+if [ "$batch" -gt 48 ]; then
+    echo "torch.cuda.OutOfMemoryError: CUDA out of memory." >&2
+    exit 1
+fi
+"""
+
+
+class TestAdaptiveBatchSize(BaseOutputTest):
+    def setUp(self):
+        BaseOutputTest.setUp(self)
+        self.stub = os.path.join(self.path, "tomotwin_embed.py")
+        with open(self.stub, "w") as f:
+            f.write(STUB_EMBED)
+        os.chmod(self.stub, 0o755)
+        self.profile = SizeProfile(os.path.join(self.path, "profile.json"),
+                                   host="host")
+        self.key = self.profile.getKey("/models/model.pth", "batchTomos")
+        self.calls = []
+
+    def _runStub(self, batchSize):
+        self.calls.append(batchSize)
+        logFn = os.path.join(self.path, "embed.log")
+        try:
+            subprocess.run(f"{self.stub} tomogram -b {batchSize} > {logFn} 2>&1",
+                           shell=True, check=True)
+        except Exception as e:
+            checkOutOfMemory(logFn, e)
+
+    def test_retry(self):
+        value = runAdaptive(self._runStub, 256, self.profile, self.key,
+                            log=lambda msg: None)
+        self.assertEqual(value, 32)
+        self.assertEqual(self.calls, [256, 128, 64, 32])
+        self.assertEqual(self.profile.get(self.key), {"ok": 32, "failed": 64})
+
+        # next run starts at the size known to work
+        self.calls = []
+        runAdaptive(self._runStub, 256, self.profile, self.key,
+                    log=lambda msg: None)
+        self.assertEqual(self.calls, [32])
+
+        # smaller requests are not changed
+        self.calls = []
+        runAdaptive(self._runStub, 40, self.profile, self.key,
+                    log=lambda msg: None)
+        self.assertEqual(self.calls, [40])
+        self.assertEqual(self.profile.get(self.key)["ok"], 40)
+
+    def test_timings(self):
+        key = self.profile.getKey("model.pth", "rate_embed")
+        self.assertIsNone(self.profile.getRate(key))
+        for units, seconds in [(1000, 1), (3000, 1), (2000, 1), (100, 0)]:
+            self.profile.addTiming(key, units, seconds)
+        self.assertEqual(self.profile.getRate(key), 2000)
+
+    def test_footprints(self):
+        key = self.profile.getKey("model.pth", "footprint_picking")
+        self.assertEqual(self.profile.getFootprintScale(key), 1.)
+        for estimated, measured in [(100, 150), (100, 120), (100, 200), (0, 10)]:
+            self.profile.addFootprint(key, estimated, measured)
+        self.assertEqual(self.profile.getFootprintScale(key), 1.5)
+
+    def test_otherErrors(self):
+        def _runner(value):
+            checkOutOfMemory(os.path.join(self.path, "missing.log"),
+                             ValueError("no such file"))
+
+        with self.assertRaises(ValueError):
+            runAdaptive(_runner, 256, self.profile, self.key)
+        self.assertEqual(self.profile.get(self.key), {})
+
+        def _oom(value):
+            raise OutOfMemoryError()
+
+        with self.assertRaises(OutOfMemoryError):
+            runAdaptive(_oom, 4, minValue=2, log=lambda msg: None)
+
+
+STUB_PROGRAM = """#!/usr/bin/env python
+import os
+import sys
+print(" ".join(sys.argv[1:]), os.environ.get("CUDA_VISIBLE_DEVICES"))
+sys.exit(int(sys.argv[-1]))
+"""
+
+
+class TestWorker(BaseOutputTest):
+    def setUp(self):
+        BaseOutputTest.setUp(self)
+        binDir = os.path.join(self.path, "bin")
+        os.makedirs(binDir)
+        with open(os.path.join(binDir, "stub_program.py"), "w") as f:
+            f.write(STUB_PROGRAM)
+        os.chmod(os.path.join(binDir, "stub_program.py"), 0o755)
+        for name in ["ref_1.mrc", "ref_2.mrc"]:
+            open(os.path.join(self.path, name), "w").close()
+        self.socketFn = getSocketPath(f"test-{os.getpid()}")
+        self.worker = startWorker(f"export PATH={binDir}:$PATH", self.socketFn,
+                                  logFn=os.path.join(self.path, "worker.log"))
+
+    def tearDown(self):
+        pid = self.worker.getPid() if self.worker else None
+        if pid is not None:
+            os.kill(pid, 15)
+
+    def test_socketDir(self):
+        with unittest.mock.patch.dict(os.environ, XDG_RUNTIME_DIR=self.path):
+            socketFn = getSocketPath("test")
+            socketDir = os.path.dirname(socketFn)
+            self.assertEqual(socketDir, os.path.join(self.path, "tomotwin"))
+            self.assertEqual(os.stat(socketDir).st_mode & 0o777, 0o700)
+            os.chmod(socketDir, 0o755)
+            getSocketDir()
+            self.assertEqual(os.stat(socketDir).st_mode & 0o777, 0o700)
+        self.assertEqual(getPeerUid(self._connect()), os.getuid())
+
+    def _connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(conn.close)
+        conn.connect(self.socketFn)
+        return conn
+
+    def test_run(self):
+        self.assertIsNotNone(self.worker)
+        logFn = os.path.join(self.path, "job.log")
+        status = self.worker.run("stub_program.py", "-v *.mrc 0", self.path,
+                                 logFn, env={"CUDA_VISIBLE_DEVICES": "1"})
+        self.assertEqual(status, 0)
+        with open(logFn) as f:
+            self.assertEqual(f.read().strip(), "-v ref_1.mrc ref_2.mrc 0 1")
+
+        self.assertEqual(self.worker.run("stub_program.py", "3", self.path,
+                                         logFn), 3)
+        self.assertEqual(self.worker.run("missing.py", "", self.path,
+                                         logFn), 127)
+        self.assertFalse(WorkerClient(self.socketFn + ".none").ping())
+
+        scriptFn = os.path.join(self.path, "bin", "stub_program.py")
+        self.assertEqual(self.worker.run(f"python {scriptFn}", "-v 0",
+                                         self.path, logFn), 0)
+        self.assertEqual(self.worker.run("python missing.py", "",
+                                         self.path, logFn), 127)
+
+    def test_batch(self):
+        jobs = [{"id": f"tomo{i}", "program": "stub_program.py",
+                 "args": f"-v tomo{i}.mrc {i}", "cwd": self.path,
+                 "log": os.path.join(self.path, f"tomo{i}.log")}
+                for i in range(3)]
+        jobsFn = os.path.join(self.path, "jobs.json")
+        resultsFn = os.path.join(self.path, "results.json")
+        with open(jobsFn, "w") as f:
+            json.dump(jobs, f)
+
+        env = dict(os.environ, PATH=os.path.join(self.path, "bin") + ":" +
+                   os.environ["PATH"])
+        subprocess.run([sys.executable, getWorkerScript(), "batch",
+                        "--jobs", jobsFn, "--results", resultsFn],
+                       env=env, check=True)
+        with open(resultsFn) as f:
+            self.assertEqual(json.load(f), {"tomo0": 0, "tomo1": 1, "tomo2": 2})
+        with open(jobs[2]["log"]) as f:
+            self.assertEqual(f.read().strip(), "-v tomo2.mrc 2 None")
+
+
+class TestEstimator(BaseTest):
+    def test_countSubvolumes(self):
+        self.assertEqual(countSubvolumes((37, 37, 37), 2), 1)
+        self.assertEqual(countSubvolumes((137, 117, 77), 2), 51 * 41 * 21)
+        self.assertEqual(countSubvolumes((137, 117, 300), 2, zRange=(10, 86)),
+                         51 * 41 * 21)
+        self.assertEqual(countSubvolumes((137, 117, 77), 2, coverage=0.5),
+                         51 * 41 * 21 // 2)
+
+    def test_estimateCost(self):
+        cost = estimateCost([1000, 3000], ["embed", "picking"], numRefs=10,
+                            numGpus=2, numWorkers=1,
+                            rates={"embed": 100, "picking": 1000})
+        self.assertEqual(cost["subvolumes"], 4000)
+        self.assertEqual(cost["diskBytes"], 4000 * ROW_BYTES)
+        self.assertEqual(cost["seconds"], {"embed": 40, "picking": 40})
+        # max(40 / 2 GPUs, 40 / 1 worker) + last tomogram picking
+        self.assertEqual(cost["wall"], 60)
+        self.assertGreater(cost["mapRam"], 0)
+        self.assertEqual(cost["umapRam"], 0)
+
+
+class TestConvert(BaseOutputTest):
+    def setUp(self):
+        BaseOutputTest.setUp(self)
+        self.volume = np.arange(6 * 5 * 4, dtype=np.float32).reshape(6, 5, 4)
+
+    def _readMrc(self, fn):
+        import mrcfile
+        with mrcfile.open(fn, permissive=True) as mrc:
+            return mrc.data.copy()
+
+    def _writeSpider(self, fn):
+        nz, ny, nx = self.volume.shape
+        labbyt = nx * 4 * int(np.ceil(256 / nx))
+        header = np.zeros(labbyt // 4, dtype=np.float32)
+        header[[0, 1, 4, 11, 21]] = [nz, ny, 3, nx, labbyt]
+        with open(fn, "wb") as f:
+            f.write(header.tobytes() + self.volume.tobytes())
+
+    def _writeEm(self, fn):
+        header = bytearray(512)
+        header[0], header[3] = 6, 2
+        header[4:16] = np.array(self.volume.shape[::-1], dtype="<i4").tobytes()
+        with open(fn, "wb") as f:
+            f.write(bytes(header) + self.volume.astype("<i2").tobytes())
+
+    def test_isMrcFile(self):
+        import mrcfile
+        recFn = os.path.join(self.path, "tomo.rec")
+        mrcfile.new(recFn, data=self.volume).close()
+        self.assertTrue(isMrcFile(recFn))
+        spiFn = os.path.join(self.path, "tomo.st")
+        self._writeSpider(spiFn)
+        self.assertFalse(isMrcFile(spiFn))
+
+    def test_convert(self):
+        import mrcfile
+        inputs = {"tomo.spi": self._writeSpider, "tomo.em": self._writeEm,
+                  "tomo.rec": lambda fn: mrcfile.new(fn, data=self.volume).close()}
+        files = []
+        for name, writer in inputs.items():
+            writer(os.path.join(self.path, name))
+            files.append((os.path.join(self.path, name),
+                          os.path.join(self.path, name + ".mrc")))
+        convertAllToMrc(files, numWorkers=3, voxelSize=4.4)
+
+        for _, outputFn in files:
+            np.testing.assert_array_equal(self._readMrc(outputFn), self.volume)
+        for _, outputFn in files[:2]:
+            with mrcfile.open(outputFn) as mrc:
+                self.assertAlmostEqual(float(mrc.voxel_size.x), 4.4, places=5)
+        self.assertTrue(os.path.islink(files[2][1]))
+
+        # one slice per slab
+        outputFn = os.path.join(self.path, "slabs.mrc")
+        writeMrcSlabs(self.volume, outputFn, slabBytes=5 * 4 * 4)
+        np.testing.assert_array_equal(self._readMrc(outputFn), self.volume)
+        with mrcfile.open(outputFn) as mrc:
+            self.assertEqual(mrc.header.dmax, self.volume.max())
+
+
+class TestRescale(BaseOutputTest):
+    def test_rescaleVolume(self):
+        import mrcfile
+        volume = np.random.default_rng(0).normal(size=(30, 40, 50)).astype(np.float32)
+        inputFn = os.path.join(self.path, "tomo.mrc")
+        mrcfile.new(inputFn, data=volume).close()
+        shape = getRescaledShape(volume.shape, 2.5)
+        self.assertEqual(shape, (12, 16, 20))
+
+        # small slabs, so that both passes are split over the processes
+        for nearest in [False, True]:
+            outputFn = os.path.join(self.path, f"tomo_{nearest}.mrc")
+            rescaleVolume(inputFn, outputFn, shape, nearest=nearest,
+                          numProcesses=2, voxelSize=10., slabBytes=4000)
+            with mrcfile.open(outputFn) as mrc:
+                np.testing.assert_allclose(mrc.data, resampleVolume(volume, shape, nearest),
+                                           atol=1e-5)
+                self.assertAlmostEqual(float(mrc.voxel_size.x), 10.)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ["tomo.mrc", "tomo_False.mrc", "tomo_True.mrc"])
+
+        # Fourier cropping keeps the mean and the low frequencies
+        x = np.arange(40)
+        wave = np.cos(2 * np.pi * x / 20)[None, None, :] * np.ones((4, 4, 1))
+        binned = resampleVolume(wave, (4, 4, 20))
+        np.testing.assert_allclose(binned[0, 0], np.cos(2 * np.pi * x[::2] / 20),
+                                   atol=1e-6)
+
+    def test_rescaleReference(self):
+        import mrcfile
+        inputFn = os.path.join(self.path, "ref.mrc")
+        mrcfile.new(inputFn, data=np.ones((50, 50, 50), dtype=np.float32)).close()
+        outputFn = os.path.join(self.path, "ref_37.mrc")
+        rescaleReference(inputFn, outputFn, 10. / 5., voxelSize=10.)
+        with mrcfile.open(outputFn) as mrc:
+            self.assertEqual(mrc.data.shape, (37, 37, 37))
+            np.testing.assert_allclose(mrc.data, 1., atol=1e-5)
+
+    def test_coordScale(self):
+        scale = getCoordScale((50, 40, 30), 2.5)
+        np.testing.assert_allclose(scale, [2.5, 2.5, 2.5])
+        # rounded dimensions give exact factors per axis
+        scale = getCoordScale((1001, 1000, 300), 2.)
+        np.testing.assert_allclose(scale, [1001 / 500, 1000 / 500, 300 / 150])
+
+
+class TestUmapTools(BaseOutputTest):
+    def test_stratifiedSample(self):
+        rows = stratifiedSample([1000, 2990, 10, 0], 400)
+        self.assertEqual([len(r) for r in rows], [100, 299, 1, 0])
+        for r, n in zip(rows, [1000, 3000, 10]):
+            self.assertEqual(len(np.unique(r)), len(r))
+            self.assertTrue(np.all(np.diff(r) > 0) and r[-1] < n)
+        # small tables are used entirely
+        rows = stratifiedSample([5, 10], 1000)
+        self.assertEqual([len(r) for r in rows], [5, 10])
+
+    def test_labelMask(self):
+        import mrcfile
+        import pandas as pd
+        table = pd.DataFrame({"X": [0, 2, 6, 20], "Y": [0, 2, 3, 0],
+                              "Z": [0, 2, 4, 0]})
+        table.attrs.update({"tomogram_input_shape": (6, 4, 8),
+                            "stride": [2, 2, 2]})
+        maskFn = getLabelMaskFn(os.path.join(self.path, "tomo_embeddings.tumap"))
+        self.assertEqual(os.path.basename(maskFn),
+                         "tomo_embeddings_label_mask.mrci")
+        writeLabelMask(table, maskFn)
+        with mrcfile.open(maskFn) as mrc:
+            # grid of the stride, 0 is the background
+            self.assertEqual(mrc.data.shape, (3, 2, 4))
+            self.assertEqual(np.count_nonzero(mrc.data), 3)
+            rows = mrc.data[tuple(np.nonzero(mrc.data))].astype(int) - 1
+            self.assertEqual(sorted(rows), [0, 1, 2])
+            self.assertEqual(mrc.data[0, 0, 0] - 1, 0)
+            self.assertEqual(mrc.data[2, 1, 3] - 1, 2)
+
+
+class TestBudget(BaseTest):
+    def test_derivedSizes(self):
+        budget = ResourceBudget(memory=16 * GB, cores=12)
+        rows = 20000000
+        sample = budget.getFitSampleSize(rows)
+        self.assertLessEqual(umapFootprint(rows, sample), budget.memory)
+        self.assertGreater(umapFootprint(rows, sample + 100), budget.memory)
+        # two UMAPs at the same time get half the memory each
+        self.assertLess(budget.getFitSampleSize(rows, jobs=2), sample)
+        self.assertEqual(budget.getFitSampleSize(1000), 1000)
+        self.assertEqual(ResourceBudget(memory=GB).getFitSampleSize(10 ** 8), 0)
+
+        self.assertEqual(budget.getConcurrency(5 * GB, maxSteps=8), 3)
+        self.assertEqual(budget.getConcurrency(GB, maxSteps=8), 8)
+        self.assertEqual(budget.getConcurrency(32 * GB, maxSteps=8), 1)
+        self.assertEqual(budget.getProcesses(3), 4)
+        self.assertEqual(budget.getProcesses(20), 1)
+        self.assertGreater(ResourceBudget().cores, 0)
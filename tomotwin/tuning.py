@@ -0,0 +1,203 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import fcntl
+import socket
+from contextlib import contextmanager
+
+from . import Plugin
+from .constants import TOMOTWIN_PROFILE
+
+OOM_PATTERNS = [
+    "CUDA out of memory",
+    "OutOfMemoryError",
+    "CUDA error: out of memory",
+    "cudaErrorMemoryAllocation",
+    "std::bad_alloc",
+    "MemoryError"
+]
+REDUCE_FACTOR = 0.5
+MAX_TIMINGS = 20
+
+
+class OutOfMemoryError(Exception):
+    """ A job failed because it ran out of (GPU) memory. """
+    pass
+
+
+def isOutOfMemory(text):
+    return any(p in text for p in OOM_PATTERNS)
+
+
+def checkOutOfMemory(logFn, error):
+    """ Raise OutOfMemoryError if the job log shows an OOM,
+    otherwise re-raise the original error. """
+    text = ""
+    if os.path.exists(logFn):
+        with open(logFn, errors="replace") as f:
+            text = f.read()
+    if isOutOfMemory(text) or isOutOfMemory(str(error)):
+        raise OutOfMemoryError(str(error)) from error
+    raise error
+
+
+class SizeProfile:
+    """ Largest batch, sample or chunk size known to work (and smallest
+    known to fail) per host, model and parameter, kept in a json file
+    shared by all the runs. The same file keeps the measured speed
+    of each kind of job, used by the cost estimator. """
+    def __init__(self, path, host=None):
+        self.path = path
+        self.host = host or socket.gethostname()
+
+    def getKey(self, model, name):
+        return f"{self.host}/{os.path.basename(str(model))}/{name}"
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "w") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        """ Return a dict with the known "ok" and "failed" values. """
+        return self._read().get(key, {})
+
+    def _write(self, data):
+        tmpFn = self.path + ".part"
+        with open(tmpFn, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmpFn, self.path)
+
+    def update(self, key, ok=None, failed=None):
+        with self._locked():
+            data = self._read()
+            entry = data.setdefault(key, {})
+            if ok is not None:
+                entry["ok"] = max(ok, entry.get("ok", 0))
+                if entry.get("failed", ok + 1) <= ok:
+                    del entry["failed"]
+            if failed is not None:
+                entry["failed"] = min(failed, entry.get("failed", failed))
+            self._write(data)
+
+    def _addValue(self, key, name, value):
+        """ Append a measurement, only the last MAX_TIMINGS are kept. """
+        with self._locked():
+            data = self._read()
+            values = data.setdefault(key, {}).setdefault(name, [])
+            values.append(value)
+            del values[:-MAX_TIMINGS]
+            self._write(data)
+
+    def _getMedian(self, key, name, default=None):
+        values = sorted(self.get(key).get(name, []))
+        return values[len(values) // 2] if values else default
+
+    def addTiming(self, key, units, seconds):
+        """ Record the speed (units per second) of a job. """
+        if units <= 0 or seconds <= 0:
+            return
+        self._addValue(key, "rates", units / seconds)
+
+    def getRate(self, key, default=None):
+        """ Median of the recorded speeds, or default. """
+        return self._getMedian(key, "rates", default)
+
+    def addFootprint(self, key, estimated, measured):
+        """ Record the memory measured for a job relative to its estimate. """
+        if estimated <= 0 or measured <= 0:
+            return
+        self._addValue(key, "footprints", measured / estimated)
+
+    def getFootprintScale(self, key, default=1.):
+        """ Median of the measured to estimated memory ratios, or default. """
+        return self._getMedian(key, "footprints", default)
+
+    def getStart(self, key, value):
+        """ Reduce the requested value below the smallest failed one,
+        if any. Values known to work are never increased. """
+        entry = self.get(key)
+        failed = entry.get("failed")
+        if failed is None or value < failed:
+            return value
+        ok = entry.get("ok")
+        if ok is not None and ok < failed:
+            return ok
+        while value >= failed and value > 1:
+            value = reduceSize(value)
+        return value
+
+
+def reduceSize(value, factor=REDUCE_FACTOR):
+    return max(1, int(value * factor))
+
+
+def runAdaptive(runner, value, profile=None, key=None, minValue=1,
+                log=print):
+    """ Call runner(value), reducing value geometrically each time it
+    raises OutOfMemoryError, down to minValue. The result is recorded
+    in the profile. Return the value that worked. """
+    if profile is not None:
+        start = profile.getStart(key, value)
+        if start != value:
+            log(f"Starting with {start} instead of {value} ({key})")
+        value = start
+
+    while True:
+        try:
+            runner(value)
+        except OutOfMemoryError:
+            if profile is not None:
+                profile.update(key, failed=value)
+            if value <= minValue:
+                raise
+            newValue = max(minValue, reduceSize(value))
+            log(f"Out of memory with {value}, retrying with {newValue}")
+            value = newValue
+        else:
+            if profile is not None:
+                profile.update(key, ok=value)
+            return value
+
+
+def getSizeProfile():
+    """ Profile file set in the plugin config. """
+    return SizeProfile(Plugin.getVar(TOMOTWIN_PROFILE))
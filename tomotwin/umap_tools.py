@@ -0,0 +1,174 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+""" UMAP of the tomogram embeddings shared by all the tomograms.
+
+The script runs inside the TomoTwin environment, where umap (or cuML)
+is installed:
+
+    python umap_tools.py fit -i tomo1.temb tomo2.temb -o model.pkl
+    python umap_tools.py transform -m model.pkl -i tomo1.temb -o tomo1.tumap
+
+pandas and mrcfile are only imported by the commands, so that the
+plugin can import this module. The fit uses a sample of all the
+tomograms, stratified by tomogram, and the fitted model is saved, so
+each tomogram (including tomograms added later) only needs the
+chunked transform. As "tomotwin_tools.py umap", the transform writes
+the .tumap table and the label mask (_label_mask.mrci) next to it,
+which napari-tomotwin needs to show the clusters on the tomogram.
+"""
+
+import os
+import sys
+import pickle
+import argparse
+
+import numpy as np
+
+FIT_SAMPLE_SIZE = 400000
+CHUNK_SIZE = 400000
+NEIGHBORS = 200
+SEED = 19
+
+
+def getUmapScript():
+    return os.path.abspath(__file__)
+
+
+def _getEmbeddingColumns(table):
+    return [c for c in table.columns if str(c).isdigit()]
+
+
+def stratifiedSample(sizes, sampleSize, seed=SEED):
+    """ Sorted row indexes to sample from each table, in proportion
+    to its number of rows and at least one per table. """
+    total = sum(sizes)
+    rng = np.random.default_rng(seed)
+    result = []
+    for n in sizes:
+        k = min(n, max(1, int(round(sampleSize * n / total)))) if n else 0
+        result.append(np.sort(rng.choice(n, k, replace=False)))
+    return result
+
+
+def _createUmap():
+    try:
+        from cuml import UMAP
+    except ImportError:
+        from umap import UMAP
+    return UMAP(n_neighbors=NEIGHBORS, n_components=2, random_state=SEED)
+
+
+def fit(embeddingsFns, modelFn, sampleSize=FIT_SAMPLE_SIZE):
+    """ Fit a UMAP on a pooled sample of the embeddings and save it. """
+    import pandas as pd
+    sizes = [len(pd.read_pickle(fn)) for fn in embeddingsFns]
+    sample = []
+    for fn, rows in zip(embeddingsFns, stratifiedSample(sizes, sampleSize)):
+        table = pd.read_pickle(fn)
+        sample.append(table[_getEmbeddingColumns(table)].to_numpy()[rows])
+        print(f"{fn}: {len(rows)} of {len(table)} rows", flush=True)
+    sample = np.concatenate(sample).astype(np.float32)
+
+    print(f"Fitting the UMAP with {len(sample)} rows", flush=True)
+    reducer = _createUmap()
+    reducer.fit(sample)
+    os.makedirs(os.path.dirname(os.path.abspath(modelFn)), exist_ok=True)
+    with open(modelFn + ".part", "wb") as f:
+        pickle.dump(reducer, f)
+    os.replace(modelFn + ".part", modelFn)
+
+
+def transform(modelFn, embeddingsFn, outputFn, chunkSize=CHUNK_SIZE):
+    """ Write the UMAP of a tomogram embedding, chunk by chunk. """
+    import pandas as pd
+    with open(modelFn, "rb") as f:
+        reducer = pickle.load(f)
+    table = pd.read_pickle(embeddingsFn)
+    vectors = table[_getEmbeddingColumns(table)].to_numpy().astype(np.float32)
+    result = np.empty((len(vectors), 2), dtype=np.float32)
+    for start in range(0, len(vectors), chunkSize):
+        result[start:start + chunkSize] = np.asarray(
+            reducer.transform(vectors[start:start + chunkSize]))
+        print(f"Transformed {min(start + chunkSize, len(vectors))} "
+              f"of {len(vectors)} rows", flush=True)
+
+    umap = pd.DataFrame(result, columns=["umap_0", "umap_1"])
+    umap.attrs["embeddings_path"] = os.path.abspath(embeddingsFn)
+    umap.attrs["umap_model"] = os.path.abspath(modelFn)
+    os.makedirs(os.path.dirname(os.path.abspath(outputFn)), exist_ok=True)
+    umap.to_pickle(outputFn)
+    writeLabelMask(table, getLabelMaskFn(outputFn))
+
+
+def getLabelMaskFn(umapFn):
+    return os.path.splitext(umapFn)[0] + "_label_mask.mrci"
+
+
+def writeLabelMask(table, outputFn):
+    """ Write the label mask of an embedding table, on the grid of the
+    embedding as TomoTwin does: a volume of the tomogram shape divided
+    by the stride, with the row index + 1 at each embedded position and
+    0 elsewhere. Ids are float32, as in TomoTwin, so they are exact up
+    to 2^24 rows. The volume is memory-mapped, not held in memory. """
+    import mrcfile
+    stride = int(np.ravel(table.attrs.get("stride", 1))[0])
+    coords = table[["Z", "Y", "X"]].to_numpy().astype(np.int64) // stride
+    shape = table.attrs.get("tomogram_input_shape")
+    shape = (tuple(int(n) // stride for n in shape) if shape is not None
+             else tuple(coords.max(axis=0) + 1))
+    if len(table) >= 2 ** 24:
+        print(f"Warning: {len(table)} rows, the label mask ids "
+              f"above 2^24 are not exact", flush=True)
+    rows = np.flatnonzero(np.all((coords >= 0) & (coords < shape), axis=1))
+    with mrcfile.new_mmap(outputFn, shape, mrc_mode=2, fill=0,
+                          overwrite=True) as mrc:
+        mrc.data[tuple(coords[rows].T)] = rows + 1
+        mrc.voxel_size = stride
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared TomoTwin UMAP")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fitParser = subparsers.add_parser("fit")
+    fitParser.add_argument("-i", "--input", nargs="+", required=True)
+    fitParser.add_argument("-o", "--output", required=True)
+    fitParser.add_argument("--fit_sample_size", type=int, default=FIT_SAMPLE_SIZE)
+    transformParser = subparsers.add_parser("transform")
+    transformParser.add_argument("-m", "--model", required=True)
+    transformParser.add_argument("-i", "--input", required=True)
+    transformParser.add_argument("-o", "--output", required=True)
+    transformParser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.command == "fit":
+        fit(args.input, args.output, args.fit_sample_size)
+    else:
+        transform(args.model, args.input, args.output, args.chunk_size)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -35,14 +35,16 @@ from pyworkflow.utils.properties import Message
 import pyworkflow.utils as pwutils
 from pwem.viewers.views import ObjectView
 
-from ..protocols import ProtTomoTwinRefPicking, ProtTomoTwinClusterPicking
+from ..protocols import (ProtTomoTwinRefPicking, ProtTomoTwinRefPickingStreaming,
+                         ProtTomoTwinClusterPicking)
 from .views_tkinter_tree import TomoTreeProvider, ViewerNapariDialog
 
 
 class NapariBoxManager(pwviewer.Viewer):
     """ Wrapper to visualize tomo coordinates using napari. """
     _environments = [pwviewer.DESKTOP_TKINTER]
-    _targets = [ProtTomoTwinRefPicking, ProtTomoTwinClusterPicking]
+    _targets = [ProtTomoTwinRefPicking, ProtTomoTwinRefPickingStreaming,
+                ProtTomoTwinClusterPicking]
 
     def __init__(self, **kwargs):
         pwviewer.Viewer.__init__(self, **kwargs)
@@ -88,19 +90,17 @@ class NapariBoxManager(pwviewer.Viewer):
         return []
 
     def _createTmpOutput(self, fileInfo, tomoList):
-        from tomotwin import Plugin
         tlocPath = fileInfo.getPath()
         flag = False
         for tomo in tomoList:
             tomoId = tomo.getTsId()
             tlocFn = os.path.join(tlocPath, f"{tomoId}.tloc")
             if os.path.exists(tlocFn):
-                tmpDir = self._getTmpPath(tomoId)
-                pwutils.cleanPath(tmpDir)
-                pwutils.makePath(tmpDir)
-                program = Plugin.getProgram("tomotwin_pick.py", gpus=False)
-                args = f"-l {os.path.abspath(tlocFn)} -o Tmp/{tomoId}"
-                pwutils.runJob(None, program, args, env=Plugin.getEnviron())
+                # the protocol reads the table in-process from Tmp
+                outputFn = self.protocol._getTlocFn(tomoId, fromViewer=True)
+                pwutils.cleanPath(outputFn)
+                pwutils.makePath(os.path.dirname(outputFn))
+                pwutils.createAbsLink(os.path.abspath(tlocFn), outputFn)
                 flag = True
             else:
                 print(f"Could not find {tlocFn}, skipping...")
@@ -56,7 +56,7 @@ class ViewerNapariDialog(ToolbarListDialog):
                                    allowSelect=False, **kwargs)
 
     def doubleClickOnTomogram(self, tomo=None):
-        tomo_path = tomo.getFileName()
+        tomo_path = self.prot._getViewerTomoFn(tomo)
         self.prot._createFilenameTemplates()
         tloc_fn = self.prot._getFileName("output_tloc", tomoId=tomo.getTsId())
         if not os.path.exists(tloc_fn):
@@ -65,9 +65,21 @@ class ViewerNapariDialog(ToolbarListDialog):
             proc = threading.Thread(target=self.launchNapari,
                                     args=(tomo_path, tloc_fn,))
             proc.start()
+            heatmaps_fn = self.prot._getHeatmapsFn(tomo.getTsId())
+            if os.path.exists(heatmaps_fn):
+                threading.Thread(target=self.launchHeatmaps,
+                                 args=(tomo_path, heatmaps_fn,)).start()
 
     def launchNapari(self, tomoFn, tlocFn):
         from tomotwin import Plugin, NAPARI_BOXMANAGER
         args = f"{tomoFn} {tlocFn}"
         Plugin.runNapariBoxManager(self.prot.getProject().getPath(),
                                    NAPARI_BOXMANAGER, args)
+
+    def launchHeatmaps(self, tomoFn, heatmapsFn):
+        """ Heatmaps are read lazily in a second Napari window. """
+        from tomotwin import Plugin
+        from tomotwin.heatmaps import getHeatmapsScript
+        args = f"view {os.path.abspath(heatmapsFn)} --tomo {os.path.abspath(tomoFn)}"
+        Plugin.runNapariBoxManager(self.prot.getProject().getPath(),
+                                   f"python {getHeatmapsScript()}", args)
@@ -26,11 +26,12 @@
 
 from pwem.wizards.wizard import EmWizard
 
-from .protocols import ProtTomoTwinRefPicking
+from .protocols import ProtTomoTwinRefPicking, ProtTomoTwinRefPickingStreaming
 
 
 class TomoTwinBoxSizeWizard(EmWizard):
-    _targets = [(ProtTomoTwinRefPicking, ['boxSize'])]
+    _targets = [(ProtTomoTwinRefPicking, ['boxSize']),
+                (ProtTomoTwinRefPickingStreaming, ['boxSize'])]
 
     def show(self, form, *params):
         prot = form.protocol
@@ -0,0 +1,376 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+""" Long-lived TomoTwin worker.
+
+The worker runs inside the TomoTwin environment and only uses the
+standard library, so it can be started as a script:
+
+    python worker.py serve --socket $XDG_RUNTIME_DIR/tomotwin/w.sock --model model.pth
+
+It imports torch and the TomoTwin modules once, then forks a child per
+job that inherits them. Each child sets its own CUDA_VISIBLE_DEVICES,
+working directory and log file, runs the program entry point and
+returns the exit status. The plugin side uses WorkerClient.
+Sockets are in a directory only accessible by the user, and both
+sides check that the process at the other end belongs to the user.
+
+The batch command runs a list of jobs one after the other in a
+single process instead (see runBatch).
+"""
+
+import os
+import io
+import sys
+import json
+import glob
+import time
+import shlex
+import shutil
+import socket
+import stat
+import struct
+import argparse
+import tempfile
+import traceback
+import subprocess
+import socketserver
+import runpy
+from contextlib import contextmanager
+
+PRELOAD_MODULES = ["numpy", "pandas", "torch", "tomotwin"]
+IDLE_TIMEOUT = 3600  # seconds
+START_TIMEOUT = 60
+
+
+def getSocketDir():
+    """ Directory of the worker sockets, private to the user:
+    $XDG_RUNTIME_DIR/tomotwin or, without it, tomotwin-<uid> in the
+    system tmp. Socket paths are limited to ~100 chars, so they are
+    not kept in the project. """
+    runtimeDir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtimeDir and os.path.isdir(runtimeDir):
+        path = os.path.join(runtimeDir, "tomotwin")
+    else:
+        path = os.path.join(tempfile.gettempdir(), f"tomotwin-{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    # an existing path (e.g. created by another user) must not be used
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not a directory of the current user")
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
+
+
+def getSocketPath(name):
+    return os.path.join(getSocketDir(), f"{name}.sock")
+
+
+def getPeerUid(conn):
+    """ User id of the process at the other end of a Unix socket,
+    None if the platform does not tell (no SO_PEERCRED). """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+def _checkPeer(conn, socketPath=None):
+    """ Raise PermissionError if the peer is not a process of the
+    user. Without SO_PEERCRED, the owner of the socket file is
+    checked instead. """
+    uid = getPeerUid(conn)
+    if uid is None and socketPath is not None:
+        uid = os.stat(socketPath).st_uid
+    if uid is not None and uid != os.getuid():
+        raise PermissionError(f"Peer of {socketPath or 'the socket'} "
+                              f"belongs to user {uid}")
+
+
+def getWorkerScript():
+    return os.path.abspath(__file__)
+
+
+def expandArgs(args, cwd):
+    """ Split a command line and expand the globs, as the shell would. """
+    result = []
+    for token in shlex.split(args):
+        if any(c in token for c in "*?["):
+            matches = sorted(glob.glob(os.path.join(cwd, token)))
+            if matches:
+                result.extend(os.path.relpath(m, cwd) for m in matches)
+                continue
+        result.append(token)
+    return result
+
+
+@contextmanager
+def _jobContext(job):
+    """ Working directory, environment and output of a job, restored
+    afterwards so that several jobs can run in the same process. """
+    cwd, environ = os.getcwd(), dict(os.environ)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    savedFds = [os.dup(1), os.dup(2)]
+    logFd = os.open(job["log"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(logFd, 1)
+    os.dup2(logFd, 2)
+    os.close(logFd)
+    os.chdir(job["cwd"])
+    os.environ.update(job.get("env", {}))
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, savedFd in zip([1, 2], savedFds):
+            os.dup2(savedFd, fd)
+            os.close(savedFd)
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def _runEntryPoint(program, args, cwd):
+    """ Run a program of the environment, or a script
+    given as "python script.py", in this process. """
+    parts = shlex.split(program)
+    if len(parts) == 2 and parts[0] in ("python", "python3"):
+        programFn = parts[1] if os.path.isfile(parts[1]) else None
+    else:
+        programFn = shutil.which(program)
+    if programFn is None:
+        print(f"{program} not found", flush=True)
+        return 127
+
+    sys.argv = [programFn] + expandArgs(args, cwd)
+    try:
+        runpy.run_path(programFn, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, flush=True)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def runJob(job):
+    """ Run a job in the current process and return its exit
+    status. Output goes to the job log. """
+    with _jobContext(job):
+        return _runEntryPoint(job["program"], job.get("args", ""),
+                              os.path.abspath(job["cwd"]))
+
+
+def runBatch(jobs, resultsFn=None):
+    """ Run several jobs one after the other in this process, so that
+    modules, the CUDA context and the cached model are loaded once.
+    A failed job does not stop the others. Return (and write to
+    resultsFn after each job) the exit status by job id. """
+    results = {}
+    for job in jobs:
+        results[job["id"]] = runJob(job)
+        if resultsFn:
+            with open(resultsFn + ".part", "w") as f:
+                json.dump(results, f)
+            os.replace(resultsFn + ".part", resultsFn)
+    return results
+
+
+def _send(conn, message):
+    conn.sendall((json.dumps(message) + "\n").encode())
+
+
+def _receive(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise ConnectionError("Connection closed by the worker")
+        data += chunk
+    return json.loads(data)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            _checkPeer(self.request)
+        except PermissionError as e:
+            print(e, flush=True)
+            return
+        request = _receive(self.request)
+        if request.get("cmd") == "ping":
+            _send(self.request, {"status": 0, "pid": os.getppid()})
+        elif request.get("cmd") == "run":
+            _send(self.request, {"status": runJob(request)})
+
+
+class _Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """ The parent process only accepts connections and forks,
+    each connection is handled by its own child. """
+    timeout = 10
+    lastRequest = 0
+
+    def process_request(self, request, clientAddress):
+        self.lastRequest = time.time()
+        socketserver.ForkingMixIn.process_request(self, request, clientAddress)
+
+
+def _cacheModel(modelFn):
+    """ Keep the model file in memory, so torch.load of that
+    path in the jobs does not read it again from disk. """
+    import torch
+    modelFn = os.path.realpath(modelFn)
+    with open(modelFn, "rb") as f:
+        data = f.read()
+    load = torch.load
+
+    def _load(f, *args, **kwargs):
+        if isinstance(f, (str, os.PathLike)) and os.path.realpath(f) == modelFn:
+            f = io.BytesIO(data)
+        return load(f, *args, **kwargs)
+
+    torch.load = _load
+
+
+def _preload(modules, modelFn=None):
+    for module in modules:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+    if modelFn and os.path.exists(modelFn):
+        _cacheModel(modelFn)
+
+
+def serve(socketPath, modelFn=None, preload=PRELOAD_MODULES,
+          idleTimeout=IDLE_TIMEOUT):
+    _preload(preload, modelFn)
+
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = _Server(socketPath, _Handler)
+    server.lastRequest = time.time()
+    print(f"TomoTwin worker {os.getpid()} listening on {socketPath}", flush=True)
+    try:
+        while time.time() - server.lastRequest < idleTimeout:
+            server.handle_request()
+            server.collect_children()
+    finally:
+        server.server_close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+
+
+class WorkerClient:
+    """ Send jobs to a worker listening on a Unix socket. """
+    def __init__(self, socketPath):
+        self.socketPath = socketPath
+
+    def _request(self, message, timeout=None):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(timeout)
+            conn.connect(self.socketPath)
+            _checkPeer(conn, self.socketPath)
+            _send(conn, message)
+            return _receive(conn)
+
+    def ping(self, timeout=5):
+        return self.getPid(timeout) is not None
+
+    def getPid(self, timeout=5):
+        """ Process id of the worker, None if it does not answer. """
+        try:
+            reply = self._request({"cmd": "ping"}, timeout)
+        except (OSError, ValueError):
+            return None
+        return reply["pid"] if reply.get("status") == 0 else None
+
+    def run(self, program, args, cwd, logFn, env=None):
+        """ Run a program with the given command line arguments
+        and return its exit status. Raise OSError if the worker
+        cannot be reached. """
+        return self._request({"cmd": "run", "program": program,
+                              "args": args, "cwd": os.path.abspath(cwd),
+                              "log": os.path.abspath(logFn),
+                              "env": env or {}})["status"]
+
+
+def startWorker(activation, socketPath, modelFn=None, logFn=None,
+                timeout=START_TIMEOUT):
+    """ Return a client of the worker on socketPath, starting it in
+    the background if needed. Return None if it does not answer. """
+    client = WorkerClient(socketPath)
+    if client.ping():
+        return client
+
+    cmd = f"python {getWorkerScript()} serve --socket {socketPath}"
+    if modelFn:
+        cmd += f" --model {modelFn}"
+    if activation:
+        cmd = f"{activation} && {cmd}"
+    with open(logFn or os.devnull, "a") as log:
+        subprocess.Popen(cmd, shell=True, stdout=log, stderr=log,
+                         stdin=subprocess.DEVNULL, start_new_session=True)
+
+    start = time.time()
+    while time.time() - start < timeout:
+        if client.ping(timeout=1):
+            return client
+        time.sleep(0.5)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TomoTwin worker")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serveParser = subparsers.add_parser("serve")
+    serveParser.add_argument("--socket", required=True)
+    serveParser.add_argument("--model", default=None)
+    serveParser.add_argument("--preload", nargs="*", default=PRELOAD_MODULES)
+    serveParser.add_argument("--idle-timeout", type=int, default=IDLE_TIMEOUT)
+    batchParser = subparsers.add_parser("batch")
+    batchParser.add_argument("--jobs", required=True)
+    batchParser.add_argument("--results", required=True)
+    batchParser.add_argument("--model", default=None)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.socket, args.model, args.preload, args.idle_timeout)
+    else:
+        with open(args.jobs) as f:
+            jobs = json.load(f)
+        _preload([], args.model)
+        runBatch(jobs, args.results)
+
+
+if __name__ == "__main__":
+    main()